@@ -70,6 +70,14 @@ echo "[*] Políticas por defecto: ACCEPT en todas las cadenas..."
 "$IPTABLES_BIN" -P FORWARD ACCEPT
 "$IPTABLES_BIN" -P OUTPUT ACCEPT
 
+# Limitación de velocidad por sesión (traffic_shaping.py, PORTAL_SHAPING=1)
+if command -v tc >/dev/null 2>&1; then
+  echo "[*] Quitando qdiscs de limitación de velocidad..."
+  tc qdisc del dev "${PORTAL_LAN_IF:-enp0s8}" root 2>/dev/null || true
+  tc qdisc del dev "${PORTAL_LAN_IF:-enp0s8}" ingress 2>/dev/null || true
+  ip link del "${PORTAL_SHAPING_IFB:-ifb-portal}" 2>/dev/null || true
+fi
+
 "$IPTABLES_BIN" -L -n -v
 
 echo "[*] Guardando reglas (iptables-save)..."
@@ -44,6 +44,7 @@ HOST_NET="192.168.56.0/24"
 PORTAL_HTTP_PORT=${PORTAL_HTTP_PORT:-8080}   # puerto real donde escuchará el portal cautivo
 CAPTIVE_HTTP_PORT=${CAPTIVE_HTTP_PORT:-80}   # puerto que interceptamos de los clientes (HTTP claro)
 PORTAL_HTTPS_PORT=${PORTAL_HTTPS_PORT:-}     # si se define, habilita un puerto TLS para el portal
+PORTAL_DNS_PORT=${PORTAL_DNS_PORT:-}         # si se define, el DNS de la LAN va al DNS cautivo del portal
 
 if [ "$EUID" -ne 0 ]; then
   echo "Este script debe ejecutarse como root" >&2
@@ -117,6 +118,16 @@ fi
 echo "[*] Redirigiendo HTTP de clientes no autenticados hacia el portal..."
 "$IPTABLES_BIN" -t nat -A PREROUTING -i "$LAN_IF" -p tcp --dport "$CAPTIVE_HTTP_PORT" -j REDIRECT --to-ports "$PORTAL_HTTP_PORT"
 
+if [ -n "$PORTAL_DNS_PORT" ]; then
+  echo "[*] Redirigiendo DNS de la LAN al DNS cautivo del portal (puerto $PORTAL_DNS_PORT)..."
+  "$IPTABLES_BIN" -A INPUT -i "$LAN_IF" -p udp --dport "$PORTAL_DNS_PORT" -j ACCEPT
+  "$IPTABLES_BIN" -A INPUT -i "$LAN_IF" -p tcp --dport "$PORTAL_DNS_PORT" -j ACCEPT
+  "$IPTABLES_BIN" -t nat -A PREROUTING -i "$LAN_IF" -p udp --dport 53 -j REDIRECT --to-ports "$PORTAL_DNS_PORT"
+  "$IPTABLES_BIN" -t nat -A PREROUTING -i "$LAN_IF" -p tcp --dport 53 -j REDIRECT --to-ports "$PORTAL_DNS_PORT"
+  # Los nombres resueltos al portal que se pidan por HTTPS fallan al instante en vez de colgarse
+  echo "[*] Rechazando HTTPS hacia el gateway con TCP reset..."
+  "$IPTABLES_BIN" -A INPUT -i "$LAN_IF" -p tcp --dport 443 -j REJECT --reject-with tcp-reset
+fi
 
 
 echo "[*] Firewall base aplicado."
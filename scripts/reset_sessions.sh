@@ -1,6 +1,7 @@
 #!/usr/bin/env bash
 # scripts/reset_sessions.sh
-# Elimina todas las sesiones persistidas en config/sessions.json.
+# Elimina todas las sesiones persistidas en config/sessions.json y revoca los
+# tokens de sesión de sus IPs (config/revoked_tokens.json, que el portal relee).
 
 set -euo pipefail
 
@@ -18,16 +19,24 @@ import sys
 
 sys.path.insert(0, os.environ["PYTHONPATH"])
 
-from sessions import eliminar_sesion, obtener_todas_las_sesiones
+import session_tokens
+from sessions import cargar_sesiones, eliminar_sesion, obtener_todas_las_sesiones
 
-sessions = obtener_todas_las_sesiones()
+cargar_sesiones(aplicar_firewall=False)
+# La vista es de solo lectura y refleja las bajas: tomar las claves antes de borrar
+claves = list(obtener_todas_las_sesiones())
 
-if not sessions:
+if not claves:
     print("No hay sesiones guardadas. Nada que eliminar.")
     raise SystemExit(0)
 
-for (ip, mac) in list(sessions.keys()):
+for (ip, mac) in claves:
     eliminar_sesion(ip, mac)
 
-print(f"Sesiones eliminadas: {len(sessions)}")
+# Sin esto /status y /success seguirían aceptando el token de una sesión borrada
+if session_tokens.ENABLED:
+    for ip in sorted({ip for (ip, _mac) in claves}):
+        session_tokens.revocar_ip(ip)
+
+print(f"Sesiones eliminadas: {len(claves)}")
 PY
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+adaptive_pool.py
+
+Pool de hilos de tamaño adaptable para atender conexiones (sustituye al
+ThreadPoolExecutor de tamaño fijo en run_server).
+
+- Crece cuando las peticiones esperan en cola más de lo tolerado
+  (espera objetivo) y reduce hilos cuando la utilización se mantiene baja
+  durante varias ventanas seguidas, siempre entre un mínimo y un máximo.
+- La espera se mide por petición (desde submit hasta que un hilo la toma) y
+  la utilización como tiempo ocupado / (hilos × duración de la ventana).
+- Cada decisión de tamaño se registra en el log con las medidas que la
+  motivaron, para ajustar los límites con tráfico real.
+
+Interfaz compatible con el uso de concurrent.futures en el servidor:
+`with AdaptiveExecutor(...) as executor: executor.submit(fn, *args)`; al
+salir del bloque se espera a que terminen las peticiones encoladas.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, Tuple
+
+# Ventanas seguidas con poca carga antes de retirar hilos (histéresis)
+VENTANAS_PARA_REDUCIR = 5
+
+_Tarea = Tuple[float, Future, Callable, tuple]
+
+
+class AdaptiveExecutor:
+    """
+    Pool de hilos con tamaño entre `minimo` y `maximo` ajustado cada
+    `intervalo` segundos según la espera en cola (p95 frente a
+    `espera_objetivo`) y la utilización (por debajo de `utilizacion_baja`
+    se reduce).
+    """
+
+    def __init__(
+        self,
+        minimo: int,
+        maximo: int,
+        espera_objetivo: float = 0.05,
+        utilizacion_baja: float = 0.3,
+        intervalo: float = 1.0,
+        nombre: str = "http-worker",
+    ) -> None:
+        if minimo < 1 or maximo < minimo:
+            raise ValueError(f"Límites de hilos inválidos: mínimo={minimo}, máximo={maximo}")
+        self.minimo = minimo
+        self.maximo = maximo
+        self.espera_objetivo = espera_objetivo
+        self.utilizacion_baja = utilizacion_baja
+        self.intervalo = intervalo
+        self.nombre = nombre
+
+        self._cond = threading.Condition()
+        self._cola: Deque[_Tarea] = deque()
+        self._hilos = 0
+        self._ocupados = 0
+        # Inicio de cada tarea en curso (por hilo), para medir la ocupación parcial
+        self._en_curso: Dict[int, float] = {}
+        self._a_retirar = 0
+        self._cerrado = False
+        self._secuencia = 0
+        self._hilos_vivos: List[threading.Thread] = []
+
+        # Medidas de la ventana actual
+        self._esperas: List[float] = []
+        self._ocupado_ventana = 0.0
+        self._inicio_ventana = time.monotonic()
+        self._ventanas_ociosas = 0
+        self._metricas: Dict[str, float] = {
+            "crecimientos": 0,
+            "reducciones": 0,
+            "tareas": 0,
+            "espera_p95_ms": 0.0,
+            "utilizacion": 0.0,
+        }
+
+        with self._cond:
+            self._lanzar(minimo)
+        self._controlador = threading.Thread(target=self._controlar, daemon=True, name=f"{nombre}-sizing")
+        self._controlador.start()
+
+    # -- interfaz tipo Executor ------------------------------------------------
+
+    def submit(self, fn: Callable, *args) -> Future:
+        futuro: Future = Future()
+        ahora = time.monotonic()
+        with self._cond:
+            if self._cerrado:
+                raise RuntimeError("No se aceptan tareas tras shutdown()")
+            self._cola.append((ahora, futuro, fn, args))
+            # Crecimiento inmediato si todos los hilos están ocupados y la tarea más
+            # antigua ya superó la espera objetivo (los hilos recién lanzados cuentan
+            # como libres hasta que toman trabajo: no se crece dos veces por lo mismo)
+            if (
+                self._hilos < self.maximo
+                and self._ocupados >= self._hilos
+                and ahora - self._cola[0][0] > self.espera_objetivo
+            ):
+                self._redimensionar(self._hilos + max(1, self._hilos // 2), "cola retrasada", ahora)
+            self._cond.notify()
+        return futuro
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Deja de aceptar tareas; los hilos terminan las encoladas y salen."""
+        with self._cond:
+            self._cerrado = True
+            self._cond.notify_all()
+            hilos = list(self._hilos_vivos)
+        if wait:
+            for hilo in hilos:
+                hilo.join()
+
+    def __enter__(self) -> "AdaptiveExecutor":
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self.shutdown(wait=True)
+
+    def metricas(self) -> Dict[str, float]:
+        """Tamaño actual, ocupación, cola y contadores de decisiones."""
+        with self._cond:
+            return dict(self._metricas, hilos=self._hilos, ocupados=self._ocupados, cola=len(self._cola))
+
+    # -- hilos -----------------------------------------------------------------
+
+    def _lanzar(self, n: int) -> None:
+        """Arranca n hilos. Llamar con _cond tomado."""
+        for _ in range(n):
+            self._secuencia += 1
+            hilo = threading.Thread(target=self._trabajar, daemon=True, name=f"{self.nombre}-{self._secuencia}")
+            self._hilos += 1
+            self._hilos_vivos.append(hilo)
+            hilo.start()
+
+    def _trabajar(self) -> None:
+        while True:
+            with self._cond:
+                while not self._cola:
+                    if self._a_retirar or self._cerrado:
+                        if self._a_retirar:
+                            self._a_retirar -= 1
+                        self._hilos -= 1
+                        self._hilos_vivos.remove(threading.current_thread())
+                        return
+                    self._cond.wait()
+                encolada, futuro, fn, args = self._cola.popleft()
+                inicio = time.monotonic()
+                self._esperas.append(inicio - encolada)
+                self._ocupados += 1
+                self._en_curso[threading.get_ident()] = inicio
+
+            if futuro.set_running_or_notify_cancel():
+                try:
+                    futuro.set_result(fn(*args))
+                except BaseException as exc:  # noqa: BLE001
+                    logging.exception("[POOL] Error no controlado en %s: %s", getattr(fn, "__name__", fn), exc)
+                    futuro.set_exception(exc)
+
+            fin = time.monotonic()
+            with self._cond:
+                self._ocupados -= 1
+                del self._en_curso[threading.get_ident()]
+                self._ocupado_ventana += fin - max(inicio, self._inicio_ventana)
+                self._metricas["tareas"] += 1
+
+    # -- dimensionado ----------------------------------------------------------
+
+    def _redimensionar(self, objetivo: int, motivo: str, ahora: float) -> None:
+        """Ajusta el número de hilos a `objetivo` (acotado) y registra la decisión. Con _cond tomado."""
+        objetivo = max(self.minimo, min(self.maximo, objetivo))
+        actual = self._hilos - self._a_retirar
+        if objetivo == actual:
+            return
+        p95, utilizacion = self._medidas(ahora)
+        if objetivo > actual:
+            self._metricas["crecimientos"] += 1
+            # Primero se cancelan retiros pendientes, luego se lanzan hilos nuevos
+            cancelados = min(self._a_retirar, objetivo - actual)
+            self._a_retirar -= cancelados
+            self._lanzar(objetivo - actual - cancelados)
+        else:
+            self._metricas["reducciones"] += 1
+            self._a_retirar += actual - objetivo
+            self._cond.notify_all()
+        logging.info(
+            "[POOL] %d -> %d hilos (%s: espera p95=%.1f ms, utilización=%.0f%%, cola=%d, límites %d-%d)",
+            actual,
+            objetivo,
+            motivo,
+            p95 * 1000,
+            utilizacion * 100,
+            len(self._cola),
+            self.minimo,
+            self.maximo,
+        )
+
+    def _medidas(self, ahora: float) -> Tuple[float, float]:
+        """(espera p95, utilización) de la ventana en curso. Con _cond tomado."""
+        # Las tareas aún en cola también cuentan con lo que llevan esperando
+        esperas = self._esperas + [ahora - encolada for encolada, _f, _fn, _a in self._cola]
+        esperas.sort()
+        p95 = esperas[min(len(esperas) - 1, int(len(esperas) * 0.95))] if esperas else 0.0
+        duracion = max(ahora - self._inicio_ventana, 1e-6)
+        ocupado = self._ocupado_ventana + sum(ahora - max(inicio, self._inicio_ventana) for inicio in self._en_curso.values())
+        utilizacion = min(1.0, ocupado / (max(self._hilos, 1) * duracion))
+        return p95, utilizacion
+
+    def _controlar(self) -> None:
+        """Cada intervalo evalúa la ventana y decide crecer, reducir o mantener."""
+        while True:
+            time.sleep(self.intervalo)
+            with self._cond:
+                if self._cerrado:
+                    return
+                ahora = time.monotonic()
+                p95, utilizacion = self._medidas(ahora)
+                self._metricas["espera_p95_ms"] = round(p95 * 1000, 2)
+                self._metricas["utilizacion"] = round(utilizacion, 3)
+                actual = self._hilos - self._a_retirar
+
+                if p95 > self.espera_objetivo and actual < self.maximo:
+                    self._ventanas_ociosas = 0
+                    self._redimensionar(actual + max(1, actual // 2), "espera alta", ahora)
+                elif utilizacion < self.utilizacion_baja and p95 <= self.espera_objetivo / 2 and actual > self.minimo:
+                    self._ventanas_ociosas += 1
+                    if self._ventanas_ociosas >= VENTANAS_PARA_REDUCIR:
+                        self._ventanas_ociosas = 0
+                        # Dejar hilos para la carga observada con margen (el doble), retirando como mucho la cuarta parte
+                        necesarios = int(utilizacion * actual * 2) + 1
+                        self._redimensionar(max(necesarios, actual - max(1, actual // 4)), "utilización baja", ahora)
+                else:
+                    self._ventanas_ociosas = 0
+
+                self._esperas = []
+                self._ocupado_ventana = 0.0
+                self._inicio_ventana = ahora
+
+
+if __name__ == "__main__":
+    # Prueba manual: ráfaga de tareas lentas (como llamadas a iptables) y luego
+    # calma; el log muestra cómo crece y vuelve al mínimo.
+    #   python3 src/adaptive_pool.py
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    with AdaptiveExecutor(2, 32, espera_objetivo=0.05, intervalo=0.5) as pool:
+        for _ in range(400):
+            pool.submit(time.sleep, 0.05)
+            time.sleep(0.002)
+        time.sleep(6)
+        print("métricas:", pool.metricas())
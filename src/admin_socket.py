@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+admin_socket.py
+
+Socket Unix de administración del portal (PORTAL_ADMIN_SOCKET=/ruta.sock;
+vacío = deshabilitado). Trabaja sobre el estado en memoria del proceso en
+marcha, a diferencia de editar config/sessions.json o scripts/reset_sessions.sh.
+
+Protocolo: una petición JSON por línea y respuestas JSON por línea.
+
+    {"op": "listar", "usuario": "ana"}            -> una línea por sesión y {"ok": true, "total": n}
+    {"op": "revocar", "subred": "10.0.3.0/24"}    -> {"ok": true, "revocadas": n, "segundos": t}
+    {"op": "extender", "usuario": "ana", "segundos": 3600[, "desde_ahora": true]}
+    {"op": "importar", "entradas": [{"mac": "...", "ip": "...", "usuario": "..."}], "ttl": 86400}
+
+Filtros (se combinan con Y): "usuario", "subred" (CIDR), "ip", "mac"; para
+revocar o extender todas las sesiones hay que pedirlo con "todas": true.
+
+- El listado se envía en streaming: se recorre la vista de sessions (solo
+  referencias, sin copiar los datos) y se escribe en bloques de líneas.
+- Revocar, extender e importar son un lote cada uno: un único paso por el
+  almacén con su lock, un guardado a disco y una transacción de firewall
+  (iptables-restore), así que miles de sesiones tardan segundos.
+- Importar crea sesiones para MACs preautorizadas; si la entrada no trae IP
+  se busca en la tabla de vecinos, y las MACs sin IP conocida se devuelven en
+  "sin_ip" para reintentarlas cuando el equipo aparezca en la red.
+
+El socket se crea con permisos 0600 y además solo se aceptan clientes con el
+mismo uid que el portal o root (SO_PEERCRED).
+
+Cliente de línea de comandos (ver __main__):
+
+    python3 src/admin_socket.py listar --usuario ana
+    python3 src/admin_socket.py revocar --subred 10.0.3.0/24
+    python3 src/admin_socket.py extender --usuario ana --segundos 3600
+    python3 src/admin_socket.py importar macs.txt --ttl 86400
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import arp_lookup
+import sessions
+
+SOCKET_PATH = os.getenv("PORTAL_ADMIN_SOCKET", "").strip()
+# Sesiones por escritura en el listado (un sendall cada tantas líneas)
+LOTE_LISTADO = 256
+# Tamaño máximo de una petición (importar puede traer miles de entradas)
+MAX_PETICION = 16 * 1024 * 1024
+USUARIO_PREAUTORIZADO = "preautorizado"
+
+_CREDENCIALES = struct.Struct("3i")  # pid, uid, gid de SO_PEERCRED
+
+_metricas: Dict[str, int] = {"conexiones": 0, "rechazadas": 0, "operaciones": 0, "errores": 0}
+
+
+class PeticionInvalida(ValueError):
+    """Petición mal formada; se responde {"ok": false, "error": ...} y la conexión sigue."""
+
+
+def _json(mensaje: dict) -> bytes:
+    return json.dumps(mensaje, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _sesion_dict(sess: sessions.Session) -> dict:
+    return {
+        "username": sess.username,
+        "ip": sess.ip,
+        "mac": sess.mac,
+        "login_time": sess.login_time,
+        "expires_at": sess.expires_at,
+        "bytes_used": sess.bytes_used,
+        "byte_quota": sess.byte_quota,
+        "last_activity": sess.last_activity,
+    }
+
+
+def construir_filtro(peticion: dict, exigir: bool) -> Callable[[sessions.Session], bool]:
+    """
+    Filtro de sesiones a partir de los campos usuario/subred/ip/mac de la
+    petición. Con `exigir`, una petición sin filtros ni "todas": true es un error.
+    """
+    condiciones: List[Callable[[sessions.Session], bool]] = []
+    usuario = peticion.get("usuario")
+    if usuario is not None:
+        condiciones.append(lambda s: s.username == usuario)
+    if peticion.get("subred") is not None:
+        try:
+            red = ipaddress.ip_network(str(peticion["subred"]), strict=False)
+        except ValueError as exc:
+            raise PeticionInvalida(f"subred inválida: {exc}") from None
+
+        def _en_red(s: sessions.Session) -> bool:
+            try:
+                return ipaddress.ip_address(s.ip) in red
+            except ValueError:
+                return False
+
+        condiciones.append(_en_red)
+    ip = peticion.get("ip")
+    if ip is not None:
+        condiciones.append(lambda s: s.ip == ip)
+    mac = peticion.get("mac")
+    if mac is not None:
+        mac = str(mac).lower()
+        condiciones.append(lambda s: s.mac == mac)
+
+    if not condiciones:
+        if exigir and peticion.get("todas") is not True:
+            raise PeticionInvalida('indica usuario, subred, ip o mac (o "todas": true)')
+        return lambda s: True
+    return lambda s: all(condicion(s) for condicion in condiciones)
+
+
+def _listar(conn: socket.socket, peticion: dict) -> None:
+    filtro = construir_filtro(peticion, exigir=False)
+    bloque: List[bytes] = []
+    total = 0
+    # values() toma bajo el lock solo las referencias; cada sesión se serializa al enviarla
+    for sess in sessions.obtener_todas_las_sesiones().values():
+        if not filtro(sess):
+            continue
+        bloque.append(_json(_sesion_dict(sess)))
+        total += 1
+        if len(bloque) >= LOTE_LISTADO:
+            conn.sendall(b"".join(bloque))
+            bloque.clear()
+    bloque.append(_json({"ok": True, "total": total}))
+    conn.sendall(b"".join(bloque))
+
+
+def _importar(peticion: dict) -> dict:
+    entradas = peticion.get("entradas")
+    if not isinstance(entradas, list):
+        raise PeticionInvalida('"entradas" debe ser una lista')
+    ttl = peticion.get("ttl")
+    if ttl is not None and not isinstance(ttl, int):
+        raise PeticionInvalida('"ttl" debe ser un entero (segundos)')
+
+    ip_por_mac: Optional[Dict[str, str]] = None
+    lote: List[Tuple[str, str, Optional[str]]] = []
+    sin_ip: List[str] = []
+    for entrada in entradas:
+        if not isinstance(entrada, dict) or not arp_lookup.MAC_RE.fullmatch(str(entrada.get("mac", ""))):
+            raise PeticionInvalida(f"entrada sin MAC válida: {entrada!r}")
+        mac = entrada["mac"].lower()
+        ip = entrada.get("ip")
+        if not ip:
+            if ip_por_mac is None:
+                # Una sola lectura de la tabla de vecinos para todo el lote
+                ip_por_mac = {m: i for i, m in arp_lookup.tabla_vecinos().items()}
+            ip = ip_por_mac.get(mac)
+            if ip is None:
+                sin_ip.append(mac)
+                continue
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            raise PeticionInvalida(f"IP inválida para {mac}: {ip!r}") from None
+        lote.append((str(entrada.get("usuario") or USUARIO_PREAUTORIZADO), ip, mac))
+
+    creadas = sessions.crear_sesiones_lote(lote, ttl=ttl)
+    return {"ok": True, "creadas": len(creadas), "sin_ip": sin_ip}
+
+
+def _atender_peticion(conn: socket.socket, peticion: dict) -> None:
+    op = peticion.get("op")
+    inicio = time.perf_counter()
+    if op == "listar":
+        _listar(conn, peticion)
+        return
+    if op == "revocar":
+        n = sessions.eliminar_sesiones(construir_filtro(peticion, exigir=True), motivo="admin")
+        respuesta = {"ok": True, "revocadas": n}
+    elif op == "extender":
+        segundos = peticion.get("segundos")
+        if not isinstance(segundos, (int, float)) or isinstance(segundos, bool):
+            raise PeticionInvalida('"segundos" debe ser un número')
+        n = sessions.extender_sesiones(
+            construir_filtro(peticion, exigir=True), segundos, desde_ahora=peticion.get("desde_ahora") is True
+        )
+        respuesta = {"ok": True, "extendidas": n}
+    elif op == "importar":
+        respuesta = _importar(peticion)
+    else:
+        raise PeticionInvalida(f"operación desconocida: {op!r}")
+    respuesta["segundos"] = round(time.perf_counter() - inicio, 3)
+    # Sin la lista de MACs pendientes, que en una importación grande puede ser larga
+    logging.info("[ADMIN] %s: %s", op, {k: len(v) if isinstance(v, list) else v for k, v in respuesta.items()})
+    conn.sendall(_json(respuesta))
+
+
+def _lineas(conn: socket.socket) -> Iterator[bytes]:
+    pendiente = b""
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return
+        pendiente += chunk
+        *lineas, pendiente = pendiente.split(b"\n")
+        yield from (linea for linea in lineas if linea.strip())
+        if len(pendiente) > MAX_PETICION:
+            raise PeticionInvalida("petición demasiado grande")
+
+
+def _autorizado(conn: socket.socket) -> bool:
+    """Solo root o el mismo usuario que ejecuta el portal."""
+    try:
+        _pid, uid, _gid = _CREDENCIALES.unpack(
+            conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _CREDENCIALES.size)
+        )
+    except (OSError, AttributeError):
+        return False
+    return uid in (0, os.getuid())
+
+
+def _servir(conn: socket.socket) -> None:
+    with conn:
+        if not _autorizado(conn):
+            _metricas["rechazadas"] += 1
+            logging.warning("[ADMIN] Conexión rechazada: el cliente no es root ni el usuario del portal")
+            return
+        _metricas["conexiones"] += 1
+        try:
+            for linea in _lineas(conn):
+                try:
+                    peticion = json.loads(linea)
+                    if not isinstance(peticion, dict):
+                        raise PeticionInvalida("se esperaba un objeto JSON")
+                    _metricas["operaciones"] += 1
+                    _atender_peticion(conn, peticion)
+                except (ValueError, PeticionInvalida) as exc:
+                    _metricas["errores"] += 1
+                    conn.sendall(_json({"ok": False, "error": str(exc)}))
+        except PeticionInvalida as exc:
+            conn.sendall(_json({"ok": False, "error": str(exc)}))
+        except OSError as exc:
+            logging.debug("[ADMIN] Conexión terminada: %s", exc)
+
+
+def _escuchar(servidor: socket.socket, stop_event: threading.Event, inodo: tuple) -> None:
+    with servidor:
+        while not stop_event.is_set():
+            try:
+                conn, _addr = servidor.accept()
+            except socket.timeout:
+                continue
+            except OSError as exc:
+                logging.error("[ADMIN] Error aceptando conexión: %s", exc)
+                stop_event.wait(1.0)
+                continue
+            conn.settimeout(None)
+            threading.Thread(target=_servir, args=(conn,), daemon=True, name="admin-socket-cliente").start()
+    # Tras una recarga la ruta ya es del socket de la instancia nueva: solo se
+    # borra si sigue apuntando al que se abrió aquí
+    try:
+        info = os.stat(SOCKET_PATH)
+        if (info.st_dev, info.st_ino) == inodo:
+            os.unlink(SOCKET_PATH)
+    except OSError:
+        pass
+
+
+def obtener_metricas() -> Dict[str, int]:
+    """Copia de los contadores del socket de administración."""
+    return dict(_metricas)
+
+
+def iniciar(stop_event: threading.Event) -> bool:
+    """Abre el socket de administración si PORTAL_ADMIN_SOCKET está definido."""
+    if not SOCKET_PATH:
+        return False
+    servidor = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Un socket huérfano de una ejecución anterior (o de la instancia que
+        # se está recargando, que ya dejó de aceptar) se sustituye
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+        os.makedirs(os.path.dirname(SOCKET_PATH) or ".", exist_ok=True)
+        mascara = os.umask(0o177)
+        try:
+            servidor.bind(SOCKET_PATH)
+        finally:
+            os.umask(mascara)
+        os.chmod(SOCKET_PATH, 0o600)
+        info = os.stat(SOCKET_PATH)
+        servidor.listen(8)
+    except OSError as exc:
+        servidor.close()
+        logging.error("[ADMIN] No se pudo abrir el socket de administración %s: %s", SOCKET_PATH, exc)
+        return False
+    servidor.settimeout(1.0)
+    threading.Thread(target=_escuchar, args=(servidor, stop_event, (info.st_dev, info.st_ino)), daemon=True, name="admin-socket").start()
+    logging.info("[ADMIN] Socket de administración en %s", SOCKET_PATH)
+    return True
+
+
+# -- cliente --------------------------------------------------------------------
+
+
+def enviar(peticion: dict, ruta: str = SOCKET_PATH) -> Iterator[dict]:
+    """Envía una petición al portal y devuelve sus respuestas (el listado, línea a línea)."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(ruta)
+        conn.sendall(_json(peticion))
+        for linea in _lineas(conn):
+            respuesta = json.loads(linea)
+            yield respuesta
+            if "ok" in respuesta:
+                return
+
+
+def _leer_entradas(archivo: str) -> List[dict]:
+    """Archivo de MACs preautorizadas: `mac [ip] [usuario]` por línea; # comenta."""
+    entradas = []
+    with open(archivo, "r", encoding="utf-8") as f:
+        for linea in f:
+            campos = linea.split("#", 1)[0].split()
+            if not campos:
+                continue
+            entrada = {"mac": campos[0]}
+            if len(campos) > 1 and campos[1] != "-":
+                entrada["ip"] = campos[1]
+            if len(campos) > 2:
+                entrada["usuario"] = campos[2]
+            entradas.append(entrada)
+    return entradas
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Administración del portal en marcha (PORTAL_ADMIN_SOCKET)")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="ruta del socket (por defecto PORTAL_ADMIN_SOCKET)")
+    sub = parser.add_subparsers(dest="op", required=True)
+    for nombre in ("listar", "revocar", "extender"):
+        p = sub.add_parser(nombre)
+        p.add_argument("--usuario")
+        p.add_argument("--subred")
+        p.add_argument("--ip")
+        p.add_argument("--mac")
+        if nombre != "listar":
+            p.add_argument("--todas", action="store_true")
+        if nombre == "extender":
+            p.add_argument("--segundos", type=int, required=True)
+            p.add_argument("--desde-ahora", action="store_true", help="expirar en ahora + segundos")
+    p = sub.add_parser("importar", help="archivo con `mac [ip|-] [usuario]` por línea")
+    p.add_argument("archivo")
+    p.add_argument("--ttl", type=int)
+    args = parser.parse_args()
+
+    if not args.socket:
+        parser.error("indica --socket o define PORTAL_ADMIN_SOCKET")
+    if args.op == "importar":
+        peticion: dict = {"op": "importar", "entradas": _leer_entradas(args.archivo)}
+        if args.ttl is not None:
+            peticion["ttl"] = args.ttl
+    else:
+        peticion = {"op": args.op}
+        for campo in ("usuario", "subred", "ip", "mac"):
+            if getattr(args, campo):
+                peticion[campo] = getattr(args, campo)
+        if getattr(args, "todas", False):
+            peticion["todas"] = True
+        if args.op == "extender":
+            peticion["segundos"] = args.segundos
+            if args.desde_ahora:
+                peticion["desde_ahora"] = True
+
+    try:
+        for respuesta in enviar(peticion, args.socket):
+            if "ok" not in respuesta:
+                print(json.dumps(respuesta, ensure_ascii=False))
+            elif respuesta["ok"]:
+                print(json.dumps(respuesta, ensure_ascii=False), file=sys.stderr)
+            else:
+                print(f"Error: {respuesta.get('error')}", file=sys.stderr)
+                raise SystemExit(1)
+    except OSError as exc:
+        print(f"No se pudo conectar con {args.socket}: {exc}", file=sys.stderr)
+        raise SystemExit(2)
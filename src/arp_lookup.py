@@ -2,8 +2,10 @@
 """
 arp_lookup.py
 
-Funciones para obtener la MAC asociada a una IP desde el gateway (tabla ARP).
+Funciones para obtener la MAC asociada a una IP desde el gateway.
 Intentos:
+ - concesiones del servidor DHCP local (dhcp_leases, si PORTAL_DHCP_LEASES)
+ - mapa vivo de neighbor_monitor (rtnetlink, sin llamadas al sistema)
  - ip neigh show <IP>
  - /proc/net/arp
 Devuelve la MAC en minúsculas o None si no se encuentra.
@@ -13,7 +15,10 @@ from __future__ import annotations
 import subprocess
 import logging
 import re
-from typing import Optional
+from typing import Dict, Optional
+
+import dhcp_leases
+import neighbor_monitor
 
 _IP_NEIGH_CMD = ["ip", "neigh", "show"]
 
@@ -41,11 +46,44 @@ def _parse_proc_arp(ip: str) -> Optional[str]:
                 return mac.lower()
     return None
 
+def tabla_vecinos() -> Dict[str, str]:
+    """
+    Tabla completa IP -> MAC (minúsculas): el mapa vivo de neighbor_monitor si
+    está activo, si no /proc/net/arp; las concesiones DHCP vigentes tienen
+    prioridad, como en get_mac.
+    """
+    if neighbor_monitor.activo():
+        tabla = neighbor_monitor.obtener_tabla()
+    else:
+        tabla = {}
+        try:
+            with open("/proc/net/arp", "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()[1:]
+        except OSError:
+            lines = []
+        for ln in lines:
+            parts = ln.split()
+            if len(parts) >= 4 and MAC_RE.match(parts[3]) and parts[3] != "00:00:00:00:00:00":
+                tabla[parts[0]] = parts[3].lower()
+    tabla.update(dhcp_leases.tabla())
+    return tabla
+
 def get_mac(ip: str) -> Optional[str]:
     """
-    Devuelve la MAC asociada a `ip` consultando la tabla ARP.
-    Si no la encuentra devuelve None.
+    Devuelve la MAC asociada a `ip` consultando las concesiones DHCP y,
+    si no hay una vigente, la tabla ARP. Si no la encuentra devuelve None.
     """
+    mac = dhcp_leases.obtener_mac(ip)
+    if mac:
+        return mac
+
+    if neighbor_monitor.activo():
+        mac = neighbor_monitor.obtener_mac(ip)
+        if mac:
+            return mac
+        # Vecino aún no notificado: /proc/net/arp sin lanzar procesos
+        return _parse_proc_arp(ip)
+
     try:
         # Primero ip neigh (rápido, moderno)
         proc = subprocess.run(_IP_NEIGH_CMD + [ip], capture_output=True, text=True, check=False)
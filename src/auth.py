@@ -5,6 +5,11 @@ Módulo de autenticación del portal cautivo.
 - Define el formato del archivo de usuarios (config/usuarios.txt).
 - Carga usuarios/contraseñas en memoria.
 - Proporciona una función para validar credenciales.
+- Backends intercambiables (PORTAL_AUTH_BACKEND): "file" (usuarios.txt, por
+  defecto) o "http" (servicio de autenticación central). El backend de red
+  usa un pool acotado de conexiones persistentes con timeout por petición y
+  va detrás de una caché con TTL de resultados positivos y negativos,
+  indexada por un hash con sal de las credenciales (nunca en claro).
 
 Formato del archivo config/usuarios.txt:
 
@@ -18,9 +23,19 @@ Formato del archivo config/usuarios.txt:
 
 from __future__ import annotations
 
+import hashlib
+import http.client
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
 
 
 # Rutas base: repo_root/config/usuarios.txt
@@ -30,10 +45,27 @@ CONFIG_DIR = REPO_ROOT / "config"
 DEFAULT_USERS_FILE = CONFIG_DIR / "usuarios.txt"
 
 
+# Backend de autenticación: file (usuarios.txt) o http (servicio central)
+AUTH_BACKEND = os.getenv("PORTAL_AUTH_BACKEND", "file").strip().lower()
+# Servicio HTTP: POST JSON {"username", "password"}; 200 = válido, 401/403 = inválido
+AUTH_URL = os.getenv("PORTAL_AUTH_URL", "")
+AUTH_TOKEN = os.getenv("PORTAL_AUTH_TOKEN", "")        # cabecera Authorization: Bearer opcional
+AUTH_TIMEOUT = float(os.getenv("PORTAL_AUTH_TIMEOUT", "3"))
+AUTH_POOL_SIZE = int(os.getenv("PORTAL_AUTH_POOL_SIZE", "4"))
+# Caché de resultados (segundos; 0 = sin caché) y número máximo de entradas
+AUTH_CACHE_TTL = float(os.getenv("PORTAL_AUTH_CACHE_TTL", "300"))
+AUTH_NEGATIVE_TTL = float(os.getenv("PORTAL_AUTH_NEGATIVE_TTL", "30"))
+AUTH_CACHE_SIZE = int(os.getenv("PORTAL_AUTH_CACHE_SIZE", "10000"))
+
+
 class UserLoadError(Exception):
     """Error al cargar el archivo de usuarios."""
 
 
+class AuthBackendError(Exception):
+    """El backend no pudo dar una respuesta (red, timeout, respuesta inesperada)."""
+
+
 UsersDict = Dict[str, str]
 
 
@@ -102,12 +134,300 @@ def authenticate(username: str, password: str, users: UsersDict) -> bool:
     return stored is not None and stored == password
 
 
+class AuthBackend:
+    """Interfaz de los backends: autenticar() devuelve True/False o lanza AuthBackendError."""
+
+    nombre = "base"
+
+    def autenticar(self, username: str, password: str) -> bool:
+        raise NotImplementedError
+
+    def metricas(self) -> Dict[str, int]:
+        return {}
+
+
+class FileBackend(AuthBackend):
+    """Usuarios en memoria cargados desde usuarios.txt."""
+
+    nombre = "file"
+
+    def __init__(self, users: UsersDict) -> None:
+        self.users = users
+
+    def autenticar(self, username: str, password: str) -> bool:
+        return authenticate(username, password, self.users)
+
+
+class _PoolConexiones:
+    """
+    Pool acotado de conexiones persistentes: como mucho `tamano` en uso a la
+    vez; quien llega con el pool agotado espera hasta `espera` segundos en
+    lugar de abrir otra conexión.
+    """
+
+    def __init__(self, fabrica: Callable[[], http.client.HTTPConnection], tamano: int, espera: float) -> None:
+        self._fabrica = fabrica
+        self._espera = espera
+        self._cupo = threading.BoundedSemaphore(max(1, tamano))
+        self._libres: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue()
+        self.abiertas = 0
+
+    @contextmanager
+    def conexion(self) -> Iterator[Tuple[http.client.HTTPConnection, bool]]:
+        """Presta (conexión, reutilizada). Si el bloque falla, la conexión se descarta."""
+        if not self._cupo.acquire(timeout=self._espera):
+            raise AuthBackendError("pool de conexiones agotado")
+        try:
+            try:
+                conn, reutilizada = self._libres.get_nowait(), True
+            except queue.Empty:
+                conn, reutilizada = self._fabrica(), False
+                self.abiertas += 1
+            try:
+                yield conn, reutilizada
+            except BaseException:
+                conn.close()
+                raise
+            self._libres.put(conn)
+        finally:
+            self._cupo.release()
+
+    def cerrar(self) -> None:
+        while True:
+            try:
+                self._libres.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HTTPBackend(AuthBackend):
+    """
+    Servicio HTTP(S) de autenticación. Cada intento es un POST JSON sobre una
+    conexión del pool (keep-alive), con timeout por petición.
+    """
+
+    nombre = "http"
+
+    def __init__(self, url: str, token: str = "", timeout: float = AUTH_TIMEOUT, pool: int = AUTH_POOL_SIZE) -> None:
+        partes = urlsplit(url)
+        if partes.scheme not in {"http", "https"} or not partes.hostname:
+            raise ValueError(f"URL de autenticación inválida: {url!r}")
+        self._https = partes.scheme == "https"
+        self._host = partes.hostname
+        self._puerto = partes.port
+        self._ruta = partes.path or "/"
+        if partes.query:
+            self._ruta += "?" + partes.query
+        self._timeout = timeout
+        self._cabeceras = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        if token:
+            self._cabeceras["Authorization"] = f"Bearer {token}"
+        self._pool = _PoolConexiones(self._nueva_conexion, pool, timeout)
+        self._peticiones = 0
+
+    def _nueva_conexion(self) -> http.client.HTTPConnection:
+        clase = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+        return clase(self._host, self._puerto, timeout=self._timeout)
+
+    def _post(self, conn: http.client.HTTPConnection, cuerpo: bytes) -> int:
+        conn.request("POST", self._ruta, body=cuerpo, headers=self._cabeceras)
+        resp = conn.getresponse()
+        resp.read()  # vaciar el cuerpo para poder reutilizar la conexión
+        if resp.will_close:
+            conn.close()  # http.client la reabre en la siguiente petición
+        return resp.status
+
+    def autenticar(self, username: str, password: str) -> bool:
+        cuerpo = json.dumps({"username": username, "password": password}).encode("utf-8")
+        self._peticiones += 1
+        for intento in range(2):
+            try:
+                with self._pool.conexion() as (conn, reutilizada):
+                    try:
+                        estado = self._post(conn, cuerpo)
+                    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                        # Conexión persistente cerrada por el servidor: se reintenta una vez con otra
+                        if reutilizada and intento == 0:
+                            raise _Reintentar from None
+                        raise
+                break
+            except _Reintentar:
+                continue
+            except (OSError, http.client.HTTPException) as exc:
+                raise AuthBackendError(f"servicio de autenticación no disponible: {exc}") from exc
+        if estado == 200:
+            return True
+        if estado in (401, 403):
+            return False
+        raise AuthBackendError(f"respuesta inesperada del servicio de autenticación: HTTP {estado}")
+
+    def metricas(self) -> Dict[str, int]:
+        return {"peticiones": self._peticiones, "conexiones_abiertas": self._pool.abiertas}
+
+
+class _Reintentar(Exception):
+    pass
+
+
+class CachedBackend(AuthBackend):
+    """
+    Caché LRU con TTL delante de otro backend. La clave es un BLAKE2b con una
+    sal aleatoria del proceso sobre usuario y contraseña. Los errores del
+    backend no se cachean. Intentos simultáneos con las mismas credenciales
+    esperan al primero en lugar de consultar todos.
+    """
+
+    def __init__(
+        self,
+        backend: AuthBackend,
+        ttl: float = AUTH_CACHE_TTL,
+        ttl_negativo: float = AUTH_NEGATIVE_TTL,
+        tamano: int = AUTH_CACHE_SIZE,
+    ) -> None:
+        self.backend = backend
+        self.nombre = f"{backend.nombre}+cache"
+        self._ttl = ttl
+        self._ttl_negativo = ttl_negativo
+        self._tamano = max(1, tamano)
+        self._sal = os.urandom(16)
+        self._lock = threading.Lock()
+        self._entradas: "OrderedDict[bytes, Tuple[float, bool]]" = OrderedDict()
+        self._en_curso: Dict[bytes, threading.Lock] = {}
+        self._aciertos = 0
+        self._fallos = 0
+
+    def _clave(self, username: str, password: str) -> bytes:
+        datos = username.encode("utf-8") + b"\0" + password.encode("utf-8")
+        return hashlib.blake2b(datos, key=self._sal, digest_size=32).digest()
+
+    def _buscar(self, clave: bytes, now: float) -> Optional[bool]:
+        """Resultado vigente en caché, o None. Llamar con _lock tomado."""
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        caduca, valido = entrada
+        if caduca <= now:
+            del self._entradas[clave]
+            return None
+        self._entradas.move_to_end(clave)
+        return valido
+
+    def autenticar(self, username: str, password: str) -> bool:
+        clave = self._clave(username, password)
+        with self._lock:
+            valido = self._buscar(clave, time.monotonic())
+            if valido is not None:
+                self._aciertos += 1
+                return valido
+            turno = self._en_curso.setdefault(clave, threading.Lock())
+
+        with turno:
+            with self._lock:
+                # Otro hilo pudo resolverlo mientras esperábamos el turno
+                valido = self._buscar(clave, time.monotonic())
+                if valido is not None:
+                    self._aciertos += 1
+                    return valido
+                self._fallos += 1
+            try:
+                valido = self.backend.autenticar(username, password)
+            finally:
+                with self._lock:
+                    self._en_curso.pop(clave, None)
+            ttl = self._ttl if valido else self._ttl_negativo
+            if ttl > 0:
+                with self._lock:
+                    self._entradas[clave] = (time.monotonic() + ttl, valido)
+                    self._entradas.move_to_end(clave)
+                    while len(self._entradas) > self._tamano:
+                        self._entradas.popitem(last=False)
+            return valido
+
+    def invalidar(self) -> None:
+        """Vacía la caché (p. ej. tras cambiar contraseñas en el directorio)."""
+        with self._lock:
+            self._entradas.clear()
+
+    def metricas(self) -> Dict[str, int]:
+        with self._lock:
+            metricas = {"cache_aciertos": self._aciertos, "cache_fallos": self._fallos, "cache_entradas": len(self._entradas)}
+        metricas.update(self.backend.metricas())
+        return metricas
+
+
+def crear_backend(users: Optional[UsersDict] = None) -> AuthBackend:
+    """
+    Construye el backend configurado en PORTAL_AUTH_BACKEND. Los backends de
+    red van detrás de CachedBackend salvo con PORTAL_AUTH_CACHE_TTL=0.
+    """
+    if AUTH_BACKEND == "http":
+        if not AUTH_URL:
+            raise ValueError("PORTAL_AUTH_BACKEND=http requiere PORTAL_AUTH_URL")
+        backend: AuthBackend = HTTPBackend(AUTH_URL, AUTH_TOKEN)
+        if AUTH_CACHE_TTL > 0:
+            backend = CachedBackend(backend)
+        logging.info("Autenticación contra %s (pool %d, timeout %.1fs)", AUTH_URL, AUTH_POOL_SIZE, AUTH_TIMEOUT)
+        return backend
+    if AUTH_BACKEND != "file":
+        logging.error("PORTAL_AUTH_BACKEND desconocido (%s); usando usuarios.txt", AUTH_BACKEND)
+    return FileBackend(users if users is not None else {})
+
+
+def _demo_http() -> None:
+    """
+    Servicio de autenticación de prueba en localhost + tormenta de logins:
+    muestra que las conexiones abiertas no pasan del tamaño del pool y que
+    los reintentos salen de la caché.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    conexiones = []
+
+    class _Servicio(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def setup(self) -> None:
+            super().setup()
+            conexiones.append(self.client_address)
+
+        def do_POST(self) -> None:
+            datos = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(0.01)  # latencia del directorio
+            valido = datos["password"] == "clave-" + datos["username"]
+            self.send_response(200 if valido else 401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args) -> None:
+            pass
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), _Servicio)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    backend = CachedBackend(HTTPBackend(f"http://127.0.0.1:{servidor.server_port}/auth", pool=4))
+
+    intentos = [(f"u{i % 50}", f"clave-u{i % 50}" if i % 7 else "mala") for i in range(1000)]
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        resultados = list(executor.map(lambda c: backend.autenticar(*c), intentos))
+    duracion = time.perf_counter() - inicio
+    print(f"{len(intentos)} logins en {duracion:.2f}s, válidos: {sum(resultados)}")
+    print(f"conexiones TCP al servicio: {len(conexiones)}; métricas: {backend.metricas()}")
+    servidor.shutdown()
+
+
 if __name__ == "__main__":
     # Pequeña prueba manual: python3 src/auth.py
+    # Backend HTTP contra un servicio local de prueba: python3 src/auth.py --demo-http
+    import sys
+
     logging.basicConfig(
         level=logging.INFO,
         format="%(levelname)s: %(message)s",
     )
+    if "--demo-http" in sys.argv:
+        _demo_http()
+        raise SystemExit(0)
 
     try:
         usuarios = load_users()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+captive_dns.py
+
+Servidor DNS cautivo opcional (asyncio, UDP y TCP) integrado en el portal.
+
+- Las consultas de IPs sin sesión se responden en el propio gateway: tipo A
+  con la dirección del portal (PORTAL_DNS_PORTAL_IP) y respuesta vacía
+  (NOERROR sin registros) para el resto de tipos, así los clientes no
+  consumen el resolvedor de la WAN y sus navegadores acaban en el portal.
+- Las IPs con sesión se reenvían al resolvedor PORTAL_DNS_UPSTREAM. El
+  firewall redirige aquí todo el puerto 53 de la LAN (también el de los
+  autenticados), así que sin resolvedor reciben REFUSED.
+
+La comprobación de sesión es una consulta al índice por IP de sessions, sin
+lock. Las respuestas cautivas se arman con un registro A precalculado y se
+guardan en una caché LRU pequeña por pregunta; las respuestas del resolvedor
+también, durante el menor TTL de sus registros (como mucho PORTAL_DNS_CACHE_TTL).
+Cada consulta reenviada por UDP sale de un socket nuevo (puerto de origen
+efímero) con un ID de `secrets`, y solo se acepta y cachea una respuesta con
+ese ID y la misma sección de pregunta (contra envenenamiento de la caché).
+
+Se habilita con PORTAL_DNS_LISTEN=host:puerto (vacío = deshabilitado). Para
+que las consultas de la LAN lleguen aquí, firewall_init.sh redirige el puerto
+53 con PORTAL_DNS_PORT.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import secrets
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+import sessions
+
+LISTEN_ADDRESS = os.getenv("PORTAL_DNS_LISTEN", "").strip()
+PORTAL_IP = os.getenv("PORTAL_DNS_PORTAL_IP", "").strip()
+UPSTREAM = os.getenv("PORTAL_DNS_UPSTREAM", "").strip()
+UPSTREAM_TIMEOUT = float(os.getenv("PORTAL_DNS_UPSTREAM_TIMEOUT", "2"))
+# TTL de las respuestas cautivas: corto para que tras el login se resuelva de verdad
+CAPTIVE_TTL = int(os.getenv("PORTAL_DNS_TTL", "1"))
+CACHE_SIZE = int(os.getenv("PORTAL_DNS_CACHE_SIZE", "512"))
+CACHE_MAX_TTL = float(os.getenv("PORTAL_DNS_CACHE_TTL", "30"))
+TCP_TIMEOUT = float(os.getenv("PORTAL_DNS_TCP_TIMEOUT", "5"))
+
+RESOLV_CONF = "/etc/resolv.conf"
+
+QTYPE_A = 1
+QTYPE_OPT = 41
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+_metricas: Dict[str, int] = {
+    "cautivas": 0,
+    "reenviadas": 0,
+    "rechazadas": 0,
+    "cache_aciertos": 0,
+    "errores_upstream": 0,
+    "malformadas": 0,
+    "descartadas_upstream": 0,
+}
+
+
+class _CacheLRU:
+    """Caché LRU acotada: pregunta (bytes) -> (caduca_en, respuesta sin ID)."""
+
+    def __init__(self, capacidad: int) -> None:
+        self._capacidad = max(0, capacidad)
+        self._datos: "OrderedDict[bytes, Tuple[float, bytes]]" = OrderedDict()
+
+    def obtener(self, clave: bytes, now: float) -> Optional[bytes]:
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        caduca, valor = entrada
+        if caduca <= now:
+            del self._datos[clave]
+            return None
+        self._datos.move_to_end(clave)
+        return valor
+
+    def guardar(self, clave: bytes, valor: bytes, caduca: float) -> None:
+        if self._capacidad == 0:
+            return
+        self._datos[clave] = (caduca, valor)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self._capacidad:
+            self._datos.popitem(last=False)
+
+
+def _parse_direccion(texto: str, puerto_defecto: int = 53) -> Tuple[str, int]:
+    host, sep, puerto = texto.rpartition(":")
+    if not sep:
+        return texto, puerto_defecto
+    return host or "0.0.0.0", int(puerto)
+
+
+def _upstream_resolv_conf() -> Optional[Tuple[str, int]]:
+    """Primer nameserver IPv4 de /etc/resolv.conf (si no se definió PORTAL_DNS_UPSTREAM)."""
+    try:
+        with open(RESOLV_CONF, "r", encoding="utf-8") as f:
+            for linea in f:
+                partes = linea.split()
+                if len(partes) >= 2 and partes[0] == "nameserver" and ":" not in partes[1]:
+                    return partes[1], 53
+    except OSError:
+        pass
+    return None
+
+
+def _pregunta(mensaje: bytes) -> Optional[Tuple[int, bytes, int]]:
+    """
+    Valida una consulta y devuelve (flags, sección de pregunta, qtype), o None
+    si está mal formada. Solo se aceptan consultas con una única pregunta.
+    """
+    if len(mensaje) < 12:
+        return None
+    flags, qdcount = struct.unpack_from("!HH", mensaje, 2)
+    if flags & 0x8000 or qdcount != 1:
+        return None
+    pos = 12
+    while True:
+        if pos >= len(mensaje):
+            return None
+        longitud = mensaje[pos]
+        if longitud == 0:
+            pos += 1
+            break
+        if longitud & 0xC0:
+            return None  # sin compresión en preguntas
+        pos += 1 + longitud
+    if pos + 4 > len(mensaje):
+        return None
+    qtype = struct.unpack_from("!H", mensaje, pos)[0]
+    return flags, mensaje[12:pos + 4], qtype
+
+
+def _coincide(respuesta: bytes, ident: bytes, pregunta: bytes) -> bool:
+    """True si `respuesta` contesta a la consulta: mismo ID, bit QR y la misma pregunta."""
+    if len(respuesta) < 12 + len(pregunta) or respuesta[:2] != ident:
+        return False
+    flags, qdcount = struct.unpack_from("!HH", respuesta, 2)
+    return bool(flags & 0x8000) and qdcount == 1 and respuesta[12:12 + len(pregunta)] == pregunta
+
+
+def _saltar_nombre(mensaje: bytes, pos: int) -> int:
+    while True:
+        longitud = mensaje[pos]
+        if longitud & 0xC0 == 0xC0:
+            return pos + 2
+        if longitud == 0:
+            return pos + 1
+        pos += 1 + longitud
+
+
+def _ttl_minimo(respuesta: bytes) -> Optional[int]:
+    """Menor TTL de los registros de una respuesta NOERROR con datos (None = no cachear)."""
+    try:
+        flags, qd, an, ns, ar = struct.unpack_from("!HHHHH", respuesta, 2)
+        if flags & 0x020F or an == 0:  # truncada o rcode != 0
+            return None
+        pos = 12
+        for _ in range(qd):
+            pos = _saltar_nombre(respuesta, pos) + 4
+        minimo = None
+        for _ in range(an + ns + ar):
+            pos = _saltar_nombre(respuesta, pos)
+            tipo, _clase, ttl, rdlen = struct.unpack_from("!HHIH", respuesta, pos)
+            pos += 10 + rdlen
+            if tipo != QTYPE_OPT:
+                minimo = ttl if minimo is None else min(minimo, ttl)
+        return minimo
+    except (IndexError, struct.error):
+        return None
+
+
+def _error(ident: bytes, flags: int, pregunta: bytes, rcode: int) -> bytes:
+    """Respuesta sin registros con el código indicado (eco de la pregunta)."""
+    flags_resp = 0x8000 | (flags & 0x7900) | 0x0080 | rcode
+    qd = 1 if pregunta else 0
+    return ident + struct.pack("!HHHHH", flags_resp, qd, 0, 0, 0) + pregunta
+
+
+class CaptiveResolver:
+    """
+    Decide y construye la respuesta de cada consulta. Independiente del
+    transporte: lo usan el servidor UDP y el TCP.
+    """
+
+    def __init__(
+        self,
+        portal_ip: str,
+        autenticada: Callable[[str], bool],
+        upstream: Optional[Tuple[str, int]],
+    ) -> None:
+        self._autenticada = autenticada
+        self._upstream = upstream
+        # Registro A precalculado: puntero a la pregunta, tipo A, clase IN, TTL, IP
+        self._registro_a = struct.pack("!HHHIH", 0xC00C, QTYPE_A, 1, CAPTIVE_TTL, 4) + socket.inet_aton(portal_ip)
+        self._cautivas = _CacheLRU(CACHE_SIZE)
+        self._reenviadas = _CacheLRU(CACHE_SIZE)
+
+    def _cautiva(self, flags: int, pregunta: bytes, qtype: int) -> bytes:
+        """Cuerpo (sin ID) de la respuesta cautiva para la pregunta; cacheado por pregunta."""
+        clave = bytes([flags >> 8 & 0x01]) + pregunta  # el bit RD se copia
+        cuerpo = self._cautivas.obtener(clave, 0.0)
+        if cuerpo is None:
+            flags_resp = 0x8000 | 0x0400 | (flags & 0x0100) | 0x0080  # QR AA RD RA
+            if qtype == QTYPE_A:
+                cuerpo = struct.pack("!HHHHH", flags_resp, 1, 1, 0, 0) + pregunta + self._registro_a
+            else:
+                cuerpo = struct.pack("!HHHHH", flags_resp, 1, 0, 0, 0) + pregunta
+            self._cautivas.guardar(clave, cuerpo, float("inf"))
+        return cuerpo
+
+    async def responder(self, mensaje: bytes, ip: str, tcp: bool = False) -> Optional[bytes]:
+        """Respuesta completa para la consulta de `ip`, o None si no hay que contestar."""
+        datos = _pregunta(mensaje)
+        if datos is None:
+            _metricas["malformadas"] += 1
+            if len(mensaje) >= 4 and not mensaje[2] & 0x80:
+                return _error(mensaje[:2], struct.unpack_from("!H", mensaje, 2)[0], b"", RCODE_FORMERR)
+            return None
+        flags, pregunta, qtype = datos
+        ident = mensaje[:2]
+        if (flags >> 11) & 0x0F:
+            return _error(ident, flags, pregunta, RCODE_NOTIMP)
+
+        if not self._autenticada(ip):
+            _metricas["cautivas"] += 1
+            return ident + self._cautiva(flags, pregunta, qtype)
+
+        if self._upstream is None:
+            _metricas["rechazadas"] += 1
+            return _error(ident, flags, pregunta, RCODE_REFUSED)
+
+        now = time.monotonic()
+        cacheada = self._reenviadas.obtener(pregunta, now)
+        if cacheada is not None:
+            _metricas["cache_aciertos"] += 1
+            return ident + cacheada
+
+        _metricas["reenviadas"] += 1
+        try:
+            if tcp:
+                respuesta = await self._consultar_tcp(mensaje, pregunta)
+            else:
+                respuesta = await self._consultar_udp(mensaje, pregunta)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as exc:
+            _metricas["errores_upstream"] += 1
+            logging.debug("[DNS] Resolvedor %s sin respuesta: %s", self._upstream, exc)
+            return _error(ident, flags, pregunta, RCODE_SERVFAIL)
+        if respuesta is None:
+            _metricas["errores_upstream"] += 1
+            return _error(ident, flags, pregunta, RCODE_SERVFAIL)
+
+        ttl = _ttl_minimo(respuesta)
+        if ttl:
+            self._reenviadas.guardar(pregunta, respuesta[2:], now + min(ttl, CACHE_MAX_TTL))
+        return ident + respuesta[2:]
+
+    async def _consultar_udp(self, mensaje: bytes, pregunta: bytes) -> bytes:
+        """
+        Consulta por un socket nuevo (puerto de origen efímero aleatorio) con un
+        ID de `secrets`; se descartan las respuestas que no sean a esta pregunta.
+        """
+        ident = struct.pack("!H", secrets.randbits(16))
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UpstreamUDP(ident, pregunta, futuro), remote_addr=self._upstream
+        )
+        try:
+            transport.sendto(ident + mensaje[2:])
+            return await asyncio.wait_for(futuro, UPSTREAM_TIMEOUT)
+        finally:
+            transport.close()
+
+    async def _consultar_tcp(self, mensaje: bytes, pregunta: bytes) -> Optional[bytes]:
+        """Consulta por TCP; None si la respuesta no corresponde a la pregunta."""
+        ident = struct.pack("!H", secrets.randbits(16))
+
+        async def consulta() -> bytes:
+            reader, writer = await asyncio.open_connection(*self._upstream)
+            try:
+                writer.write(struct.pack("!H", len(mensaje)) + ident + mensaje[2:])
+                await writer.drain()
+                longitud = struct.unpack("!H", await reader.readexactly(2))[0]
+                return await reader.readexactly(longitud)
+            finally:
+                writer.close()
+
+        respuesta = await asyncio.wait_for(consulta(), UPSTREAM_TIMEOUT)
+        if not _coincide(respuesta, ident, pregunta):
+            _metricas["descartadas_upstream"] += 1
+            return None
+        return respuesta
+
+
+class _UpstreamUDP(asyncio.DatagramProtocol):
+    """Socket UDP de una sola consulta al resolvedor (conectado: solo recibe de él)."""
+
+    def __init__(self, ident: bytes, pregunta: bytes, futuro: asyncio.Future) -> None:
+        self._ident = ident
+        self._pregunta = pregunta
+        self._futuro = futuro
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if self._futuro.done():
+            return
+        if not _coincide(data, self._ident, self._pregunta):
+            _metricas["descartadas_upstream"] += 1
+            return
+        self._futuro.set_result(data)
+
+    def error_received(self, exc) -> None:
+        if not self._futuro.done():
+            self._futuro.set_exception(exc)
+
+
+class _ServidorUDP(asyncio.DatagramProtocol):
+    def __init__(self, resolver: CaptiveResolver) -> None:
+        self._resolver = resolver
+        self._transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport) -> None:
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        asyncio.ensure_future(self._atender(data, addr))
+
+    async def _atender(self, data: bytes, addr) -> None:
+        respuesta = await self._resolver.responder(data, addr[0])
+        if respuesta is not None and self._transport is not None:
+            self._transport.sendto(respuesta, addr)
+
+
+async def _atender_tcp(resolver: CaptiveResolver, reader, writer) -> None:
+    ip = writer.get_extra_info("peername")[0]
+    try:
+        while True:
+            cabecera = await asyncio.wait_for(reader.readexactly(2), TCP_TIMEOUT)
+            mensaje = await asyncio.wait_for(reader.readexactly(struct.unpack("!H", cabecera)[0]), TCP_TIMEOUT)
+            respuesta = await resolver.responder(mensaje, ip, tcp=True)
+            if respuesta is None:
+                break
+            writer.write(struct.pack("!H", len(respuesta)) + respuesta)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def servir(
+    host: str,
+    puerto: int,
+    resolver: CaptiveResolver,
+    stop_event: threading.Event,
+    listo: Optional[threading.Event] = None,
+) -> None:
+    """
+    Atiende UDP y TCP en host:puerto hasta que se active stop_event.
+
+    Reintenta el bind mientras el puerto esté ocupado: tras una recarga
+    (SIGHUP) la instancia anterior sigue escuchando hasta que la nueva está
+    lista, y lo libera poco después.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        transport = None
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _ServidorUDP(resolver), local_addr=(host, puerto)
+            )
+            servidor_tcp = await asyncio.start_server(
+                lambda r, w: _atender_tcp(resolver, r, w), host, puerto, reuse_address=True
+            )
+            break
+        except OSError as exc:
+            if transport is not None:
+                transport.close()
+            if stop_event.is_set():
+                return
+            logging.warning("[DNS] No se pudo escuchar en %s:%d (%s); reintentando", host, puerto, exc)
+            await asyncio.sleep(1.0)
+    logging.info("[DNS] DNS cautivo escuchando en %s:%d (UDP/TCP)", host, puerto)
+    if listo is not None:
+        listo.set()
+    try:
+        while not stop_event.is_set():
+            await asyncio.sleep(0.5)
+    finally:
+        transport.close()
+        servidor_tcp.close()
+        await servidor_tcp.wait_closed()
+
+
+def obtener_metricas() -> Dict[str, int]:
+    """Copia de los contadores del DNS cautivo."""
+    return dict(_metricas)
+
+
+def iniciar(
+    stop_event: threading.Event,
+    autenticada: Callable[[str], bool] = sessions.ip_autenticada,
+    listo: Optional[threading.Event] = None,
+) -> bool:
+    """Arranca el DNS cautivo en un hilo propio si PORTAL_DNS_LISTEN está definido."""
+    if not LISTEN_ADDRESS:
+        return False
+    host, puerto = _parse_direccion(LISTEN_ADDRESS)
+    portal_ip = PORTAL_IP or (host if host not in {"0.0.0.0", ""} else "")
+    if not portal_ip:
+        logging.error("[DNS] Define PORTAL_DNS_PORTAL_IP (IP del portal en la LAN); DNS cautivo deshabilitado")
+        return False
+
+    upstream = _parse_direccion(UPSTREAM) if UPSTREAM else _upstream_resolv_conf()
+    if upstream is None:
+        logging.warning("[DNS] Sin resolvedor (PORTAL_DNS_UPSTREAM); las IPs con sesión recibirán REFUSED")
+    resolver = CaptiveResolver(portal_ip, autenticada, upstream)
+
+    def _ejecutar() -> None:
+        try:
+            asyncio.run(servir(host, puerto, resolver, stop_event, listo))
+        except Exception as exc:  # noqa: BLE001
+            logging.error("[DNS] El DNS cautivo se detuvo: %s", exc)
+
+    threading.Thread(target=_ejecutar, daemon=True, name="captive-dns").start()
+    return True
+
+
+if __name__ == "__main__":
+    # Prueba manual en localhost con un resolvedor de prueba:
+    #   python3 src/captive_dns.py
+    # Levanta un "upstream" falso en 127.0.0.1:15353 que responde 203.0.113.7,
+    # el DNS cautivo en 127.0.0.1:5353 (portal 192.168.50.1) y consulta como IP
+    # sin sesión (127.0.0.1) y con sesión (127.0.0.2 se da por autenticada).
+    # También se puede probar con: dig @127.0.0.1 -p 5353 example.com
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    UPSTREAM_TTL = 60
+
+    class _Stub(asyncio.DatagramProtocol):
+        def connection_made(self, transport) -> None:
+            self.transport = transport
+
+        def datagram_received(self, data: bytes, addr) -> None:
+            _flags, pregunta, _qtype = _pregunta(data)
+            resp = data[:2] + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0) + pregunta
+            resp += struct.pack("!HHHIH", 0xC00C, 1, 1, UPSTREAM_TTL, 4) + socket.inet_aton("203.0.113.7")
+            self.transport.sendto(resp, addr)
+
+    def _consulta(nombre: str) -> bytes:
+        qname = b"".join(bytes([len(p)]) + p.encode() for p in nombre.split(".")) + b"\0"
+        return struct.pack("!HHHHHH", random.getrandbits(16), 0x0100, 1, 0, 0, 0) + qname + struct.pack("!HH", 1, 1)
+
+    def _ip_respuesta(resp: bytes) -> str:
+        if struct.unpack_from("!H", resp, 6)[0] == 0:
+            return f"sin registros (rcode {resp[3] & 0x0F})"
+        return socket.inet_ntoa(resp[-4:])
+
+    async def _demo() -> None:
+        loop = asyncio.get_running_loop()
+        stub, _ = await loop.create_datagram_endpoint(_Stub, local_addr=("127.0.0.1", 15353))
+        stop = threading.Event()
+        resolver = CaptiveResolver("192.168.50.1", lambda ip: ip == "127.0.0.2", ("127.0.0.1", 15353))
+        tarea = asyncio.ensure_future(servir("127.0.0.1", 5353, resolver, stop))
+        await asyncio.sleep(0.2)
+        for origen in ("127.0.0.1", "127.0.0.2", "127.0.0.2"):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((origen, 0))
+            sock.setblocking(False)
+            await loop.sock_sendto(sock, _consulta("example.com"), ("127.0.0.1", 5353))
+            resp = await asyncio.wait_for(loop.sock_recv(sock, 512), 2)
+            print(f"{origen} -> example.com = {_ip_respuesta(resp)}")
+            sock.close()
+        reader, writer = await asyncio.open_connection("127.0.0.1", 5353)
+        consulta = _consulta("portal.test")
+        writer.write(struct.pack("!H", len(consulta)) + consulta)
+        longitud = struct.unpack("!H", await reader.readexactly(2))[0]
+        print("TCP 127.0.0.1 -> portal.test =", _ip_respuesta(await reader.readexactly(longitud)))
+        writer.close()
+        print("métricas:", obtener_metricas())
+        stop.set()
+        await tarea
+        stub.close()
+
+    asyncio.run(_demo())
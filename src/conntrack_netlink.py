@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+conntrack_netlink.py
+
+Acceso a la tabla conntrack vía ctnetlink (NETLINK_NETFILTER) con sockets de
+la stdlib, sin lanzar el binario `conntrack` por cada IP.
+
+- borrar_por_origen(ips): una sola lectura (dump) de la tabla y borrado de
+  todas las entradas cuyo origen (tupla original) esté en `ips`, enviando
+  los mensajes de borrado en bloque por el mismo socket.
+- listar_origenes(): IPs origen con entradas activas (señal de actividad).
+
+Requiere CAP_NET_ADMIN y el módulo nf_conntrack_netlink. Ante cualquier
+problema se lanza OSError para que el llamador recurra al binario.
+"""
+
+from __future__ import annotations
+
+import errno
+import socket
+import struct
+from typing import Iterable, Iterator, List, Set
+
+from netlink_util import (
+    NLM_F_ACK,
+    NLM_F_DUMP,
+    NLM_F_REQUEST,
+    NLMSG_DONE,
+    NLMSG_ERROR,
+    check_error,
+    iter_attrs_raw,
+    iter_messages,
+    open_socket,
+    pack_nlmsg,
+    parse_attrs,
+    raise_for_errno,
+)
+
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_CTNETLINK = 1
+IPCTNL_MSG_CT_GET = 1
+IPCTNL_MSG_CT_DELETE = 2
+NFNETLINK_V0 = 0
+
+CTA_TUPLE_ORIG = 1
+CTA_TUPLE_IP = 1
+CTA_IP_V4_SRC = 1
+CTA_ZONE = 18
+
+# Tamaño máximo de cada envío de mensajes de borrado agrupados
+_BATCH_BYTES = 32 * 1024
+_RECV_BYTES = 1 << 17
+
+
+def _nfgenmsg(family: int = socket.AF_INET) -> bytes:
+    """Cabecera nfgenmsg: familia, versión y res_id (big-endian)."""
+    return struct.pack("!BBH", family, NFNETLINK_V0, 0)
+
+
+def _msg_type(command: int) -> int:
+    return (NFNL_SUBSYS_CTNETLINK << 8) | command
+
+
+def _dump(sock: socket.socket) -> Iterator[bytes]:
+    """Pide un volcado de la tabla conntrack IPv4 y devuelve los atributos de cada entrada."""
+    sock.send(pack_nlmsg(_msg_type(IPCTNL_MSG_CT_GET), NLM_F_REQUEST | NLM_F_DUMP, 1, _nfgenmsg()))
+    while True:
+        data = sock.recv(_RECV_BYTES)
+        if not data:
+            return
+        for msg_type, _flags, _seq, payload in iter_messages(data):
+            if msg_type == NLMSG_DONE:
+                return
+            if msg_type == NLMSG_ERROR:
+                raise_for_errno(check_error(payload), "volcado conntrack")
+                continue
+            yield payload[4:]  # saltar nfgenmsg
+
+
+def _origen(tuple_orig: bytes) -> bytes:
+    """IPv4 origen (4 bytes) de un atributo CTA_TUPLE_ORIG, o b'' si no aplica."""
+    ip_block = parse_attrs(tuple_orig).get(CTA_TUPLE_IP)
+    if ip_block is None:
+        return b""
+    return parse_attrs(ip_block).get(CTA_IP_V4_SRC, b"")
+
+
+def _send_and_ack(sock: socket.socket, messages: List[bytes]) -> int:
+    """
+    Envía mensajes con NLM_F_ACK en bloques y espera todas las confirmaciones.
+    Devuelve cuántos se aplicaron (ENOENT, entrada ya desaparecida, no cuenta).
+    """
+    applied = 0
+    idx = 0
+    while idx < len(messages):
+        chunk: List[bytes] = []
+        size = 0
+        while idx < len(messages) and (not chunk or size + len(messages[idx]) <= _BATCH_BYTES):
+            chunk.append(messages[idx])
+            size += len(messages[idx])
+            idx += 1
+        sock.send(b"".join(chunk))
+
+        pending = len(chunk)
+        while pending:
+            data = sock.recv(_RECV_BYTES)
+            if not data:
+                raise OSError(errno.EIO, "socket netlink cerrado esperando ACKs")
+            for msg_type, _flags, _seq, payload in iter_messages(data):
+                if msg_type != NLMSG_ERROR:
+                    continue
+                pending -= 1
+                err = check_error(payload)
+                if err == 0:
+                    applied += 1
+                elif err != errno.ENOENT:
+                    raise_for_errno(err, "borrado conntrack")
+    return applied
+
+
+def borrar_por_origen(ips: Iterable[str]) -> int:
+    """
+    Elimina de conntrack todas las entradas cuyo origen original esté en `ips`.
+    Una sola lectura de la tabla y borrados agrupados en el mismo socket.
+    Devuelve el número de entradas eliminadas. Lanza OSError si netlink no está disponible.
+    """
+    objetivos: Set[bytes] = set()
+    for ip in ips:
+        try:
+            objetivos.add(socket.inet_aton(ip))
+        except OSError:
+            continue
+    if not objetivos:
+        return 0
+
+    with open_socket(NETLINK_NETFILTER) as sock:
+        borrados: List[bytes] = []
+        for attrs in _dump(sock):
+            raw_orig = b""
+            raw_zone = b""
+            src = b""
+            for attr_type, payload, raw in iter_attrs_raw(attrs):
+                if attr_type == CTA_TUPLE_ORIG:
+                    raw_orig = raw
+                    src = _origen(payload)
+                elif attr_type == CTA_ZONE:
+                    raw_zone = raw
+            if raw_orig and src in objetivos:
+                borrados.append(raw_orig + raw_zone)
+
+        messages = [
+            pack_nlmsg(
+                _msg_type(IPCTNL_MSG_CT_DELETE),
+                NLM_F_REQUEST | NLM_F_ACK,
+                seq,
+                _nfgenmsg() + attrs,
+            )
+            for seq, attrs in enumerate(borrados, start=2)
+        ]
+        return _send_and_ack(sock, messages)
+
+
+def listar_origenes() -> Set[str]:
+    """IPs origen (tupla original) con al menos una entrada en conntrack."""
+    origenes: Set[bytes] = set()
+    with open_socket(NETLINK_NETFILTER) as sock:
+        for attrs in _dump(sock):
+            tuple_orig = parse_attrs(attrs).get(CTA_TUPLE_ORIG)
+            if tuple_orig:
+                src = _origen(tuple_orig)
+                if src:
+                    origenes.add(src)
+    return {socket.inet_ntoa(src) for src in origenes}
+
+
+if __name__ == "__main__":
+    # Prueba manual (root): python3 src/conntrack_netlink.py [ip ...]
+    import sys
+
+    if len(sys.argv) > 1:
+        print("Entradas eliminadas:", borrar_por_origen(sys.argv[1:]))
+    else:
+        print("Orígenes con entradas conntrack:", sorted(listar_origenes()))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+dhcp_leases.py
+
+Índice en memoria del archivo de concesiones del servidor DHCP local
+(PORTAL_DHCP_LEASES=/ruta; vacío = deshabilitado) como fuente de identidad
+IP -> MAC / nombre de equipo. A diferencia de la tabla ARP, la concesión no
+caduca a los pocos minutos de inactividad: un teléfono que se duerme entre el
+GET y el POST sigue teniendo su MAC aquí.
+
+Formatos (PORTAL_DHCP_LEASES_FORMAT=auto, dnsmasq o isc):
+- dnsmasq: una línea `expiración mac ip nombre client-id` por concesión
+  (expiración 0 = sin caducidad; las líneas tras `duid` son de DHCPv6 y se
+  ignoran). dnsmasq reescribe el archivo entero en cada cambio.
+- ISC dhcpd: bloques `lease <ip> { ... }` con `ends`, `binding state`,
+  `hardware ethernet` y `client-hostname`. dhcpd añade bloques al final (el
+  último de cada IP manda) y de vez en cuando reescribe el archivo.
+
+Las consultas miran un dict (O(1)). Como mucho cada PORTAL_DHCP_LEASES_CHECK
+segundos se hace un stat() del archivo; solo si cambian mtime, tamaño o
+inodo se vuelve a leer: en formato ISC, si el archivo solo creció, se
+procesan únicamente los bytes nuevos (hasta el último bloque completo); si
+no, y en dnsmasq, se relee entero y el índice se sustituye de una vez.
+
+arp_lookup consulta este índice antes que la tabla ARP (que queda de respaldo).
+"""
+
+from __future__ import annotations
+
+import calendar
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+RUTA = os.getenv("PORTAL_DHCP_LEASES", "").strip()
+FORMATO = os.getenv("PORTAL_DHCP_LEASES_FORMAT", "auto").strip().lower()
+INTERVALO = float(os.getenv("PORTAL_DHCP_LEASES_CHECK", "1.0"))
+
+_MAC_RE = re.compile(r"[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}")
+_COMILLAS_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+# Sentencia hasta el primer # que no esté dentro de comillas
+_SIN_COMENTARIO_RE = re.compile(r'(?:[^"#]|"(?:[^"\\]|\\.)*")*')
+_LEASE_RE = re.compile(r"lease\s+([0-9.]+)\s*\{")
+# Estados ISC en los que la IP ya no pertenece al cliente
+_ESTADOS_LIBRES = {"free", "released", "expired", "abandoned", "reset", "backup"}
+
+
+@dataclass(frozen=True)
+class Concesion:
+    """Concesión DHCP de una IP."""
+
+    mac: str
+    hostname: Optional[str]
+    expira: Optional[float]  # epoch; None = sin caducidad
+
+    def vigente(self, ahora: float) -> bool:
+        return self.expira is None or self.expira > ahora
+
+
+def _utf8(texto: str) -> str:
+    # Los archivos se leen como latin-1 (un carácter por byte, para poder
+    # contar posiciones en bytes); los nombres de equipo vienen en UTF-8
+    return texto.encode("latin-1").decode("utf-8", "replace")
+
+
+def detectar_formato(texto: str) -> Optional[str]:
+    """'dnsmasq' o 'isc' según la primera línea con contenido; None si no hay ninguna."""
+    for linea in texto.splitlines():
+        linea = linea.strip()
+        if not linea:
+            continue
+        primero = linea.split(None, 1)[0]
+        return "dnsmasq" if primero.isdigit() or primero == "duid" else "isc"
+    return None
+
+
+def parse_dnsmasq(texto: str) -> Dict[str, Concesion]:
+    """Concesiones IPv4 de un archivo de dnsmasq."""
+    concesiones: Dict[str, Concesion] = {}
+    for linea in texto.splitlines():
+        campos = linea.split()
+        if len(campos) < 4 or not campos[0].isdigit():
+            # "duid ..." y líneas truncadas; las entradas DHCPv6 llevan IAID en vez de MAC
+            continue
+        expiracion, mac, ip, hostname = campos[:4]
+        if not _MAC_RE.fullmatch(mac) or ":" in ip:
+            continue
+        concesiones[ip] = Concesion(
+            mac.lower(),
+            None if hostname == "*" else _utf8(hostname),
+            float(expiracion) if expiracion != "0" else None,
+        )
+    return concesiones
+
+
+def _fecha_isc(valor: str) -> Optional[float]:
+    """`4 2026/10/15 22:00:00` (UTC), `epoch 1792101600` o `never`."""
+    partes = valor.split()
+    if not partes or partes[0] == "never":
+        return None
+    if partes[0] == "epoch" and len(partes) > 1:
+        return float(partes[1])
+    if len(partes) >= 3:
+        return float(calendar.timegm(time.strptime(f"{partes[1]} {partes[2]}", "%Y/%m/%d %H:%M:%S")))
+    raise ValueError(f"fecha no reconocida: {valor!r}")
+
+
+def parse_isc(texto: str) -> Tuple[Dict[str, Optional[Concesion]], int]:
+    """
+    Bloques `lease` de un fragmento de dhcpd.leases, en orden. Devuelve
+    (ip -> concesión, o None si el bloque la libera) y cuántos caracteres
+    del texto forman sentencias completas; lo que queda es un bloque a
+    medio escribir que se procesará en la siguiente lectura. El texto se
+    espera decodificado como latin-1 (caracteres = bytes).
+    """
+    cambios: Dict[str, Optional[Concesion]] = {}
+    consumido = 0
+    pos = 0
+    profundidad = 0
+    ip: Optional[str] = None
+    campos: Dict[str, str] = {}
+    for linea in texto.splitlines(keepends=True):
+        pos += len(linea)
+        if not linea.endswith("\n"):
+            break  # línea a medio escribir
+        sentencia = _SIN_COMENTARIO_RE.match(linea).group(0).strip()
+        if not sentencia:
+            if profundidad == 0:
+                consumido = pos
+            continue
+        sin_cadenas = _COMILLAS_RE.sub('""', sentencia)
+        if profundidad == 0:
+            m = _LEASE_RE.match(sin_cadenas)
+            ip = m.group(1) if m else None
+            campos = {}
+        elif profundidad == 1 and ip is not None and sin_cadenas.endswith(";"):
+            clave, _, valor = sentencia.rstrip(";").partition(" ")
+            if clave == "hardware":
+                campos["mac"] = valor.split()[-1]
+            elif clave == "binding" and valor.startswith("state "):
+                campos["estado"] = valor.split()[-1]
+            elif clave in ("ends", "client-hostname"):
+                campos[clave] = _utf8(valor.strip().strip('"'))
+            elif clave == "abandoned":
+                campos["estado"] = "abandoned"
+        profundidad += sin_cadenas.count("{") - sin_cadenas.count("}")
+        if profundidad > 0:
+            continue
+        profundidad = 0
+        consumido = pos
+        if ip is None:
+            continue  # sentencia o bloque que no es una concesión (host, failover, ia-na...)
+        mac = campos.get("mac", "")
+        if campos.get("estado", "active") in _ESTADOS_LIBRES or not _MAC_RE.fullmatch(mac):
+            cambios[ip] = None
+        else:
+            try:
+                cambios[ip] = Concesion(
+                    mac.lower(), campos.get("client-hostname") or None, _fecha_isc(campos.get("ends", "never"))
+                )
+            except ValueError as exc:
+                logging.debug("[DHCP] Concesión de %s ignorada: %s", ip, exc)
+                cambios[ip] = None
+        ip = None
+    return cambios, consumido
+
+
+class IndiceConcesiones:
+    """Índice IP -> concesión de un archivo de concesiones, recargado al cambiar."""
+
+    def __init__(self, ruta: str, formato: str = "auto", intervalo: float = INTERVALO) -> None:
+        self.ruta = ruta
+        self.formato = None if formato == "auto" else formato
+        self.intervalo = intervalo
+        self.concesiones: Dict[str, Concesion] = {}
+        self._lock = threading.Lock()
+        self._ultima_comprobacion = float("-inf")
+        self._firma: Optional[Tuple[int, int, int]] = None  # (inodo, tamaño, mtime_ns)
+        self._leido = 0  # bytes ya procesados (formato ISC)
+        self._aviso_ausente = False
+        self.metricas: Dict[str, int] = {"lecturas_completas": 0, "lecturas_incrementales": 0, "errores": 0}
+
+    def _leer(self, desde: int) -> str:
+        with open(self.ruta, "rb") as f:
+            f.seek(desde)
+            return f.read().decode("latin-1")
+
+    def actualizar(self) -> bool:
+        """Relee el archivo si cambió desde la última lectura. Devuelve True si lo releyó."""
+        try:
+            st = os.stat(self.ruta)
+        except OSError as exc:
+            if not self._aviso_ausente:
+                logging.warning("[DHCP] No se puede leer %s: %s", self.ruta, exc)
+                self._aviso_ausente = True
+            self._firma = None
+            return False
+        self._aviso_ausente = False
+        firma = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if firma == self._firma:
+            return False
+
+        try:
+            incremental = (
+                self.formato == "isc"
+                and self._firma is not None
+                and self._firma[0] == st.st_ino
+                and st.st_size >= self._firma[1]
+            )
+            if incremental:
+                texto = self._leer(self._leido)
+                cambios, consumido = parse_isc(texto)
+                for ip, concesion in cambios.items():
+                    if concesion is None:
+                        self.concesiones.pop(ip, None)
+                    else:
+                        self.concesiones[ip] = concesion
+                self._leido += consumido
+                self.metricas["lecturas_incrementales"] += 1
+            else:
+                texto = self._leer(0)
+                if self.formato is None:
+                    self.formato = detectar_formato(texto)
+                if self.formato == "isc":
+                    cambios, consumido = parse_isc(texto)
+                    concesiones = {ip: c for ip, c in cambios.items() if c is not None}
+                    self._leido = consumido
+                else:
+                    concesiones = parse_dnsmasq(texto)
+                # Sustitución de una vez: las consultas concurrentes ven el índice viejo o el nuevo
+                self.concesiones = concesiones
+                self.metricas["lecturas_completas"] += 1
+        except (OSError, ValueError) as exc:
+            self.metricas["errores"] += 1
+            logging.error("[DHCP] Error leyendo %s: %s", self.ruta, exc)
+            return False
+        self._firma = firma
+        logging.debug("[DHCP] %s releído (%s): %d concesiones", self.ruta, self.formato, len(self.concesiones))
+        return True
+
+    def comprobar(self) -> None:
+        """actualizar() como mucho una vez por intervalo; sin esperar si otro hilo ya lo hace."""
+        ahora = time.monotonic()
+        if ahora - self._ultima_comprobacion < self.intervalo or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._ultima_comprobacion = ahora
+            self.actualizar()
+        finally:
+            self._lock.release()
+
+    def obtener(self, ip: str) -> Optional[Concesion]:
+        """Concesión vigente de la IP, o None."""
+        self.comprobar()
+        concesion = self.concesiones.get(ip)
+        if concesion is None or not concesion.vigente(time.time()):
+            return None
+        return concesion
+
+    def tabla(self) -> Dict[str, str]:
+        """IP -> MAC de todas las concesiones vigentes."""
+        self.comprobar()
+        ahora = time.time()
+        return {ip: c.mac for ip, c in list(self.concesiones.items()) if c.vigente(ahora)}
+
+
+_indice: Optional[IndiceConcesiones] = IndiceConcesiones(RUTA, FORMATO) if RUTA else None
+
+
+def activo() -> bool:
+    """True si PORTAL_DHCP_LEASES apunta a un archivo de concesiones."""
+    return _indice is not None
+
+
+def obtener(ip: str) -> Optional[Concesion]:
+    """Concesión vigente de la IP en el archivo del servidor DHCP, o None."""
+    return _indice.obtener(ip) if _indice is not None else None
+
+
+def obtener_mac(ip: str) -> Optional[str]:
+    concesion = obtener(ip)
+    return concesion.mac if concesion else None
+
+
+def obtener_hostname(ip: str) -> Optional[str]:
+    concesion = obtener(ip)
+    return concesion.hostname if concesion else None
+
+
+def tabla() -> Dict[str, str]:
+    """IP -> MAC de las concesiones vigentes (vacío si el índice está deshabilitado)."""
+    return _indice.tabla() if _indice is not None else {}
+
+
+def obtener_metricas() -> Dict[str, int]:
+    """Concesiones indexadas y lecturas del archivo (completas, incrementales, con error)."""
+    if _indice is None:
+        return {}
+    return dict(_indice.metricas, concesiones=len(_indice.concesiones))
+
+
+def _imprimir(concesiones: Iterable[Tuple[str, Concesion]]) -> None:
+    ahora = time.time()
+    for ip, c in concesiones:
+        estado = "vigente" if c.vigente(ahora) else "caducada"
+        expira = "nunca" if c.expira is None else time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(c.expira))
+        print(f"{ip:15s}  {c.mac}  {c.hostname or '-':20s}  {expira}  {estado}")
+
+
+if __name__ == "__main__":
+    # python3 src/dhcp_leases.py /var/lib/misc/dnsmasq.leases [isc|dnsmasq]
+    import sys
+
+    if len(sys.argv) < 2 and not RUTA:
+        print("Uso: dhcp_leases.py <archivo de concesiones> [dnsmasq|isc]")
+        raise SystemExit(2)
+    indice = IndiceConcesiones(sys.argv[1] if len(sys.argv) > 1 else RUTA, sys.argv[2] if len(sys.argv) > 2 else FORMATO)
+    if not indice.actualizar():
+        raise SystemExit(1)
+    print(f"{indice.ruta} ({indice.formato}): {len(indice.concesiones)} concesiones")
+    _imprimir(sorted(indice.concesiones.items()))
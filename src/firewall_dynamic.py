@@ -4,20 +4,247 @@ firewall_dynamic.py
 --------------------
 Este módulo añade y elimina reglas de iptables dinámicamente
 cuando un usuario inicia o cierra sesión en el portal cautivo.
+
+Para operaciones masivas (restauración al arrancar) se lee el ruleset una sola
+vez con iptables-save y se aplican solo las diferencias en un único lote con
+iptables-restore --noflush.
+
+La limpieza de conntrack tras revocar se agrupa: dentro de un
+`ciclo_revocacion()` los flushes se acumulan (sin repetir IPs) y se ejecutan
+en una sola operación netlink al cerrar el ciclo.
+
+Contabilidad de tráfico: la regla FORWARD que permite navegar cuenta la subida
+del cliente y una regla de contabilidad (`-d ip`, sin objetivo) cuenta la
+bajada. leer_contadores() obtiene todos los contadores con un solo
+`iptables-save -c`.
+
+Con PORTAL_FIREWALL_SHARD_BITS > 0 las reglas por cliente no se insertan en
+FORWARD/PREROUTING sino en subcadenas hoja (PORTAL_FWD_*, PORTAL_ACC_*,
+PORTAL_NAT_*) elegidas por los bits bajos de la IP. Un árbol de saltos por
+bit lleva cada paquete a su hoja: recorre 2 reglas por nivel más las reglas
+de una sola hoja, en lugar de todas las reglas de todos los clientes.
 """
 
 import subprocess
 import logging
 import shutil
 import os
+import socket
+import struct
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import conntrack_netlink
 
 IPTABLES = shutil.which("iptables") or "/sbin/iptables"
+IPTABLES_SAVE = shutil.which("iptables-save") or "/sbin/iptables-save"
+IPTABLES_RESTORE = shutil.which("iptables-restore") or "/sbin/iptables-restore"
 CONNTRACK = shutil.which("conntrack") or "/usr/sbin/conntrack"
 
 # Parámetros para las reglas dinámicas (ajustables vía variables de entorno)
 LAN_INTERFACE = os.getenv("PORTAL_LAN_IF", "enp0s8")
 # Puerto que intercepta el portal (HTTP claro típico)
 CAPTIVE_HTTP_PORT = os.getenv("CAPTIVE_HTTP_PORT", "80")
+# Regla de contabilidad de bajada por cliente (0 = solo se cuenta la subida)
+CONTABILIZAR_BAJADA = os.getenv("PORTAL_ACCOUNT_DOWNLOAD", "1") != "0"
+# Bits de la IP usados para repartir clientes en subcadenas (0 = sin subcadenas, máx. 8)
+SHARD_BITS = min(max(int(os.getenv("PORTAL_FIREWALL_SHARD_BITS", "0")), 0), 8)
+
+# Raíces de los árboles de subcadenas
+CADENA_PERMITIR = "PORTAL_FWD"
+CADENA_CONTABILIDAD = "PORTAL_ACC"
+CADENA_BYPASS = "PORTAL_NAT"
+
+# Flushes de conntrack pendientes del ciclo de revocación en curso (por hilo)
+_revocacion = threading.local()
+
+# Estado de la estructura de subcadenas (se comprueba una vez y tras fallos)
+_estructura_lock = threading.Lock()
+_estructura_verificada = False
+
+# Tipos de regla dinámica por cliente
+TIPO_PERMITIR = "permitir"          # filter/FORWARD -s ip -j ACCEPT (cuenta subida)
+TIPO_BYPASS = "bypass"              # nat/PREROUTING ... -j RETURN
+TIPO_CONTABILIDAD = "contabilidad"  # filter/FORWARD -d ip (sin objetivo, cuenta bajada)
+
+# Regla dinámica identificada por (tabla, cadena, tipo, ip, mac). mac=None -> regla solo por IP.
+ReglaDinamica = Tuple[str, str, str, str, Optional[str]]
+
+
+def _forward_spec(ip: str, mac: Optional[str]) -> list[str]:
+    """Especificación (sin cadena) de la regla FORWARD que permite navegar."""
+    spec = ["-s", ip]
+    if mac:
+        spec += ["-m", "mac", "--mac-source", mac]
+    return spec + ["-j", "ACCEPT"]
+
+
+def _bypass_spec(ip: str, mac: Optional[str]) -> list[str]:
+    """Especificación (sin cadena) del bypass de la redirección HTTP en PREROUTING (nat)."""
+    spec = ["-i", LAN_INTERFACE, "-s", ip, "-p", "tcp", "--dport", CAPTIVE_HTTP_PORT]
+    if mac:
+        spec += ["-m", "mac", "--mac-source", mac]
+    return spec + ["-j", "RETURN"]
+
+
+def _contabilidad_spec(ip: str) -> list[str]:
+    """Especificación (sin cadena) de la regla que solo cuenta el tráfico hacia la IP."""
+    return ["-d", ip]
+
+
+def _cadena_hoja(raiz: str, ip: str) -> str:
+    """Subcadena hoja de `raiz` que corresponde a la IP (un carácter por bit, del menos significativo)."""
+    valor = struct.unpack("!I", socket.inet_aton(ip))[0]
+    return raiz + "_" + "".join("1" if valor >> bit & 1 else "0" for bit in range(SHARD_BITS))
+
+
+def _ubicacion(tipo: str, ip: str) -> Tuple[str, str]:
+    """(tabla, cadena) donde vive la regla de un tipo para la IP."""
+    if tipo == TIPO_BYPASS:
+        return "nat", _cadena_hoja(CADENA_BYPASS, ip) if SHARD_BITS else "PREROUTING"
+    raiz = CADENA_PERMITIR if tipo == TIPO_PERMITIR else CADENA_CONTABILIDAD
+    return "filter", _cadena_hoja(raiz, ip) if SHARD_BITS else "FORWARD"
+
+
+def _regla(tipo: str, ip: str, mac: Optional[str]) -> ReglaDinamica:
+    tabla, cadena = _ubicacion(tipo, ip)
+    return (tabla, cadena, tipo, ip, mac)
+
+
+def _reglas_cliente(ip: str, mac: Optional[str]) -> list[ReglaDinamica]:
+    """Reglas dinámicas que debe tener un cliente autenticado."""
+    mac_norm = mac.lower() if mac else None
+    reglas: list[ReglaDinamica] = [
+        _regla(TIPO_PERMITIR, ip, mac_norm),
+        _regla(TIPO_BYPASS, ip, mac_norm),
+    ]
+    if CONTABILIZAR_BAJADA:
+        reglas.append(_regla(TIPO_CONTABILIDAD, ip, None))
+    return reglas
+
+
+def _spec_regla(regla: ReglaDinamica) -> list[str]:
+    """Traduce una ReglaDinamica a su especificación de iptables (sin cadena)."""
+    _tabla, cadena, tipo, ip, mac = regla
+    if tipo == TIPO_PERMITIR:
+        return _forward_spec(ip, mac)
+    if tipo == TIPO_CONTABILIDAD:
+        return _contabilidad_spec(ip)
+    if cadena != "PREROUTING":
+        # En una subcadena RETURN volvería al REDIRECT de PREROUTING: se usa ACCEPT
+        # (el salto desde PREROUTING ya filtra interfaz, protocolo y puerto).
+        spec = ["-s", ip]
+        if mac:
+            spec += ["-m", "mac", "--mac-source", mac]
+        return spec + ["-j", "ACCEPT"]
+    return _bypass_spec(ip, mac)
+
+
+def _arboles() -> list[Tuple[str, str, str, str, list[str]]]:
+    """
+    Árboles de subcadenas: (tabla, cadena base, raíz, dirección del match, spec del
+    salto desde la cadena base). La contabilidad reparte por destino (-d).
+    """
+    return [
+        ("filter", "FORWARD", CADENA_CONTABILIDAD, "-d", []),
+        ("filter", "FORWARD", CADENA_PERMITIR, "-s", []),
+        ("nat", "PREROUTING", CADENA_BYPASS, "-s",
+         ["-i", LAN_INTERFACE, "-p", "tcp", "--dport", CAPTIVE_HTTP_PORT]),
+    ]
+
+
+def _nodos_arbol(raiz: str, direccion: str) -> Iterator[Tuple[str, list[Tuple[str, str]]]]:
+    """
+    Recorre los nodos del árbol de `raiz`. Devuelve (cadena, saltos) donde saltos
+    es [(match, cadena hija)]; las hojas tienen saltos vacíos. En el nivel n se
+    decide por el bit n de la IP con una máscara no contigua (p. ej. 0.0.0.4/0.0.0.4).
+    """
+    for nivel in range(SHARD_BITS + 1):
+        for valor in range(1 << nivel):
+            ruta = "".join("1" if valor >> bit & 1 else "0" for bit in range(nivel))
+            cadena = f"{raiz}_{ruta}" if ruta else raiz
+            if nivel == SHARD_BITS:
+                yield cadena, []
+                continue
+            mascara = socket.inet_ntoa(struct.pack("!I", 1 << nivel))
+            yield cadena, [
+                (f"{direccion} 0.0.0.0/{mascara}", f"{raiz}_{ruta}0"),
+                (f"{direccion} {mascara}/{mascara}", f"{raiz}_{ruta}1"),
+            ]
+
+
+def _estructura_faltante(salida: str) -> str:
+    """
+    Compara la salida de iptables-save con el árbol de subcadenas esperado y
+    devuelve el payload de iptables-restore --noflush que crea lo que falte
+    (cadenas, saltos entre niveles y saltos desde FORWARD/PREROUTING).
+    Las cadenas existentes no se redeclaran: --noflush las vaciaría.
+    """
+    if SHARD_BITS <= 0:
+        return ""
+    presentes: set[Tuple[str, str]] = set()
+    saltos: set[Tuple[str, str, str]] = set()
+    tabla = ""
+    for line in salida.splitlines():
+        if line.startswith("*"):
+            tabla = line[1:].strip()
+        elif line.startswith(":"):
+            presentes.add((tabla, line[1:].split()[0]))
+        else:
+            tokens = line.split()
+            if len(tokens) >= 4 and tokens[0] == "-A" and tokens[-2] == "-j":
+                saltos.add((tabla, tokens[1], tokens[-1]))
+
+    declarar: dict[str, list[str]] = {"filter": [], "nat": []}
+    reglas: dict[str, list[str]] = {"filter": [], "nat": []}
+    for tabla, base, raiz, direccion, spec_salto in _arboles():
+        for cadena, hijos in _nodos_arbol(raiz, direccion):
+            if (tabla, cadena) not in presentes:
+                declarar[tabla].append(f":{cadena} - [0:0]")
+            for match, hija in hijos:
+                if (tabla, cadena, hija) not in saltos:
+                    reglas[tabla].append(f"-A {cadena} {match} -j {hija}")
+        if (tabla, base, raiz) not in saltos:
+            reglas[tabla].append(" ".join(["-I", base, "1"] + spec_salto + ["-j", raiz]))
+
+    return "".join(
+        f"*{tabla}\n"
+        + "".join(f"{ln}\n" for ln in declarar[tabla] + reglas[tabla])
+        + "COMMIT\n"
+        for tabla in ("filter", "nat")
+        if declarar[tabla] or reglas[tabla]
+    )
+
+
+def _reparar_estructura(salida: str) -> bool:
+    """Crea las subcadenas/saltos que falten según la salida de iptables-save dada."""
+    global _estructura_verificada
+    payload = _estructura_faltante(salida)
+    if payload and not _restore(payload):
+        _estructura_verificada = False
+        return False
+    if payload:
+        logging.info("[FIREWALL] Estructura de subcadenas creada/reparada (%d bits)", SHARD_BITS)
+    _estructura_verificada = True
+    return True
+
+
+def preparar_cadenas(forzar: bool = False) -> bool:
+    """
+    Garantiza que existe el árbol de subcadenas (una lectura + un lote si falta algo).
+    Sin forzar, solo comprueba la primera vez. Sin subcadenas no hace nada.
+    """
+    if SHARD_BITS <= 0:
+        return True
+    with _estructura_lock:
+        if _estructura_verificada and not forzar:
+            return True
+        salida = _leer_ruleset([])
+        if salida is None:
+            return False
+        return _reparar_estructura(salida)
 
 
 def _ensure_binary() -> bool:
@@ -55,14 +282,14 @@ def _delete(cmd: list[str], label: str) -> bool:
     return False
 
 
-def _rule_exists(check_cmd: list[str]) -> bool:
+def _rule_exists(check_cmd: list[str], tabla: str = "filter") -> bool:
     """
     Devuelve True si la regla ya existe (usa iptables -C).
     check_cmd debe incluir la cadena de coincidencia completa sin el -C inicial.
     """
     if not _ensure_binary():
         return False
-    cmd = [IPTABLES, "-C"] + check_cmd
+    cmd = [IPTABLES, "-t", tabla, "-C"] + check_cmd
     result = subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return result.returncode == 0
 
@@ -70,17 +297,78 @@ def _rule_exists(check_cmd: list[str]) -> bool:
 def _flush_conntrack(ip: str) -> None:
     """
     Elimina entradas de conntrack para la IP (evita que conexiones establecidas sigan vivas tras logout).
-    Si no existe el binario `conntrack`, solo loguea una advertencia.
+    Dentro de un ciclo_revocacion() solo se anota la IP; el flush se hace al cerrar el ciclo.
+    """
+    pendientes = getattr(_revocacion, "pendientes", None)
+    if pendientes is not None:
+        pendientes.add(ip)
+        return
+    limpiar_conntrack([ip])
+
+
+@contextmanager
+def ciclo_revocacion() -> Iterator[None]:
+    """
+    Agrupa los flushes de conntrack de varias revocaciones: las IPs se
+    deduplican y se limpian en una sola operación al salir del bloque.
+    Los ciclos anidados se integran en el más externo.
+    """
+    if getattr(_revocacion, "pendientes", None) is not None:
+        yield
+        return
+    _revocacion.pendientes = set()
+    try:
+        yield
+    finally:
+        pendientes = _revocacion.pendientes
+        _revocacion.pendientes = None
+        if pendientes:
+            limpiar_conntrack(pendientes)
+
+
+def limpiar_conntrack(ips: Iterable[str]) -> None:
     """
+    Elimina las entradas de conntrack de varias IPs origen en una sola operación
+    (un volcado netlink + borrados agrupados). Si netlink no está disponible,
+    recurre al binario `conntrack`, una vez por IP distinta.
+    """
+    ips = sorted(set(ips))
+    if not ips:
+        return
+    try:
+        borradas = conntrack_netlink.borrar_por_origen(ips)
+        logging.info(
+            "[FIREWALL] Limpiada tabla conntrack para %d origen(es) (%d entradas): %s",
+            len(ips),
+            borradas,
+            ", ".join(ips),
+        )
+        return
+    except OSError as exc:
+        logging.debug("[FIREWALL] ctnetlink no disponible (%s); usando binario conntrack", exc)
+
     if not CONNTRACK or not os.path.exists(CONNTRACK):
         logging.warning("[FIREWALL] No se pudo limpiar conntrack (binario conntrack no encontrado)")
         return
-    cmd = [CONNTRACK, "-D", "-s", ip]
+    for ip in ips:
+        cmd = [CONNTRACK, "-D", "-s", ip]
+        try:
+            subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            logging.info("[FIREWALL] Limpiada tabla conntrack para origen %s", ip)
+        except Exception as exc:  # noqa: BLE001
+            logging.warning("[FIREWALL] Error limpiando conntrack para %s: %s", ip, exc)
+
+
+def origenes_conntrack() -> Optional[set[str]]:
+    """
+    IPs origen con alguna conexión en conntrack, en un único volcado netlink
+    (señal de actividad para la expiración por inactividad). None si no se pudo leer.
+    """
     try:
-        subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        logging.info("[FIREWALL] Limpiada tabla conntrack para origen %s", ip)
-    except Exception as exc:  # noqa: BLE001
-        logging.warning("[FIREWALL] Error limpiando conntrack para %s: %s", ip, exc)
+        return conntrack_netlink.listar_origenes()
+    except OSError as exc:
+        logging.warning("[FIREWALL] No se pudo volcar conntrack: %s", exc)
+        return None
 
 
 def permitir_ip(ip: str) -> bool:
@@ -96,47 +384,26 @@ def permitir_ip_mac(ip: str, mac: str | None) -> bool:
     y evita que sus peticiones HTTP sean redirigidas al portal cautivo.
     Si mac es None se usa solo IP (como antes). Si mac está presente
     se añade un match de MAC para endurecer la regla.
+    Con PORTAL_ACCOUNT_DOWNLOAD activo añade además la regla de contabilidad.
+    Con subcadenas, las reglas van a la hoja de la IP (solo se toca esa cadena).
     """
-    base_forward = [IPTABLES, "-I", "FORWARD", "1", "-s", ip]
-    base_bypass = [
-        IPTABLES,
-        "-t",
-        "nat",
-        "-I",
-        "PREROUTING",
-        "1",
-        "-i",
-        LAN_INTERFACE,
-        "-s",
-        ip,
-        "-p",
-        "tcp",
-        "--dport",
-        CAPTIVE_HTTP_PORT,
-    ]
-
-    if mac:
-        # Añadir match por MAC (solo tiene sentido en paquetes entrantes por interfaz LAN)
-        base_forward += ["-m", "mac", "--mac-source", mac]
-        base_bypass += ["-m", "mac", "--mac-source", mac]
-
-    allow_forward = base_forward + ["-j", "ACCEPT"]
-    bypass_redirect = base_bypass + ["-j", "RETURN"]
-
-    ok_forward = True
-    ok_bypass = True
-
-    if _rule_exists(allow_forward[1:]):  # quitar binario iptables
-        logging.info("[FIREWALL] Regla FORWARD ya existía para %s", ip)
-    else:
-        ok_forward = _run(allow_forward)
-
-    if _rule_exists(bypass_redirect[1:]):
-        logging.info("[FIREWALL] Regla PREROUTING ya existía para %s", ip)
-    else:
-        ok_bypass = _run(bypass_redirect)
-
-    return ok_forward and ok_bypass
+    preparar_cadenas()
+    ok = True
+    for regla in _reglas_cliente(ip, mac):
+        tabla, cadena, tipo = regla[0], regla[1], regla[2]
+        spec = _spec_regla(regla)
+        if _rule_exists([cadena] + spec, tabla=tabla):
+            logging.info("[FIREWALL] Regla %s (%s) ya existía para %s", cadena, tipo, ip)
+            continue
+        # Posición 1: la contabilidad debe contar antes de la regla ESTABLISHED,RELATED
+        insertar = [IPTABLES, "-t", tabla, "-I", cadena, "1"] + spec
+        if _run(insertar):
+            continue
+        # La estructura pudo desaparecer (p. ej. firewall_init.sh): se recrea y se reintenta
+        if SHARD_BITS > 0 and preparar_cadenas(forzar=True) and _run(insertar):
+            continue
+        ok = False
+    return ok
 
 
 
@@ -152,52 +419,375 @@ def denegar_ip_mac(ip: str, mac: str | None) -> bool:
     Elimina las reglas que permiten navegar a la IP (FORWARD)
     y su bypass de redirección HTTP (PREROUTING nat).
     Si mac es None, elimina reglas que no usan match mac.
-    Si mac está presente, intenta eliminar las reglas con match mac.
-    """
-    remove_forward = [IPTABLES, "-D", "FORWARD", "-s", ip]
-    remove_bypass = [
-        IPTABLES,
-        "-t",
-        "nat",
-        "-D",
-        "PREROUTING",
-        "-i",
-        LAN_INTERFACE,
-        "-s",
-        ip,
-        "-p",
-        "tcp",
-        "--dport",
-        CAPTIVE_HTTP_PORT,
-    ]
+    Si mac está presente, elimina también las reglas con match mac.
 
-    # Construir variantes con y sin MAC para asegurar limpieza completa
-    commands: list[tuple[list[str], str]] = []
+    Solo se tocan las cadenas de la disposición activa (hojas de la IP o
+    FORWARD/PREROUTING): se leen con `iptables -S` y las reglas presentes se
+    borran en un único lote. Las reglas que queden en la otra disposición
+    las migra o elimina la reconciliación.
+    """
+    mac_norm = mac.lower() if mac else None
+    candidatas = [_regla(TIPO_PERMITIR, ip, None), _regla(TIPO_BYPASS, ip, None)]
+    if mac_norm:
+        candidatas += [_regla(TIPO_PERMITIR, ip, mac_norm), _regla(TIPO_BYPASS, ip, mac_norm)]
+    # La regla de contabilidad se borra siempre (aunque se haya desactivado después)
+    candidatas.append(_regla(TIPO_CONTABILIDAD, ip, None))
+
+    existentes = _leer_cadenas({(regla[0], regla[1]) for regla in candidatas})
+    if existentes is not None:
+        eliminar = [regla for regla in candidatas for _ in range(existentes.get(regla, 0))]
+        if not eliminar or aplicar_lote([], eliminar):
+            removed_any = bool(eliminar)
+        else:
+            removed_any = _denegar_regla_a_regla(candidatas)
+    else:
+        removed_any = _denegar_regla_a_regla(candidatas)
 
-    forward_no_mac = remove_forward + ["-j", "ACCEPT"]
-    bypass_no_mac = remove_bypass + ["-j", "RETURN"]
-    commands.append((forward_no_mac, "FORWARD/ip"))
-    commands.append((bypass_no_mac, "PREROUTING/ip"))
+    _flush_conntrack(ip)
 
-    if mac:
-        forward_mac = remove_forward + ["-m", "mac", "--mac-source", mac, "-j", "ACCEPT"]
-        bypass_mac = remove_bypass + ["-m", "mac", "--mac-source", mac, "-j", "RETURN"]
-        commands.append((forward_mac, "FORWARD/ip+mac"))
-        commands.append((bypass_mac, "PREROUTING/ip+mac"))
+    if not removed_any:
+        logging.info("[FIREWALL] No se encontraron reglas a eliminar para %s (mac=%s)", ip, mac)
+
+    return True
 
+
+def _denegar_regla_a_regla(reglas: Iterable[ReglaDinamica]) -> bool:
+    """Borra las reglas una a una con iptables -D (incluidos duplicados). True si borró alguna."""
     removed_any = False
-    for cmd, label in commands:
-        while _delete(cmd, label):
+    for regla in reglas:
+        tabla, cadena, tipo = regla[0], regla[1], regla[2]
+        cmd = [IPTABLES, "-t", tabla, "-D", cadena] + _spec_regla(regla)
+        while _delete(cmd, f"{cadena}/{tipo}"):
             removed_any = True
+    return removed_any
 
-    _flush_conntrack(ip)
 
-    if not removed_any:
-        logging.info("[FIREWALL] No se encontraron reglas a eliminar para %s (mac=%s)", ip, mac)
+def _leer_cadenas(cadenas: Iterable[Tuple[str, str]]) -> Optional[Counter]:
+    """
+    Lee con `iptables -S` solo las cadenas (tabla, cadena) dadas y devuelve un
+    Counter ReglaDinamica -> apariciones (None si alguna no se pudo leer).
+    """
+    if not _ensure_binary():
+        return None
+    reglas: Counter = Counter()
+    for tabla, cadena in sorted(cadenas):
+        try:
+            result = subprocess.run(
+                [IPTABLES, "-t", tabla, "-S", cadena], check=True, capture_output=True, text=True
+            )
+        except (OSError, subprocess.CalledProcessError) as exc:
+            logging.debug("[FIREWALL] No se pudo leer la cadena %s/%s: %s", tabla, cadena, exc)
+            return None
+        for line in result.stdout.splitlines():
+            regla = _parse_regla_guardada(line, tabla)
+            if regla is not None:
+                reglas[regla] += 1
+    return reglas
+
+
+def _parse_regla_guardada(line: str, tabla: str) -> Optional[ReglaDinamica]:
+    """
+    Interpreta una línea '-A ...' de iptables-save y devuelve la ReglaDinamica
+    si corresponde a una regla creada por este módulo (None en otro caso).
+    """
+    tokens = line.split()
+    if len(tokens) < 3 or tokens[0] != "-A":
+        return None
+    cadena = tokens[1]
+    opts: dict[str, str] = {}
+    i = 2
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok == "-m" and i + 1 < len(tokens):
+            if tokens[i + 1] not in {"mac", "tcp"}:
+                return None
+            i += 2
+            continue
+        if i + 1 >= len(tokens):
+            return None
+        opts[tok] = tokens[i + 1]
+        i += 2
+
+    # Se reconocen también las reglas en FORWARD/PREROUTING cuando hay subcadenas
+    # (y al revés) para que la reconciliación migre las que estén en el sitio viejo.
+    if tabla == "filter" and set(opts) == {"-d"} and (
+        cadena == "FORWARD" or cadena.startswith(CADENA_CONTABILIDAD + "_")
+    ):
+        ip = opts["-d"]
+        if ip.endswith("/32"):
+            ip = ip[:-3]
+        if not ip or "/" in ip:
+            return None
+        return ("filter", cadena, TIPO_CONTABILIDAD, ip, None)
+
+    ip = opts.get("-s", "")
+    if ip.endswith("/32"):
+        ip = ip[:-3]
+    if not ip or "/" in ip:
+        return None
+    mac = opts.get("--mac-source")
+    mac = mac.lower() if mac else None
+    keys = set(opts) - {"--mac-source"}
+
+    if tabla == "filter" and (cadena == "FORWARD" or cadena.startswith(CADENA_PERMITIR + "_")):
+        if keys == {"-s", "-j"} and opts["-j"] == "ACCEPT":
+            return ("filter", cadena, TIPO_PERMITIR, ip, mac)
+    elif tabla == "nat" and cadena == "PREROUTING":
+        if (
+            keys == {"-s", "-i", "-p", "--dport", "-j"}
+            and opts["-i"] == LAN_INTERFACE
+            and opts["-p"] == "tcp"
+            and opts["--dport"] == CAPTIVE_HTTP_PORT
+            and opts["-j"] == "RETURN"
+        ):
+            return ("nat", "PREROUTING", TIPO_BYPASS, ip, mac)
+    elif tabla == "nat" and cadena.startswith(CADENA_BYPASS + "_"):
+        if keys == {"-s", "-j"} and opts["-j"] == "ACCEPT":
+            return ("nat", cadena, TIPO_BYPASS, ip, mac)
+    return None
+
+
+def _leer_ruleset(args: list[str]) -> Optional[str]:
+    """Ejecuta iptables-save con los argumentos dados y devuelve su salida (None si falla)."""
+    if not os.path.exists(IPTABLES_SAVE):
+        logging.warning("[FIREWALL] iptables-save no disponible (%s)", IPTABLES_SAVE)
+        return None
+    try:
+        result = subprocess.run(
+            [IPTABLES_SAVE] + args, check=True, capture_output=True, text=True
+        )
+    except (OSError, subprocess.CalledProcessError) as exc:
+        logging.error("[FIREWALL] Error leyendo reglas con iptables-save: %s", exc)
+        return None
+    return result.stdout
+
+
+def leer_reglas_dinamicas() -> Optional[Counter]:
+    """
+    Lee el ruleset actual con una sola llamada a iptables-save y devuelve
+    un Counter ReglaDinamica -> número de apariciones.
+    Devuelve None si no se pudo leer (binario ausente o error).
+
+    Con subcadenas, aprovecha la lectura para recrear la estructura si falta
+    algo, de modo que el lote posterior (restauración, reconciliación) no falle.
+    """
+    salida = _leer_ruleset([])
+    if salida is None:
+        return None
+    if SHARD_BITS > 0:
+        with _estructura_lock:
+            _reparar_estructura(salida)
+
+    reglas: Counter = Counter()
+    tabla = ""
+    for line in salida.splitlines():
+        if line.startswith("*"):
+            tabla = line[1:].strip()
+            continue
+        regla = _parse_regla_guardada(line, tabla)
+        if regla is not None:
+            reglas[regla] += 1
+    return reglas
+
+
+def leer_contadores() -> Optional[Dict[str, Tuple[int, int]]]:
+    """
+    Lee los contadores de todas las reglas dinámicas de la tabla filter con una
+    sola llamada a `iptables-save -c` (coste O(reglas), no un proceso por sesión).
 
+    Devuelve {ip: (paquetes, bytes)} sumando subida (regla FORWARD de permiso)
+    y bajada (regla de contabilidad). None si no se pudo leer.
+    """
+    salida = _leer_ruleset(["-c", "-t", "filter"])
+    if salida is None:
+        return None
+
+    contadores: Dict[str, Tuple[int, int]] = {}
+    for line in salida.splitlines():
+        # Formato: [paquetes:bytes] -A CADENA ...
+        if not line.startswith("["):
+            continue
+        cierre = line.find("]")
+        if cierre < 0:
+            continue
+        try:
+            paquetes, octetos = (int(v) for v in line[1:cierre].split(":"))
+        except ValueError:
+            continue
+        regla = _parse_regla_guardada(line[cierre + 1:].strip(), "filter")
+        if regla is None:
+            continue
+        ip = regla[3]
+        prev_p, prev_b = contadores.get(ip, (0, 0))
+        contadores[ip] = (prev_p + paquetes, prev_b + octetos)
+    return contadores
+
+
+def diferencia_reglas(
+    deseadas: set[ReglaDinamica], existentes: Counter
+) -> Tuple[list[ReglaDinamica], list[ReglaDinamica]]:
+    """
+    Compara reglas deseadas con las existentes.
+    Devuelve (a_agregar, a_eliminar); los duplicados cuentan como sobrantes.
+    """
+    agregar = [r for r in deseadas if existentes.get(r, 0) == 0]
+    eliminar: list[ReglaDinamica] = []
+    for regla, count in existentes.items():
+        sobrantes = count - (1 if regla in deseadas else 0)
+        eliminar.extend([regla] * sobrantes)
+    return agregar, eliminar
+
+
+def aplicar_lote(agregar: Iterable[ReglaDinamica], eliminar: Iterable[ReglaDinamica]) -> bool:
+    """
+    Aplica altas y bajas de reglas dinámicas en una sola invocación de
+    iptables-restore --noflush (una transacción por tabla).
+    Las bajas deben existir (obtenerlas de leer_reglas_dinamicas) o el lote falla.
+    """
+    lineas: dict[str, list[str]] = {"filter": [], "nat": []}
+    for regla in eliminar:
+        lineas[regla[0]].append(" ".join(["-D", regla[1]] + _spec_regla(regla)))
+    for regla in agregar:
+        lineas[regla[0]].append(" ".join(["-I", regla[1], "1"] + _spec_regla(regla)))
+
+    payload = "".join(
+        f"*{tabla}\n" + "".join(f"{ln}\n" for ln in lns) + "COMMIT\n"
+        for tabla, lns in lineas.items()
+        if lns
+    )
+    if not payload:
+        return True
+    if not _restore(payload):
+        return False
+    logging.info(
+        "[FIREWALL] Lote aplicado con iptables-restore (%d líneas)",
+        sum(len(lns) for lns in lineas.values()),
+    )
+    return True
+
+
+def _restore(payload: str) -> bool:
+    """Aplica un payload con iptables-restore --noflush (una transacción por tabla)."""
+    try:
+        subprocess.run(
+            [IPTABLES_RESTORE, "--noflush"],
+            input=payload,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except subprocess.CalledProcessError as exc:
+        logging.error("[FIREWALL] Error aplicando lote con iptables-restore: %s", exc.stderr.strip())
+        return False
+    except OSError as exc:
+        logging.error("[FIREWALL] No se pudo ejecutar iptables-restore: %s", exc)
+        return False
     return True
 
 
+def reglas_deseadas(clientes: Iterable[Tuple[str, Optional[str]]]) -> set[ReglaDinamica]:
+    """Conjunto de reglas dinámicas que corresponden a los clientes (ip, mac) dados."""
+    return {regla for ip, mac in clientes for regla in _reglas_cliente(ip, mac)}
+
+
+def restaurar_reglas(clientes: Iterable[Tuple[str, Optional[str]]]) -> Optional[Tuple[int, int]]:
+    """
+    Sincroniza las reglas dinámicas con la lista de clientes (ip, mac) autorizados:
+    lee el ruleset una vez, calcula la diferencia y aplica solo lo que falta o
+    sobra en un único lote.
+
+    Devuelve (añadidas, eliminadas). Si no se puede leer el ruleset, recurre a
+    permitir_ip_mac por cliente y devuelve None.
+    """
+    clientes = list(clientes)
+    existentes = leer_reglas_dinamicas()
+    if existentes is None:
+        logging.warning("[FIREWALL] Restauración regla a regla (sin iptables-save)")
+        for ip, mac in clientes:
+            permitir_ip_mac(ip, mac)
+        return None
+
+    agregar, eliminar = diferencia_reglas(reglas_deseadas(clientes), existentes)
+    if (agregar or eliminar) and not aplicar_lote(agregar, eliminar):
+        return None
+    return len(agregar), len(eliminar)
+
+
+def permitir_lote(clientes: Iterable[Tuple[str, Optional[str]]]) -> int:
+    """
+    Autoriza de una vez a varios clientes (ip, mac): lee el ruleset una vez y
+    añade en un único lote solo las reglas que les faltan (las existentes no
+    se duplican). Si no se puede leer el ruleset o el lote falla, recurre a
+    permitir_ip_mac por cliente.
+
+    Devuelve el número de reglas añadidas en lote.
+    """
+    clientes = list(clientes)
+    if not clientes:
+        return 0
+    preparar_cadenas()
+    existentes = leer_reglas_dinamicas()
+    if existentes is not None:
+        agregar = [regla for regla in reglas_deseadas(clientes) if regla not in existentes]
+        if not agregar or aplicar_lote(agregar, []):
+            logging.info("[FIREWALL] Autorizados %d clientes en lote (%d reglas)", len(clientes), len(agregar))
+            return len(agregar)
+    for ip, mac in clientes:
+        permitir_ip_mac(ip, mac)
+    return 0
+
+
+def revocar_lote(
+    clientes: Iterable[Tuple[str, Optional[str]]],
+    en_uso: Optional[Callable[[str], Iterable[Optional[str]]]] = None,
+) -> int:
+    """
+    Revoca de una vez el acceso de varios clientes (ip, mac): lee el ruleset una
+    vez, elimina en un único lote todas sus reglas dinámicas (con y sin MAC,
+    como denegar_ip_mac) y limpia conntrack para todas sus IPs (deduplicadas).
+
+    `en_uso(ip)` devuelve las MACs (None = sin MAC) de las sesiones que siguen
+    vivas en la IP: sus reglas solo por IP se conservan si alguna sesión sin
+    MAC las usa, y la de contabilidad mientras quede cualquier sesión.
+
+    Devuelve el número de reglas eliminadas.
+    """
+    clientes = list(clientes)
+    if not clientes:
+        return 0
+
+    with ciclo_revocacion():
+        existentes = leer_reglas_dinamicas()
+        if existentes is None:
+            for ip, mac in clientes:
+                denegar_ip_mac(ip, mac)
+            return 0
+
+        objetivo = {(ip, mac.lower() if mac else None) for ip, mac in clientes}
+        restantes = {ip: set(en_uso(ip)) if en_uso else set() for ip, _mac in clientes}
+        for ip, macs in restantes.items():
+            if None in macs:
+                objetivo.discard((ip, None))
+            else:
+                objetivo.add((ip, None))
+        eliminar = [
+            regla
+            for regla, count in existentes.items()
+            if (regla[3], regla[4]) in objetivo
+            and not (regla[2] == TIPO_CONTABILIDAD and restantes[regla[3]])
+            for _ in range(count)
+        ]
+        if eliminar and not aplicar_lote([], eliminar):
+            for ip, mac in clientes:
+                denegar_ip_mac(ip, mac)
+            return 0
+
+        for ip, _mac in clientes:
+            _flush_conntrack(ip)
+
+    logging.info("[FIREWALL] Revocados %d clientes en lote (%d reglas)", len(clientes), len(eliminar))
+    return len(eliminar)
+
 
 def listar_reglas() -> None:
     """Imprime las reglas actuales (para debug)."""
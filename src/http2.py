@@ -0,0 +1,908 @@
+#!/usr/bin/env python3
+"""
+http2.py
+
+HTTP/2 (RFC 7540) sobre TLS para el portal, negociado por ALPN ("h2") y
+solo con la biblioteca estándar. Cubre lo que necesitan las pocas rutas que
+servimos: una conexión lleva la página de login, sus recursos y el POST
+/login, en vez de un handshake TLS por petición.
+
+- HPACK (RFC 7541): el decodificador implementa la tabla estática, la
+  dinámica (con sus actualizaciones de tamaño) y Huffman; el codificador
+  usa índices estáticos y literales sin indexar, así que no guarda estado.
+- Streams: cada stream que termina su petición se traduce a una petición
+  HTTP/1.1 en memoria y se atiende con el mismo manejador que el resto de
+  conexiones; la respuesta HTTP/1.1 se vuelve a traducir a HEADERS + DATA.
+  Los streams se atienden en orden, uno tras otro, en el hilo de la conexión.
+- Control de flujo: la ventana de recepción se repone en cuanto llega cada
+  DATA; el envío respeta las ventanas de conexión y de stream del cliente
+  (lo que no cabe espera a su WINDOW_UPDATE).
+- Sin server push, prioridades (se ignoran) ni HTTP/2 en claro (h2c).
+
+La conexión se cierra con GOAWAY tras PORTAL_HTTP2_IDLE_TIMEOUT segundos sin
+completar una petición (ni un PING ni un stream rechazado o reiniciado
+cuentan) o tras PORTAL_HTTP2_MAX_REQUESTS peticiones. Como ocupa un hilo del
+pool mientras está abierta, tiene además los mismos límites que una
+conexión HTTP/1.1 lenta:
+- vida máxima absoluta (PORTAL_HTTP2_MAX_LIFETIME segundos),
+- ritmo mínimo de peticiones completadas (PORTAL_HTTP2_MIN_RATE por minuto,
+  exigido pasado el primer PORTAL_HTTP2_IDLE_TIMEOUT),
+- plazo para recibir cada frame entero una vez empezado.
+Los cierres por estos límites (y por inactividad con streams a medias) se
+notifican al llamador para que los cuente como clientes lentos. El llamador
+puede además acortar la inactividad de una conexión (p. ej. si ya hay
+demasiadas conexiones HTTP/2 ocupando el pool).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+ENABLED = os.getenv("PORTAL_HTTP2", "1").strip().lower() in {"1", "true", "yes", "on"}
+IDLE_TIMEOUT = float(os.getenv("PORTAL_HTTP2_IDLE_TIMEOUT", "5"))
+MAX_REQUESTS = int(os.getenv("PORTAL_HTTP2_MAX_REQUESTS", "100"))
+MAX_CONCURRENT_STREAMS = int(os.getenv("PORTAL_HTTP2_MAX_STREAMS", "32"))
+MAX_LIFETIME = float(os.getenv("PORTAL_HTTP2_MAX_LIFETIME", "120"))
+# Peticiones completadas por minuto (0 = sin mínimo)
+MIN_REQUEST_RATE = float(os.getenv("PORTAL_HTTP2_MIN_RATE", "2"))
+
+PREFACIO = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+# Tipos de frame
+DATA = 0x0
+HEADERS = 0x1
+PRIORITY = 0x2
+RST_STREAM = 0x3
+SETTINGS = 0x4
+PUSH_PROMISE = 0x5
+PING = 0x6
+GOAWAY = 0x7
+WINDOW_UPDATE = 0x8
+CONTINUATION = 0x9
+
+# Flags
+FLAG_END_STREAM = 0x1
+FLAG_ACK = 0x1
+FLAG_END_HEADERS = 0x4
+FLAG_PADDED = 0x8
+FLAG_PRIORITY = 0x20
+
+# Códigos de error
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+ENHANCE_YOUR_CALM = 0xB
+COMPRESSION_ERROR = 0x9
+
+# Parámetros de SETTINGS
+SETTINGS_HEADER_TABLE_SIZE = 0x1
+SETTINGS_ENABLE_PUSH = 0x2
+SETTINGS_MAX_CONCURRENT_STREAMS = 0x3
+SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+SETTINGS_MAX_FRAME_SIZE = 0x5
+SETTINGS_MAX_HEADER_LIST_SIZE = 0x6
+
+VENTANA_INICIAL = 65535
+TAMANO_FRAME = 16384
+VENTANA_MAXIMA = 2**31 - 1
+
+_FRAME = struct.Struct("!HBBBI")  # longitud en 24 bits: 16 + 8
+
+# Cabeceras propias de HTTP/1.1 que no pueden viajar en HTTP/2 (RFC 7540, 8.1.2.2)
+_CABECERAS_DE_CONEXION = frozenset({"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade"})
+
+
+class LimiteH2(Exception):
+    """La conexión superó uno de sus límites (vida, ritmo, inactividad, frame o lectura)."""
+
+    def __init__(self, motivo: str) -> None:
+        super().__init__(motivo)
+        self.motivo = motivo
+
+
+class ErrorH2(Exception):
+    """Error de protocolo; `stream` 0 = error de conexión (GOAWAY), si no RST_STREAM."""
+
+    def __init__(self, codigo: int, mensaje: str, stream: int = 0) -> None:
+        super().__init__(mensaje)
+        self.codigo = codigo
+        self.stream = stream
+
+
+# -- HPACK --------------------------------------------------------------------
+
+# Tabla estática (RFC 7541, apéndice A); el índice 1 es la primera entrada
+TABLA_ESTATICA: Tuple[Tuple[str, str], ...] = (
+    (":authority", ""),
+    (":method", "GET"),
+    (":method", "POST"),
+    (":path", "/"),
+    (":path", "/index.html"),
+    (":scheme", "http"),
+    (":scheme", "https"),
+    (":status", "200"),
+    (":status", "204"),
+    (":status", "206"),
+    (":status", "304"),
+    (":status", "400"),
+    (":status", "404"),
+    (":status", "500"),
+    ("accept-charset", ""),
+    ("accept-encoding", "gzip, deflate"),
+    ("accept-language", ""),
+    ("accept-ranges", ""),
+    ("accept", ""),
+    ("access-control-allow-origin", ""),
+    ("age", ""),
+    ("allow", ""),
+    ("authorization", ""),
+    ("cache-control", ""),
+    ("content-disposition", ""),
+    ("content-encoding", ""),
+    ("content-language", ""),
+    ("content-length", ""),
+    ("content-location", ""),
+    ("content-range", ""),
+    ("content-type", ""),
+    ("cookie", ""),
+    ("date", ""),
+    ("etag", ""),
+    ("expect", ""),
+    ("expires", ""),
+    ("from", ""),
+    ("host", ""),
+    ("if-match", ""),
+    ("if-modified-since", ""),
+    ("if-none-match", ""),
+    ("if-range", ""),
+    ("if-unmodified-since", ""),
+    ("last-modified", ""),
+    ("link", ""),
+    ("location", ""),
+    ("max-forwards", ""),
+    ("proxy-authenticate", ""),
+    ("proxy-authorization", ""),
+    ("range", ""),
+    ("referer", ""),
+    ("refresh", ""),
+    ("retry-after", ""),
+    ("server", ""),
+    ("set-cookie", ""),
+    ("strict-transport-security", ""),
+    ("transfer-encoding", ""),
+    ("user-agent", ""),
+    ("vary", ""),
+    ("via", ""),
+    ("www-authenticate", ""),
+)
+
+# Para el codificador: (nombre, valor) -> índice y nombre -> primer índice
+_INDICE_COMPLETO = {entrada: i for i, entrada in enumerate(TABLA_ESTATICA, 1) if entrada[1]}
+_INDICE_NOMBRE: Dict[str, int] = {}
+for _i, (_nombre, _valor) in enumerate(TABLA_ESTATICA, 1):
+    _INDICE_NOMBRE.setdefault(_nombre, _i)
+
+# Códigos Huffman de HPACK (RFC 7541, apéndice B): (código, bits) por símbolo 0-255; EOS aparte
+_HUFFMAN = (
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28),
+    (0xfffffe4, 28), (0xfffffe5, 28), (0xfffffe6, 28), (0xfffffe7, 28),
+    (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28),
+    (0xfffffed, 28), (0xfffffee, 28), (0xfffffef, 28), (0xffffff0, 28),
+    (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28),
+    (0xffffff8, 28), (0xffffff9, 28), (0xffffffa, 28), (0xffffffb, 28),
+    (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12),
+    (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11),
+    (0x3fa, 10), (0x3fb, 10), (0xf9, 8), (0x7fb, 11),
+    (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6),
+    (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6),
+    (0x1a, 6), (0x1b, 6), (0x1c, 6), (0x1d, 6),
+    (0x1e, 6), (0x1f, 6), (0x5c, 7), (0xfb, 8),
+    (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10),
+    (0x1ffa, 13), (0x21, 6), (0x5d, 7), (0x5e, 7),
+    (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7),
+    (0x63, 7), (0x64, 7), (0x65, 7), (0x66, 7),
+    (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7),
+    (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7),
+    (0x6f, 7), (0x70, 7), (0x71, 7), (0x72, 7),
+    (0xfc, 8), (0x73, 7), (0xfd, 8), (0x1ffb, 13),
+    (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14), (0x22, 6),
+    (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5),
+    (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6),
+    (0x27, 6), (0x6, 5), (0x74, 7), (0x75, 7),
+    (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5),
+    (0x2b, 6), (0x76, 7), (0x2c, 6), (0x8, 5),
+    (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7),
+    (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15),
+    (0x7fc, 11), (0x3ffd, 14), (0x1ffd, 13), (0xffffffc, 28),
+    (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20),
+    (0x3fffd3, 22), (0x3fffd4, 22), (0x3fffd5, 22), (0x7fffd9, 23),
+    (0x3fffd6, 22), (0x7fffda, 23), (0x7fffdb, 23), (0x7fffdc, 23),
+    (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23),
+    (0xffffec, 24), (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23),
+    (0xffffee, 24), (0x7fffe1, 23), (0x7fffe2, 23), (0x7fffe3, 23),
+    (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23),
+    (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23), (0xffffef, 24),
+    (0x3fffda, 22), (0x1fffdd, 21), (0xfffe9, 20), (0x3fffdb, 22),
+    (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21),
+    (0x7fffea, 23), (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24),
+    (0x1fffdf, 21), (0x3fffdf, 22), (0x7fffeb, 23), (0x7fffec, 23),
+    (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21),
+    (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23), (0x7fffef, 23),
+    (0xfffea, 20), (0x3fffe2, 22), (0x3fffe3, 22), (0x3fffe4, 22),
+    (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23),
+    (0x3ffffe0, 26), (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19),
+    (0x3fffe7, 22), (0x7ffff2, 23), (0x3fffe8, 22), (0x1ffffec, 25),
+    (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25),
+    (0x7fff2, 19), (0x1fffe3, 21), (0x3ffffe6, 26), (0x7ffffe0, 27),
+    (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24),
+    (0x1fffe4, 21), (0x1fffe5, 21), (0x3ffffe8, 26), (0x3ffffe9, 26),
+    (0xffffffd, 28), (0x7ffffe3, 27), (0x7ffffe4, 27), (0x7ffffe5, 27),
+    (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21),
+    (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21), (0x7ffff3, 23),
+    (0x3fffea, 22), (0x3fffeb, 22), (0x1ffffee, 25), (0x1ffffef, 25),
+    (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23),
+    (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26),
+    (0x7ffffe7, 27), (0x7ffffe8, 27), (0x7ffffe9, 27), (0x7ffffea, 27),
+    (0x7ffffeb, 27), (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27),
+    (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27), (0x3ffffee, 26),
+)
+
+# (bits, código) -> símbolo, para decodificar
+_HUFFMAN_INVERSO = {(bits, codigo): simbolo for simbolo, (codigo, bits) in enumerate(_HUFFMAN)}
+_HUFFMAN_MIN_BITS = min(bits for _c, bits in _HUFFMAN)
+
+
+def _huffman_decodificar(datos: bytes) -> bytes:
+    salida = bytearray()
+    actual = 0
+    n = 0
+    for byte in datos:
+        for desplazamiento in range(7, -1, -1):
+            actual = (actual << 1) | ((byte >> desplazamiento) & 1)
+            n += 1
+            if n >= _HUFFMAN_MIN_BITS:
+                simbolo = _HUFFMAN_INVERSO.get((n, actual))
+                if simbolo is not None:
+                    salida.append(simbolo)
+                    actual = 0
+                    n = 0
+                elif n >= 30:
+                    raise ErrorH2(COMPRESSION_ERROR, "código Huffman inválido")
+    # El relleno final son como mucho 7 bits a uno (prefijo de EOS)
+    if n > 7 or actual != (1 << n) - 1:
+        raise ErrorH2(COMPRESSION_ERROR, "relleno Huffman inválido")
+    return bytes(salida)
+
+
+def _leer_entero(datos: bytes, pos: int, prefijo: int) -> Tuple[int, int]:
+    """Entero HPACK con prefijo de `prefijo` bits desde datos[pos]; devuelve (valor, nueva pos)."""
+    mascara = (1 << prefijo) - 1
+    try:
+        valor = datos[pos] & mascara
+        pos += 1
+        if valor < mascara:
+            return valor, pos
+        m = 0
+        while True:
+            byte = datos[pos]
+            pos += 1
+            valor += (byte & 0x7F) << m
+            m += 7
+            if not byte & 0x80:
+                return valor, pos
+            if m > 28:
+                raise ErrorH2(COMPRESSION_ERROR, "entero HPACK demasiado grande")
+    except IndexError:
+        raise ErrorH2(COMPRESSION_ERROR, "bloque de cabeceras truncado") from None
+
+
+def _leer_cadena(datos: bytes, pos: int) -> Tuple[str, int]:
+    huffman = pos < len(datos) and datos[pos] & 0x80
+    longitud, pos = _leer_entero(datos, pos, 7)
+    if pos + longitud > len(datos):
+        raise ErrorH2(COMPRESSION_ERROR, "cadena HPACK truncada")
+    crudo = datos[pos:pos + longitud]
+    if huffman:
+        crudo = _huffman_decodificar(crudo)
+    # iso-8859-1 conserva los octetos tal cual (como el parser HTTP/1.1)
+    return crudo.decode("iso-8859-1"), pos + longitud
+
+
+def _codificar_entero(valor: int, prefijo: int, primer_byte: int) -> bytes:
+    mascara = (1 << prefijo) - 1
+    if valor < mascara:
+        return bytes((primer_byte | valor,))
+    salida = bytearray((primer_byte | mascara,))
+    valor -= mascara
+    while valor >= 0x80:
+        salida.append((valor & 0x7F) | 0x80)
+        valor >>= 7
+    salida.append(valor)
+    return bytes(salida)
+
+
+def _codificar_cadena(texto: str) -> bytes:
+    crudo = texto.encode("iso-8859-1")
+    return _codificar_entero(len(crudo), 7, 0x00) + crudo
+
+
+class DecodificadorHPACK:
+    """Estado HPACK de recepción de una conexión (la tabla dinámica la dicta el cliente)."""
+
+    def __init__(self, tamano_maximo: int = 4096) -> None:
+        self.tamano_maximo = tamano_maximo  # lo anunciado en SETTINGS_HEADER_TABLE_SIZE
+        self.limite = tamano_maximo  # lo que fijó la última actualización del cliente
+        self.tabla: Deque[Tuple[str, str]] = deque()
+        self.tamano = 0
+
+    def _entrada(self, indice: int) -> Tuple[str, str]:
+        if indice <= 0:
+            raise ErrorH2(COMPRESSION_ERROR, "índice HPACK 0")
+        if indice <= len(TABLA_ESTATICA):
+            return TABLA_ESTATICA[indice - 1]
+        try:
+            return self.tabla[indice - len(TABLA_ESTATICA) - 1]
+        except IndexError:
+            raise ErrorH2(COMPRESSION_ERROR, f"índice HPACK fuera de tabla: {indice}") from None
+
+    def _recortar(self) -> None:
+        while self.tamano > self.limite:
+            nombre, valor = self.tabla.pop()
+            self.tamano -= len(nombre) + len(valor) + 32
+
+    def _anadir(self, nombre: str, valor: str) -> None:
+        self.tabla.appendleft((nombre, valor))
+        self.tamano += len(nombre) + len(valor) + 32
+        self._recortar()
+
+    def decodificar(self, bloque: bytes) -> List[Tuple[str, str]]:
+        cabeceras: List[Tuple[str, str]] = []
+        pos = 0
+        while pos < len(bloque):
+            byte = bloque[pos]
+            if byte & 0x80:
+                # Campo indexado
+                indice, pos = _leer_entero(bloque, pos, 7)
+                cabeceras.append(self._entrada(indice))
+            elif byte & 0x40:
+                # Literal con indexación incremental
+                indice, pos = _leer_entero(bloque, pos, 6)
+                if indice:
+                    nombre = self._entrada(indice)[0]
+                else:
+                    nombre, pos = _leer_cadena(bloque, pos)
+                valor, pos = _leer_cadena(bloque, pos)
+                self._anadir(nombre, valor)
+                cabeceras.append((nombre, valor))
+            elif byte & 0x20:
+                # Actualización de tamaño de la tabla dinámica
+                nuevo, pos = _leer_entero(bloque, pos, 5)
+                if nuevo > self.tamano_maximo:
+                    raise ErrorH2(COMPRESSION_ERROR, f"tabla HPACK de {nuevo} bytes por encima de lo anunciado")
+                self.limite = nuevo
+                self._recortar()
+            else:
+                # Literal sin indexar (0000) o nunca indexado (0001)
+                indice, pos = _leer_entero(bloque, pos, 4)
+                if indice:
+                    nombre = self._entrada(indice)[0]
+                else:
+                    nombre, pos = _leer_cadena(bloque, pos)
+                valor, pos = _leer_cadena(bloque, pos)
+                cabeceras.append((nombre, valor))
+        return cabeceras
+
+
+def codificar_cabeceras(cabeceras: List[Tuple[str, str]]) -> bytes:
+    """Bloque HPACK sin estado: índice estático si hay coincidencia, si no literal sin indexar."""
+    salida = bytearray()
+    for nombre, valor in cabeceras:
+        indice = _INDICE_COMPLETO.get((nombre, valor))
+        if indice is not None:
+            salida += _codificar_entero(indice, 7, 0x80)
+            continue
+        indice = _INDICE_NOMBRE.get(nombre, 0)
+        salida += _codificar_entero(indice, 4, 0x00)
+        if not indice:
+            salida += _codificar_cadena(nombre)
+        salida += _codificar_cadena(valor)
+    return bytes(salida)
+
+
+# -- traducción a y desde HTTP/1.1 -----------------------------------------------
+
+
+def peticion_http1(cabeceras: List[Tuple[str, str]], cuerpo: bytes, stream: int) -> bytes:
+    """
+    Petición HTTP/1.1 equivalente a las cabeceras y el cuerpo de un stream.
+    Valida lo que RFC 7540 8.1.2 exige (pseudo-cabeceras, minúsculas, sin
+    cabeceras de conexión) y rechaza CR/LF/NUL, que romperían la traducción.
+    """
+    pseudo: Dict[str, str] = {}
+    normales: List[Tuple[str, str]] = []
+    cookies: List[str] = []
+    for nombre, valor in cabeceras:
+        if any(c in nombre or c in valor for c in "\r\n\0") or nombre != nombre.lower():
+            raise ErrorH2(PROTOCOL_ERROR, f"cabecera inválida: {nombre!r}", stream)
+        if nombre.startswith(":"):
+            if normales or nombre in pseudo or nombre not in {":method", ":path", ":scheme", ":authority"}:
+                raise ErrorH2(PROTOCOL_ERROR, f"pseudo-cabecera inválida: {nombre}", stream)
+            pseudo[nombre] = valor
+        elif nombre in _CABECERAS_DE_CONEXION or (nombre == "te" and valor != "trailers"):
+            raise ErrorH2(PROTOCOL_ERROR, f"cabecera de conexión en HTTP/2: {nombre}", stream)
+        elif nombre == "cookie":
+            # Las cookies pueden llegar troceadas en varias cabeceras (8.1.2.5)
+            cookies.append(valor)
+        elif nombre not in {"content-length", "host"}:
+            normales.append((nombre, valor))
+    metodo = pseudo.get(":method")
+    ruta = pseudo.get(":path")
+    if not metodo or not ruta or ":scheme" not in pseudo or " " in metodo or " " in ruta:
+        raise ErrorH2(PROTOCOL_ERROR, "faltan pseudo-cabeceras obligatorias", stream)
+
+    lineas = [f"{metodo} {ruta} HTTP/1.1", f"Host: {pseudo.get(':authority', '')}"]
+    lineas += [f"{nombre}: {valor}" for nombre, valor in normales]
+    if cookies:
+        lineas.append("cookie: " + "; ".join(cookies))
+    if cuerpo or metodo == "POST":
+        lineas.append(f"Content-Length: {len(cuerpo)}")
+    return ("\r\n".join(lineas) + "\r\n\r\n").encode("iso-8859-1") + cuerpo
+
+
+def respuesta_desde_http1(respuesta: bytes) -> Tuple[List[Tuple[str, str]], bytes]:
+    """Cabeceras HTTP/2 (con :status) y cuerpo de una respuesta HTTP/1.1 completa."""
+    cabecera, _, cuerpo = respuesta.partition(b"\r\n\r\n")
+    lineas = cabecera.decode("iso-8859-1").split("\r\n")
+    partes = lineas[0].split(" ", 2)
+    if len(partes) < 2 or not partes[1].isdigit():
+        raise ErrorH2(INTERNAL_ERROR, f"respuesta HTTP/1.1 inválida: {lineas[0]!r}")
+    cabeceras = [(":status", partes[1])]
+    for linea in lineas[1:]:
+        nombre, _, valor = linea.partition(":")
+        nombre = nombre.strip().lower()
+        if nombre and nombre not in _CABECERAS_DE_CONEXION:
+            cabeceras.append((nombre, valor.strip()))
+    return cabeceras, cuerpo
+
+
+# -- conexión -----------------------------------------------------------------
+
+
+class _Stream:
+    __slots__ = ("id", "bloque", "fin", "rechazado", "cabeceras", "cuerpo", "ventana", "pendiente", "respondido")
+
+    def __init__(self, stream_id: int, ventana: int) -> None:
+        self.id = stream_id
+        self.bloque = bytearray()  # HEADERS + CONTINUATION hasta END_HEADERS
+        self.fin = False  # END_STREAM del HEADERS cuyo bloque sigue en CONTINUATION
+        self.rechazado = False
+        self.cabeceras: Optional[List[Tuple[str, str]]] = None
+        self.cuerpo = bytearray()
+        self.ventana = ventana  # ventana de envío hacia el cliente
+        self.pendiente = b""  # cuerpo de la respuesta aún sin enviar
+        self.respondido = False
+
+
+class ConexionH2:
+    """
+    Una conexión HTTP/2 del lado servidor. `atender(peticion_http1) -> respuesta_http1`
+    resuelve cada stream completo; `parar` (opcional) cierra con GOAWAY al drenar.
+    Si la conexión se cierra por un límite, `cierre` guarda el motivo.
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        atender: Callable[[bytes], bytes],
+        max_peticion: int = 65536,
+        lectura: float = 2.0,
+        inactividad: float = IDLE_TIMEOUT,
+        parar: Optional[threading.Event] = None,
+        vida: float = MAX_LIFETIME,
+        min_ritmo: float = MIN_REQUEST_RATE,
+        plazo_frame: float = 10.0,
+    ) -> None:
+        self.sock = sock
+        self.atender = atender
+        self.max_peticion = max_peticion
+        self.lectura = lectura
+        self.inactividad = inactividad
+        self.parar = parar
+        self.min_ritmo = min_ritmo
+        self.plazo_frame = plazo_frame
+
+        self.decodificador = DecodificadorHPACK()
+        self.streams: Dict[int, _Stream] = {}
+        self.ultimo_stream = 0
+        self.en_cabeceras: Optional[_Stream] = None  # esperando CONTINUATION
+        self.ventana_conexion = VENTANA_INICIAL
+        self.ventana_inicial = VENTANA_INICIAL
+        self.frame_maximo = TAMANO_FRAME
+        self.peticiones = 0
+        self.inicio = time.monotonic()
+        self.fin_vida = self.inicio + vida
+        self.limite_inactividad = self.inicio + inactividad
+        # HEADERS/DATA recibidos desde la última petición completada
+        self.actividad_pendiente = False
+        self.recibidos = 0
+        self.cierre: Optional[str] = None
+        self._salida = bytearray()
+        self._entrada = bytearray()
+
+    # -- E/S ---------------------------------------------------------------------
+
+    def _frame(self, tipo: int, flags: int, stream: int, carga: bytes = b"") -> None:
+        longitud = len(carga)
+        self._salida += _FRAME.pack(longitud >> 8, longitud & 0xFF, tipo, flags, stream) + carga
+
+    def _vaciar(self) -> None:
+        if self._salida:
+            self.sock.sendall(self._salida)
+            self._salida.clear()
+
+    def _recibir(self, n: int, esperando_peticion: bool) -> Optional[bytes]:
+        """
+        Lee exactamente n bytes. Entre frames (`esperando_peticion`) se espera
+        hasta el límite de inactividad y se devuelve None al vencer o al parar
+        (LimiteH2 si había un stream a medias); un frame empezado debe
+        llegar entero en `plazo_frame`, con cada recv limitado al timeout de
+        lectura. Nada espera más allá de la vida máxima de la conexión.
+        """
+        inicio_frame: Optional[float] = None
+        while len(self._entrada) < n:
+            ahora = time.monotonic()
+            if ahora >= self.fin_vida:
+                raise LimiteH2("vida")
+            entre_frames = esperando_peticion and not self._entrada
+            if entre_frames:
+                restante = self.limite_inactividad - ahora
+                if restante <= 0 and self.actividad_pendiente:
+                    raise LimiteH2("inactividad")
+                if restante <= 0 or (self.parar is not None and self.parar.is_set()):
+                    return None
+                # Esperas cortas para notar `parar` sin retrasar el drenado
+                self.sock.settimeout(min(restante, 1.0, self.fin_vida - ahora))
+            else:
+                if inicio_frame is None:
+                    inicio_frame = ahora
+                restante = inicio_frame + self.plazo_frame - ahora
+                if restante <= 0:
+                    raise LimiteH2("frame")
+                self.sock.settimeout(min(self.lectura, restante, self.fin_vida - ahora))
+            try:
+                chunk = self.sock.recv(max(n - len(self._entrada), 16384))
+            except socket.timeout:
+                if entre_frames:
+                    continue
+                raise LimiteH2("lectura") from None
+            if not chunk:
+                raise ConnectionResetError("conexión cerrada por el cliente")
+            self.recibidos += len(chunk)
+            self._entrada += chunk
+        datos = bytes(self._entrada[:n])
+        del self._entrada[:n]
+        return datos
+
+    # -- bucle principal ----------------------------------------------------------
+
+    def ejecutar(self) -> None:
+        """Atiende la conexión hasta GOAWAY, inactividad, error o cierre del cliente."""
+        try:
+            if self._recibir(len(PREFACIO), True) != PREFACIO:
+                raise ErrorH2(PROTOCOL_ERROR, "prefacio de conexión inválido")
+            self._frame(
+                SETTINGS,
+                0,
+                0,
+                struct.pack(
+                    "!HIHIHI",
+                    SETTINGS_MAX_CONCURRENT_STREAMS,
+                    MAX_CONCURRENT_STREAMS,
+                    SETTINGS_ENABLE_PUSH,
+                    0,
+                    SETTINGS_MAX_HEADER_LIST_SIZE,
+                    self.max_peticion,
+                ),
+            )
+            self._vaciar()
+            while True:
+                cabecera = self._recibir(9, self.en_cabeceras is None)
+                if cabecera is None:
+                    self._cerrar(NO_ERROR)
+                    return
+                alto, bajo, tipo, flags, stream = _FRAME.unpack(cabecera)
+                longitud = (alto << 8) | bajo
+                stream &= 0x7FFFFFFF
+                if longitud > TAMANO_FRAME:
+                    raise ErrorH2(FRAME_SIZE_ERROR, f"frame de {longitud} bytes")
+                carga = self._recibir(longitud, False) if longitud else b""
+                try:
+                    if not self._procesar(tipo, flags, stream, carga):
+                        self._cerrar(NO_ERROR)
+                        return
+                except ErrorH2 as exc:
+                    if not exc.stream:
+                        raise
+                    logging.info("[HTTP2] Stream %d reiniciado: %s", exc.stream, exc)
+                    self.streams.pop(exc.stream, None)
+                    self._frame(RST_STREAM, 0, exc.stream, struct.pack("!I", exc.codigo))
+                self._enviar_pendientes()
+                self._vaciar()
+                if self.peticiones >= MAX_REQUESTS and not self.streams:
+                    self._cerrar(NO_ERROR)
+                    return
+                self._comprobar_ritmo()
+        except LimiteH2 as exc:
+            self.cierre = exc.motivo
+            logging.info("[HTTP2] Conexión cerrada por límite (%s) tras %d peticiones", exc.motivo, self.peticiones)
+            self._cerrar(NO_ERROR if exc.motivo == "vida" else ENHANCE_YOUR_CALM)
+        except ErrorH2 as exc:
+            logging.warning("[HTTP2] Error de protocolo (código %d): %s", exc.codigo, exc)
+            self._cerrar(exc.codigo)
+        except OSError as exc:
+            logging.debug("[HTTP2] Conexión terminada: %s", exc)
+
+    def _comprobar_ritmo(self) -> None:
+        """Pasado el margen inicial, exige MIN_RATE peticiones completadas por minuto."""
+        transcurrido = time.monotonic() - self.inicio
+        if (
+            self.min_ritmo > 0
+            and transcurrido > self.inactividad
+            and self.peticiones < self.min_ritmo * transcurrido / 60.0
+        ):
+            raise LimiteH2("ritmo")
+
+    def _cerrar(self, codigo: int) -> None:
+        try:
+            self._frame(GOAWAY, 0, 0, struct.pack("!II", self.ultimo_stream, codigo))
+            self._vaciar()
+        except OSError:
+            pass
+
+    # -- frames ---------------------------------------------------------------------
+
+    def _procesar(self, tipo: int, flags: int, stream: int, carga: bytes) -> bool:
+        """Aplica un frame recibido; False si el cliente cerró (GOAWAY)."""
+        if self.en_cabeceras is not None and (tipo != CONTINUATION or stream != self.en_cabeceras.id):
+            raise ErrorH2(PROTOCOL_ERROR, "se esperaba CONTINUATION")
+
+        if tipo == DATA:
+            self._datos(flags, stream, carga)
+        elif tipo == HEADERS:
+            self._cabeceras(flags, stream, carga)
+        elif tipo == CONTINUATION:
+            if self.en_cabeceras is None:
+                raise ErrorH2(PROTOCOL_ERROR, "CONTINUATION inesperado")
+            self._bloque(self.en_cabeceras, carga, flags)
+        elif tipo == SETTINGS:
+            if stream:
+                raise ErrorH2(PROTOCOL_ERROR, "SETTINGS en un stream")
+            if not flags & FLAG_ACK:
+                self._settings(carga)
+                self._frame(SETTINGS, FLAG_ACK, 0)
+        elif tipo == PING:
+            if stream or len(carga) != 8:
+                raise ErrorH2(PROTOCOL_ERROR, "PING inválido")
+            if not flags & FLAG_ACK:
+                self._frame(PING, FLAG_ACK, 0, carga)
+        elif tipo == WINDOW_UPDATE:
+            self._window_update(stream, carga)
+        elif tipo == RST_STREAM:
+            if not stream or len(carga) != 4:
+                raise ErrorH2(PROTOCOL_ERROR, "RST_STREAM inválido")
+            self.streams.pop(stream, None)
+        elif tipo == GOAWAY:
+            return False
+        elif tipo == PUSH_PROMISE:
+            raise ErrorH2(PROTOCOL_ERROR, "PUSH_PROMISE de un cliente")
+        # PRIORITY y tipos desconocidos se ignoran
+        return True
+
+    @staticmethod
+    def _sin_relleno(flags: int, carga: bytes) -> bytes:
+        if not flags & FLAG_PADDED:
+            return carga
+        if not carga or carga[0] >= len(carga):
+            raise ErrorH2(PROTOCOL_ERROR, "relleno mayor que el frame")
+        return carga[1:len(carga) - carga[0]]
+
+    def _cabeceras(self, flags: int, stream_id: int, carga: bytes) -> None:
+        if not stream_id % 2:
+            raise ErrorH2(PROTOCOL_ERROR, f"stream de cliente par: {stream_id}")
+        carga = self._sin_relleno(flags, carga)
+        if flags & FLAG_PRIORITY:
+            carga = carga[5:]
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            if stream_id <= self.ultimo_stream:
+                raise ErrorH2(STREAM_CLOSED, f"HEADERS en stream cerrado {stream_id}")
+            self.ultimo_stream = stream_id
+            stream = _Stream(stream_id, self.ventana_inicial)
+            if len(self.streams) >= MAX_CONCURRENT_STREAMS:
+                # El bloque se decodifica igualmente para no desincronizar HPACK
+                stream.rechazado = True
+            else:
+                self.streams[stream_id] = stream
+        elif stream.respondido:
+            raise ErrorH2(PROTOCOL_ERROR, f"HEADERS inesperado en stream {stream_id}")
+        # Con el stream ya abierto son trailers: solo cierran el cuerpo
+        self.actividad_pendiente = True
+        self._bloque(stream, carga, flags)
+
+    def _bloque(self, stream: _Stream, carga: bytes, flags: int) -> None:
+        stream.bloque += carga
+        if len(stream.bloque) > self.max_peticion:
+            raise ErrorH2(PROTOCOL_ERROR, "bloque de cabeceras demasiado grande")
+        # END_STREAM viaja en el HEADERS, no en CONTINUATION: se recuerda en el stream
+        if flags & FLAG_END_STREAM:
+            stream.fin = True
+        if not flags & FLAG_END_HEADERS:
+            self.en_cabeceras = stream
+            return
+        self.en_cabeceras = None
+        cabeceras = self.decodificador.decodificar(bytes(stream.bloque))
+        stream.bloque.clear()
+        if stream.rechazado:
+            raise ErrorH2(REFUSED_STREAM, "demasiados streams abiertos", stream.id)
+        if stream.cabeceras is None:
+            stream.cabeceras = cabeceras
+        if stream.fin:
+            self._completar(stream)
+
+    def _datos(self, flags: int, stream_id: int, carga: bytes) -> None:
+        if not stream_id:
+            raise ErrorH2(PROTOCOL_ERROR, "DATA en el stream 0")
+        # Todo DATA cuenta para el control de flujo aunque el stream ya no exista
+        self._reponer_ventana(len(carga))
+        self.actividad_pendiente = True
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.cabeceras is None or stream.respondido:
+            raise ErrorH2(STREAM_CLOSED, f"DATA en stream cerrado {stream_id}", stream_id)
+        stream.cuerpo += self._sin_relleno(flags, carga)
+        if len(stream.cuerpo) > self.max_peticion:
+            raise ErrorH2(REFUSED_STREAM, "cuerpo demasiado grande", stream_id)
+        if flags & FLAG_END_STREAM:
+            self._completar(stream)
+        elif carga:
+            self._frame(WINDOW_UPDATE, 0, stream_id, struct.pack("!I", len(carga)))
+
+    def _reponer_ventana(self, n: int) -> None:
+        """Repone en el acto la ventana de conexión consumida por un DATA."""
+        if n:
+            self._frame(WINDOW_UPDATE, 0, 0, struct.pack("!I", n))
+
+    def _settings(self, carga: bytes) -> None:
+        if len(carga) % 6:
+            raise ErrorH2(FRAME_SIZE_ERROR, "SETTINGS de longitud inválida")
+        for ident, valor in struct.iter_unpack("!HI", carga):
+            if ident == SETTINGS_INITIAL_WINDOW_SIZE:
+                if valor > VENTANA_MAXIMA:
+                    raise ErrorH2(FLOW_CONTROL_ERROR, "ventana inicial fuera de rango")
+                # El cambio se aplica también a los streams abiertos (6.9.2)
+                delta = valor - self.ventana_inicial
+                self.ventana_inicial = valor
+                for stream in self.streams.values():
+                    stream.ventana += delta
+            elif ident == SETTINGS_MAX_FRAME_SIZE:
+                if not TAMANO_FRAME <= valor <= 2**24 - 1:
+                    raise ErrorH2(PROTOCOL_ERROR, "tamaño de frame fuera de rango")
+                self.frame_maximo = valor
+            elif ident == SETTINGS_ENABLE_PUSH and valor > 1:
+                raise ErrorH2(PROTOCOL_ERROR, "ENABLE_PUSH inválido")
+            # HEADER_TABLE_SIZE del cliente no nos afecta: el codificador no indexa
+
+    def _window_update(self, stream_id: int, carga: bytes) -> None:
+        if len(carga) != 4:
+            raise ErrorH2(FRAME_SIZE_ERROR, "WINDOW_UPDATE de longitud inválida")
+        incremento = struct.unpack("!I", carga)[0] & 0x7FFFFFFF
+        if not incremento:
+            raise ErrorH2(PROTOCOL_ERROR, "WINDOW_UPDATE de 0", stream_id)
+        if not stream_id:
+            self.ventana_conexion += incremento
+            if self.ventana_conexion > VENTANA_MAXIMA:
+                raise ErrorH2(FLOW_CONTROL_ERROR, "ventana de conexión desbordada")
+            return
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            stream.ventana += incremento
+            if stream.ventana > VENTANA_MAXIMA:
+                raise ErrorH2(FLOW_CONTROL_ERROR, "ventana de stream desbordada", stream_id)
+
+    # -- peticiones y respuestas ----------------------------------------------------
+
+    def _completar(self, stream: _Stream) -> None:
+        """El cliente terminó de enviar: se atiende y se encola la respuesta."""
+        peticion = peticion_http1(stream.cabeceras or [], bytes(stream.cuerpo), stream.id)
+        stream.cuerpo = bytearray()
+        self.peticiones += 1
+        try:
+            respuesta = self.atender(peticion)
+            cabeceras, cuerpo = respuesta_desde_http1(respuesta)
+        except ErrorH2 as exc:
+            raise ErrorH2(exc.codigo, str(exc), stream.id) from None
+        except Exception as exc:  # noqa: BLE001
+            logging.exception("[HTTP2] Error atendiendo el stream %d: %s", stream.id, exc)
+            raise ErrorH2(INTERNAL_ERROR, "error interno", stream.id) from None
+        stream.respondido = True
+        bloque = codificar_cabeceras(cabeceras)
+        # Cabeceras en HEADERS + CONTINUATION según el tamaño de frame del cliente
+        trozos = [bloque[i:i + self.frame_maximo] for i in range(0, len(bloque), self.frame_maximo)] or [b""]
+        for i, trozo in enumerate(trozos):
+            flags = FLAG_END_HEADERS if i == len(trozos) - 1 else 0
+            if i == 0 and not cuerpo:
+                flags |= FLAG_END_STREAM
+            self._frame(HEADERS if i == 0 else CONTINUATION, flags, stream.id, trozo)
+        if cuerpo:
+            stream.pendiente = cuerpo
+        else:
+            del self.streams[stream.id]
+        # Solo una petición completada alarga la conexión
+        self.limite_inactividad = time.monotonic() + self.inactividad
+        self.actividad_pendiente = False
+
+    def _enviar_pendientes(self) -> None:
+        """Envía todo el cuerpo de respuesta que permitan las ventanas del cliente."""
+        for stream in list(self.streams.values()):
+            while stream.pendiente and self.ventana_conexion > 0 and stream.ventana > 0:
+                n = min(len(stream.pendiente), self.ventana_conexion, stream.ventana, self.frame_maximo)
+                trozo, stream.pendiente = stream.pendiente[:n], stream.pendiente[n:]
+                self.ventana_conexion -= n
+                stream.ventana -= n
+                self._frame(DATA, 0 if stream.pendiente else FLAG_END_STREAM, stream.id, trozo)
+            if stream.respondido and not stream.pendiente:
+                del self.streams[stream.id]
+
+
+def atender_conexion(
+    sock: socket.socket,
+    atender: Callable[[bytes], bytes],
+    max_peticion: int = 65536,
+    lectura: float = 2.0,
+    parar: Optional[threading.Event] = None,
+    plazo_frame: float = 10.0,
+    al_limite: Optional[Callable[[str, int, float], None]] = None,
+    inactividad: float = IDLE_TIMEOUT,
+) -> int:
+    """
+    Atiende una conexión ya negociada como "h2"; devuelve cuántas peticiones llevó.
+    Si se cierra por un límite llama a `al_limite(motivo, bytes recibidos, segundos)`.
+    """
+    conexion = ConexionH2(
+        sock,
+        atender,
+        max_peticion=max_peticion,
+        lectura=lectura,
+        parar=parar,
+        inactividad=inactividad,
+        plazo_frame=plazo_frame,
+    )
+    conexion.ejecutar()
+    if conexion.cierre and al_limite is not None:
+        al_limite(conexion.cierre, conexion.recibidos, time.monotonic() - conexion.inicio)
+    return conexion.peticiones
+
+
+if __name__ == "__main__":
+    # Prueba manual de HPACK con los ejemplos de RFC 7541 (C.4, con Huffman):
+    #   python3 src/http2.py
+    # Para la conexión completa: PORTAL_ENABLE_TLS=1 ... y `curl -kv --http2 https://.../ https://.../login`
+    decodificador = DecodificadorHPACK()
+    for ejemplo in ("828684418cf1e3c2e5f23a6ba0ab90f4ff", "828684be5886a8eb10649cbf"):
+        print(decodificador.decodificar(bytes.fromhex(ejemplo)))
+    print("tabla dinámica:", list(decodificador.tabla), f"({decodificador.tamano} bytes)")
+    bloque = codificar_cabeceras([(":status", "200"), ("content-type", "text/html; charset=utf-8"), ("content-length", "3864")])
+    print(f"respuesta codificada ({len(bloque)} bytes):", decodificador.decodificar(bloque))
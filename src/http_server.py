@@ -5,33 +5,58 @@ Servidor HTTP del portal cautivo.
 - Sirve múltiples plantillas HTML desde src/templates/ según la ruta solicitada.
 - GET /          → index.html
 - GET /login     → login.html (formulario de autenticación)
+- GET /status    → JSON con el estado de la sesión de la IP que consulta
+- Cookie de sesión firmada (session_tokens): /status, /logout y /success la
+  validan sin consultar el almacén de sesiones
 - POST /login    → procesa credenciales enviadas por formulario
-- Autenticación correcta   → login_success.html
-- Autenticación incorrecta → login_error.html
+- Autenticación correcta   → login_success.html (personalizada con usuario/expiración)
+- Autenticación incorrecta → login_error.html (personalizada con el motivo)
 - Manejo básico de errores: 400, 404, 405 y 500.
 """
 
 
+import json
 import logging
 import os
+import select
+import signal
 import socket
-from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import sys
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
 import threading
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Iterable, Optional, Tuple
 import ssl
 
 from urllib.parse import parse_qs
-from auth import load_users, authenticate, UserLoadError, UsersDict
+from auth import AuthBackend, AuthBackendError, authenticate, crear_backend, load_users, UserLoadError, UsersDict
 
 
 from sessions import (
+    actualizar_contadores,
+    cargar_sesiones,
     crear_sesion,
     eliminar_sesion,
     eliminar_sesiones_por_ip,
     limpiar_sesiones_expiradas,
+    obtener_sesion_por_ip,
+    reconciliar_firewall,
 )  # o import sessions
+from adaptive_pool import AdaptiveExecutor
+import admin_socket
 import arp_lookup
+import captive_dns
+import dhcp_leases
+import http2
+import neighbor_monitor
+import profiling
+import replication
+import session_tokens
+import traffic_shaping
+import traffic_trace
+from template_engine import CompiledTemplate, compile_template
 
 import firewall_dynamic
 
@@ -41,14 +66,51 @@ import firewall_dynamic
 HOST = os.getenv("PORTAL_HTTP_HOST", "0.0.0.0")
 PORT = int(os.getenv("PORTAL_HTTP_PORT", "8080"))
 # Número máximo de hilos para atender clientes (concurrencia)
-MAX_WORKERS = int(os.getenv("PORTAL_HTTP_WORKERS", "16"))
+MAX_WORKERS = max(1, int(os.getenv("PORTAL_HTTP_WORKERS", "16")))
+# Pool adaptable: mínimo de hilos y criterios para crecer/reducir (0 = pool fijo de MAX_WORKERS)
+POOL_ADAPTIVE = os.getenv("PORTAL_HTTP_POOL_ADAPTIVE", "1").strip().lower() in {"1", "true", "yes", "on"}
+MIN_WORKERS = max(1, min(MAX_WORKERS, int(os.getenv("PORTAL_HTTP_WORKERS_MIN", "4"))))
+POOL_TARGET_WAIT = float(os.getenv("PORTAL_HTTP_POOL_TARGET_WAIT", "0.05"))
+POOL_LOW_UTILIZATION = float(os.getenv("PORTAL_HTTP_POOL_LOW_UTIL", "0.3"))
+POOL_INTERVAL = float(os.getenv("PORTAL_HTTP_POOL_INTERVAL", "1"))
+# Conexiones HTTP/2 que pueden ocupar un hilo a la vez; por encima se atienden las
+# peticiones ya enviadas y se cierran enseguida (siempre quedan hilos para HTTP/1.1)
+HTTP2_MAX_CONNECTIONS = max(
+    1, min(MAX_WORKERS - 1 or 1, int(os.getenv("PORTAL_HTTP2_MAX_CONNECTIONS", str(MAX_WORKERS // 2))))
+)
+HTTP2_OVERFLOW_IDLE = 0.5
 # Límite de bytes a leer de la petición (cabeceras + body) para evitar consumo desmedido
 MAX_REQUEST_BYTES = int(os.getenv("PORTAL_HTTP_MAX_REQUEST", "65536"))
+# Plazos absolutos por conexión (segundos): cabeceras (incluye el handshake TLS) y cuerpo
+HEADER_TIMEOUT = float(os.getenv("PORTAL_HTTP_HEADER_TIMEOUT", "10"))
+BODY_TIMEOUT = float(os.getenv("PORTAL_HTTP_BODY_TIMEOUT", "10"))
+# Espera máxima entre dos lecturas (además del plazo absoluto)
+RECV_IDLE_TIMEOUT = float(os.getenv("PORTAL_HTTP_IDLE_TIMEOUT", "2"))
+# Ritmo mínimo de recepción (bytes/s; 0 = sin mínimo), exigido tras un margen inicial
+MIN_TRANSFER_RATE = float(os.getenv("PORTAL_HTTP_MIN_RATE", "100"))
+MIN_RATE_GRACE = float(os.getenv("PORTAL_HTTP_MIN_RATE_GRACE", "2"))
 TLS_ENABLED = os.getenv("PORTAL_ENABLE_TLS", "0").strip().lower() in {"1", "true", "yes", "on"}
 TLS_CERT_FILE = os.getenv("PORTAL_TLS_CERT")
 TLS_KEY_FILE = os.getenv("PORTAL_TLS_KEY")
 TLS_CIPHERS = os.getenv("PORTAL_TLS_CIPHERS")
 SESSION_CLEANUP_INTERVAL = int(os.getenv("PORTAL_SESSION_CLEANUP_INTERVAL", "30"))
+# Cada cuántos segundos se reconcilian reglas de firewall y sesiones (<= 0 deshabilita)
+FIREWALL_RECONCILE_INTERVAL = int(os.getenv("PORTAL_FIREWALL_RECONCILE_INTERVAL", "60"))
+# Cada cuántos segundos se leen los contadores de tráfico por sesión (<= 0 deshabilita)
+ACCOUNTING_INTERVAL = int(os.getenv("PORTAL_ACCOUNTING_INTERVAL", "60"))
+# Backlog del socket de escucha (absorbe conexiones durante una recarga en caliente)
+LISTEN_BACKLOG = int(os.getenv("PORTAL_HTTP_BACKLOG", "128"))
+
+# Recarga en caliente (SIGHUP): el socket de escucha se hereda por descriptor
+RELOAD_SIGNAL = getattr(signal, "SIGHUP", None)
+# Segundos que la instancia anterior espera a que la nueva confirme que está lista
+RELOAD_READY_TIMEOUT = float(os.getenv("PORTAL_RELOAD_READY_TIMEOUT", "15"))
+# Archivo KEY=VALUE opcional con variables de entorno nuevas para la instancia recargada
+RELOAD_ENV_FILE = os.getenv("PORTAL_RELOAD_ENV_FILE")
+LISTEN_FD_ENV = "PORTAL_LISTEN_FD"
+READY_FD_ENV = "PORTAL_READY_FD"
+GO_FD_ENV = "PORTAL_GO_FD"
+RELOAD_HANDOFF_ENV = "PORTAL_RELOAD_HANDOFF"
 
 # Directorios de plantillas
 BASE_DIR = Path(__file__).resolve().parent
@@ -70,16 +132,39 @@ TEMPLATE_ROUTE_MAP = {
     "/logout": LOGOUT_TEMPLATE,
 }
 
+# Rutas que la traza de tráfico graba por su nombre (el resto, como "otra")
+RUTAS_TRAZA = frozenset(TEMPLATE_ROUTE_MAP) | {"/login", "/logout", "/status"}
+
 # RUTAS PARA EL LOGGING
 REPO_ROOT = BASE_DIR.parent
 LOGS_DIR = REPO_ROOT / "logs" # La carpeta 'logs' estará un nivel arriba de 'src'
 LOG_FILE = LOGS_DIR / "portal_captivo.log"
 
 
-# Cache en memoria de plantillas cargadas (route -> bytes)
+# Cache en memoria de plantillas cargadas (route -> bytes ya renderizados con valores por defecto)
 TEMPLATE_CACHE: dict[str, bytes] = {}
+# Plantillas precompiladas (route -> fragmentos + huecos) para respuestas personalizadas
+COMPILED_TEMPLATES: dict[str, CompiledTemplate] = {}
+# Valores usados al servir las plantillas por GET (sin datos de una petición concreta)
+TEMPLATE_DEFAULTS: dict[str, dict[str, str]] = {
+    "/success": {
+        "username": "-",
+        "login_time": "-",
+        "expires_at": "-",
+        "remaining": "-",
+    },
+    "/error": {
+        "reason": "El usuario o la contraseña no coinciden con el registro del portal.",
+    },
+}
+# Motivos de error mostrados en login_error.html
+LOGIN_ERROR_BAD_CREDENTIALS = "El usuario o la contraseña no coinciden con el registro del portal."
+LOGIN_ERROR_EMPTY_FIELDS = "Debes indicar usuario y contraseña para iniciar sesión."
+LOGIN_ERROR_BACKEND = "El servicio de autenticación no responde. Inténtalo de nuevo en unos segundos."
 # Usuarios cargados en memoria (solo-lectura después de cargar)
 USERS: UsersDict = {}
+# Backend de autenticación (auth.crear_backend en run_server); None = USERS directamente
+AUTH_BACKEND: Optional[AuthBackend] = None
 
 # Plantillas de cabecera HTTP
 HTTP_OK_TEMPLATE = (
@@ -90,6 +175,19 @@ HTTP_OK_TEMPLATE = (
     "\r\n"
 )
 
+# Respuesta JSON (endpoint /status); no debe cachearse en el cliente
+HTTP_JSON_TEMPLATE = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: application/json\r\n"
+    "Content-Length: {length}\r\n"
+    "Cache-Control: no-store\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+)
+
+# Atributos de la cookie de sesión (Secure se añade con TLS)
+SESSION_COOKIE_ATTRS = "Path=/; HttpOnly; SameSite=Lax"
+
 # HTTP 405 ahora usa placeholder para Allow, se rellenará donde corresponda.
 HTTP_405_TEMPLATE = (
     "HTTP/1.1 405 Method Not Allowed\r\n"
@@ -124,6 +222,116 @@ HTTP_500_TEMPLATE = (
     "\r\n"
 )
 
+HTTP_408_RESPONSE = (
+    b"HTTP/1.1 408 Request Timeout\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+)
+
+
+class SlowClientError(Exception):
+    """El cliente no completó una fase de la petición a tiempo o a ritmo suficiente."""
+
+    def __init__(self, fase: str, motivo: str, recibidos: int, transcurrido: float) -> None:
+        super().__init__(f"{fase}: {motivo} ({recibidos} bytes en {transcurrido:.1f}s)")
+        self.fase = fase
+        self.motivo = motivo
+        self.recibidos = recibidos
+        self.transcurrido = transcurrido
+
+
+class ReadDeadline:
+    """
+    Plazo absoluto y ritmo mínimo para una fase de lectura de una conexión
+    (plano o TLS). Cada recv espera como mucho RECV_IDLE_TIMEOUT o lo que
+    quede del plazo; al vencer el plazo o caer por debajo de MIN_TRANSFER_RATE
+    se lanza SlowClientError.
+    """
+
+    __slots__ = ("fase", "inicio", "limite", "recibidos")
+
+    def __init__(self, fase: str, duracion: float) -> None:
+        self.fase = fase
+        self.inicio = time.monotonic()
+        self.limite = self.inicio + duracion
+        self.recibidos = 0
+
+    def error(self, motivo: str) -> SlowClientError:
+        return SlowClientError(self.fase, motivo, self.recibidos, time.monotonic() - self.inicio)
+
+    def aplicar_timeout(self, conn: socket.socket) -> None:
+        """Ajusta el timeout del socket al menor entre la espera por lectura y el plazo restante."""
+        restante = self.limite - time.monotonic()
+        if restante <= 0:
+            raise self.error("plazo")
+        conn.settimeout(min(RECV_IDLE_TIMEOUT, restante))
+
+    def recv(self, conn: socket.socket, n: int) -> bytes:
+        self.aplicar_timeout(conn)
+        try:
+            chunk = conn.recv(n)
+        except socket.timeout:
+            raise self.error("plazo" if time.monotonic() >= self.limite else "inactividad") from None
+        self.recibidos += len(chunk)
+        transcurrido = time.monotonic() - self.inicio
+        if (
+            chunk
+            and MIN_TRANSFER_RATE > 0
+            and transcurrido > MIN_RATE_GRACE
+            and self.recibidos < MIN_TRANSFER_RATE * transcurrido
+        ):
+            raise self.error("ritmo")
+        return chunk
+
+
+# Conexiones cerradas por lentas: "fase:motivo" -> número (desde el arranque)
+_slow_clients: dict[str, int] = {}
+_slow_clients_lock = threading.Lock()
+
+
+def _contar_cliente_lento(exc: SlowClientError, ip: str) -> None:
+    clave = f"{exc.fase}:{exc.motivo}"
+    with _slow_clients_lock:
+        _slow_clients[clave] = _slow_clients.get(clave, 0) + 1
+        total = sum(_slow_clients.values())
+    logging.warning("Conexión lenta cerrada desde %s: %s (total cerradas: %d)", ip, exc, total)
+
+
+def obtener_metricas_conexiones() -> dict[str, int]:
+    """Copia de los contadores de conexiones cerradas por plazo, inactividad o ritmo."""
+    with _slow_clients_lock:
+        return dict(_slow_clients)
+
+
+# Pool de hilos en uso (para consultar su tamaño y sus decisiones)
+_pool: Optional[Executor] = None
+# Al dejar de aceptar (parada o recarga) las conexiones HTTP/2 abiertas cierran con GOAWAY
+_DRENAR_H2 = threading.Event()
+_CUPOS_H2 = threading.BoundedSemaphore(HTTP2_MAX_CONNECTIONS)
+
+
+def _crear_pool() -> Executor:
+    """Pool que atiende las conexiones: adaptable (por defecto) o fijo como antes."""
+    global _pool
+    if POOL_ADAPTIVE:
+        _pool = AdaptiveExecutor(
+            MIN_WORKERS,
+            MAX_WORKERS,
+            espera_objetivo=POOL_TARGET_WAIT,
+            utilizacion_baja=POOL_LOW_UTILIZATION,
+            intervalo=POOL_INTERVAL,
+        )
+    else:
+        _pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _pool
+
+
+def obtener_metricas_pool() -> dict[str, float]:
+    """Tamaño, ocupación y decisiones del pool adaptable (vacío con pool fijo)."""
+    pool = _pool
+    return pool.metricas() if isinstance(pool, AdaptiveExecutor) else {}
+
 
 def _build_tls_context() -> Optional[ssl.SSLContext]:
     """
@@ -162,17 +370,152 @@ def _build_tls_context() -> Optional[ssl.SSLContext]:
         logging.error("No se pudo cargar el certificado/llave TLS: %s", exc)
         raise SystemExit(1) from exc
 
+    # HTTP/2 por ALPN (PORTAL_HTTP2): una conexión para página, recursos y POST
+    if http2.ENABLED:
+        context.set_alpn_protocols(["h2", "http/1.1"])
+
     return context
 
 
+def _install_signal_handler(signum: Optional[int], handler) -> None:
+    """Registra un manejador de señal si la plataforma lo permite (solo hilo principal)."""
+    if signum is None:
+        return
+    try:
+        signal.signal(signum, handler)
+    except (ValueError, OSError) as exc:
+        logging.warning("No se pudo registrar el manejador de la señal %s: %s", signum, exc)
+
+
+def _open_listen_socket(host: str, port: int) -> socket.socket:
+    """
+    Devuelve el socket de escucha: el heredado de la instancia anterior
+    (PORTAL_LISTEN_FD) o uno nuevo enlazado a host:port.
+    """
+    inherited_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if inherited_fd:
+        sock = socket.socket(fileno=int(inherited_fd))
+        logging.info("Socket de escucha heredado de la instancia anterior (fd=%s)", inherited_fd)
+        return sock
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)  # backlog decente para picos breves y recargas
+    return sock
+
+
+def _notify_predecessor_ready() -> None:
+    """Escribe en el pipe de la instancia anterior (si existe) que ya estamos aceptando."""
+    ready_fd = os.environ.pop(READY_FD_ENV, None)
+    os.environ.pop(RELOAD_HANDOFF_ENV, None)
+    if not ready_fd:
+        return
+    try:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+    except OSError as exc:
+        logging.warning("No se pudo notificar a la instancia anterior: %s", exc)
+
+
+def _esperar_turno() -> bool:
+    """
+    En una recarga, espera a que la instancia anterior deje de aceptar y drene
+    (o termine). Devuelve True si veníamos de una recarga.
+    """
+    go_fd = os.environ.pop(GO_FD_ENV, None)
+    if not go_fd:
+        return False
+    try:
+        os.read(int(go_fd), 1)  # b"1" o EOF si la anterior murió
+        os.close(int(go_fd))
+    except OSError as exc:
+        logging.warning("No se pudo esperar a la instancia anterior: %s", exc)
+    return True
+
+
+def _read_env_file(path: str) -> dict[str, str]:
+    """Lee un archivo KEY=VALUE (ignora líneas vacías y comentarios)."""
+    values: dict[str, str] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for raw_line in f:
+            line = raw_line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            values[key.strip()] = value.strip()
+    return values
+
+
+def _spawn_successor(server_sock: socket.socket) -> Optional[int]:
+    """
+    Lanza una nueva instancia del portal que hereda el socket de escucha
+    mientras esta sigue aceptando. La nueva arranca todo (sesiones sin
+    reaplicar el firewall, subsistemas) y avisa; después espera a que esta le
+    dé paso con _dar_paso_sucesor() para releer las sesiones y aceptar.
+    Devuelve el fd para darle paso si confirmó el arranque, o None.
+    """
+    listen_fd = server_sock.fileno()
+    read_fd, write_fd = os.pipe()
+    go_read_fd, go_write_fd = os.pipe()
+
+    env = dict(os.environ)
+    if RELOAD_ENV_FILE:
+        try:
+            env.update(_read_env_file(RELOAD_ENV_FILE))
+        except OSError as exc:
+            logging.warning("No se pudo leer PORTAL_RELOAD_ENV_FILE=%s: %s", RELOAD_ENV_FILE, exc)
+    env[LISTEN_FD_ENV] = str(listen_fd)
+    env[READY_FD_ENV] = str(write_fd)
+    env[GO_FD_ENV] = str(go_read_fd)
+    env[RELOAD_HANDOFF_ENV] = "1"
+
+    cmd = [sys.executable, str(Path(__file__).resolve())] + sys.argv[1:]
+    try:
+        proc = subprocess.Popen(cmd, env=env, pass_fds=(listen_fd, write_fd, go_read_fd))
+    except OSError as exc:
+        logging.error("No se pudo lanzar la nueva instancia: %s", exc)
+        for fd in (read_fd, write_fd, go_read_fd, go_write_fd):
+            os.close(fd)
+        return None
+    os.close(write_fd)
+    os.close(go_read_fd)
+
+    try:
+        readable, _, _ = select.select([read_fd], [], [], RELOAD_READY_TIMEOUT)
+        ready = bool(readable) and os.read(read_fd, 1) == b"1"
+    finally:
+        os.close(read_fd)
+
+    if ready:
+        logging.info("Nueva instancia (pid %d) lista; esta deja de aceptar y drena.", proc.pid)
+        return go_write_fd
+
+    logging.error("La nueva instancia (pid %d) no respondió en %.0fs; se detiene.", proc.pid, RELOAD_READY_TIMEOUT)
+    os.close(go_write_fd)
+    proc.terminate()
+    return None
+
+
+def _dar_paso_sucesor(go_fd: int) -> None:
+    """Avisa a la nueva instancia de que esta ya no acepta y terminó de drenar."""
+    try:
+        os.write(go_fd, b"1")
+    except OSError as exc:
+        logging.warning("No se pudo dar paso a la nueva instancia: %s", exc)
+    finally:
+        os.close(go_fd)
+
+
 def _lookup_mac_for_ip(ip: str) -> Optional[str]:
     """
-    Devuelve la MAC asociada a la IP consultando la tabla ARP.
+    Devuelve la MAC asociada a la IP (concesiones DHCP o tabla ARP).
     """
     try:
         mac = arp_lookup.get_mac(ip)
         if mac:
-            logging.info("MAC encontrada para %s : %s", ip, mac)
+            hostname = dhcp_leases.obtener_hostname(ip)
+            logging.info("MAC encontrada para %s : %s%s", ip, mac, f" ({hostname})" if hostname else "")
         else:
             logging.info("No se encontró MAC para %s; continuará solo con IP", ip)
         return mac
@@ -202,16 +545,76 @@ def load_template(path: Path, fallback_message: str = "Plantilla no encontrada")
 
 def fill_template_cache() -> None:
     """
-    Carga en memoria todas las plantillas definidas en TEMPLATE_ROUTE_MAP.
+    Carga y compila en memoria todas las plantillas definidas en TEMPLATE_ROUTE_MAP.
+    TEMPLATE_CACHE guarda la versión ya renderizada con TEMPLATE_DEFAULTS (GET estático).
     Safe to call at startup.
     """
     for route, p in TEMPLATE_ROUTE_MAP.items():
+        if route not in COMPILED_TEMPLATES:
+            raw = load_template(p, f"No se encontró {p.name}")
+            COMPILED_TEMPLATES[route] = compile_template(raw, p.name)
         if route not in TEMPLATE_CACHE:
-            TEMPLATE_CACHE[route] = load_template(p, f"No se encontró {p.name}")
+            TEMPLATE_CACHE[route] = COMPILED_TEMPLATES[route].render(TEMPLATE_DEFAULTS.get(route))
     logging.info("Plantillas pre-cargadas: %s", ", ".join(sorted(set(TEMPLATE_CACHE.keys()))))
 
 
-def read_post_body_and_parse(initial_data: bytes, conn: socket.socket) -> dict:
+def render_template_chunks(route: str, values: dict, fallback: bytes) -> list[bytes]:
+    """
+    Devuelve los fragmentos de la plantilla precompilada de `route` rellenos con `values`
+    (los huecos sin valor toman el de TEMPLATE_DEFAULTS).
+    Si la plantilla no está compilada, devuelve [fallback].
+    """
+    compiled = COMPILED_TEMPLATES.get(route)
+    if compiled is None:
+        return [fallback]
+    defaults = TEMPLATE_DEFAULTS.get(route)
+    if defaults:
+        values = {**defaults, **values}
+    return compiled.render_chunks(values)
+
+
+def send_html_chunks(conn: socket.socket, header_template: str, chunks: Iterable[bytes]) -> None:
+    """
+    Envía cabecera + cuerpo fragmentado sin concatenarlo en Python cuando es posible.
+    Usa sendmsg (scatter/gather) en sockets planos y sendall en TLS.
+    """
+    chunks = [c for c in chunks if c]
+    length = sum(len(c) for c in chunks)
+    buffers = [header_template.format(length=length).encode("ascii")] + chunks
+
+    if isinstance(conn, ssl.SSLSocket) or not hasattr(conn, "sendmsg"):
+        conn.sendall(b"".join(buffers))
+        return
+
+    sent = conn.sendmsg(buffers)
+    total = length + len(buffers[0])
+    if sent < total:
+        # Envío parcial: completar con sendall sobre el resto
+        conn.sendall(b"".join(buffers)[sent:])
+
+
+def _format_timestamp(ts: Optional[float]) -> str:
+    """Formatea un timestamp como hora local legible (o 'sin expiración')."""
+    if ts is None:
+        return "sin expiración"
+    return time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(ts))
+
+
+def _format_remaining(expires_at: Optional[float], now: Optional[float] = None) -> str:
+    """Tiempo restante de sesión en formato corto (ej. '59 min 12 s')."""
+    if expires_at is None:
+        return "ilimitado"
+    remaining = max(0, int(expires_at - (now if now is not None else time.time())))
+    minutes, seconds = divmod(remaining, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} h {minutes} min"
+    return f"{minutes} min {seconds} s"
+
+
+def read_post_body_and_parse(
+    initial_data: bytes, conn: socket.socket, plazo: Optional[ReadDeadline] = None
+) -> dict:
     """
     Extrae Content-Length de las cabeceras incluidas en initial_data,
     lee el cuerpo restante desde conn hasta Content-Length y parsea
@@ -220,7 +623,9 @@ def read_post_body_and_parse(initial_data: bytes, conn: socket.socket) -> dict:
     Protección contra DoS:
       - Si Content-Length > MAX_REQUEST_BYTES => rechazamos (retornamos {}).
       - Al leer, nunca se superan MAX_REQUEST_BYTES bytes.
-    Devuelve {} ante cualquier error.
+      - El cuerpo debe llegar en BODY_TIMEOUT segundos (o en `plazo`) y a
+        MIN_TRANSFER_RATE; si no, se lanza SlowClientError.
+    Devuelve {} ante cualquier otro error.
     """
     try:
         # Asegurarnos de que initial_data contiene cabeceras completas
@@ -251,13 +656,17 @@ def read_post_body_and_parse(initial_data: bytes, conn: socket.socket) -> dict:
         max_body_remaining = min(content_length - len(body), MAX_REQUEST_BYTES - len(headers) - 4)
         bytes_to_read = max(0, max_body_remaining)
         total_read = len(body)
+        if bytes_to_read > 0 and plazo is None:
+            plazo = ReadDeadline("cuerpo", BODY_TIMEOUT)
         while bytes_to_read > 0:
-            chunk = conn.recv(min(4096, bytes_to_read))
+            chunk = plazo.recv(conn, min(4096, bytes_to_read))
             if not chunk:
                 break
             body += chunk
             total_read += len(chunk)
             bytes_to_read = min(content_length - len(body), MAX_REQUEST_BYTES - len(headers) - 4)
+        if plazo is not None:
+            conn.settimeout(RECV_IDLE_TIMEOUT)
 
         # Si no leimos todo lo que dijo Content-Length, consideramos válido lo que tenemos,
         # pero no aceptamos que el cliente pidiera más que MAX_REQUEST_BYTES (lo rechazamos arriba).
@@ -266,17 +675,93 @@ def read_post_body_and_parse(initial_data: bytes, conn: socket.socket) -> dict:
         # Aplanar valores: de listas a strings
         return {k: v[0] for k, v in parsed.items()}
 
+    except SlowClientError:
+        raise
     except Exception as exc:
         logging.exception("Error leyendo/parsing POST body: %s", exc)
         return {}
 
 
-def _logout_client(client_ip: str) -> bool:
+def _leer_cookie(data: bytes, nombre: str) -> Optional[str]:
+    """Valor de la cookie `nombre` en las cabeceras de la petición, o None."""
+    cabeceras = data.split(b"\r\n\r\n", 1)[0].decode("iso-8859-1")
+    for linea in cabeceras.split("\r\n")[1:]:
+        campo, _, valor = linea.partition(":")
+        if campo.strip().lower() != "cookie":
+            continue
+        for par in valor.split(";"):
+            clave, _, contenido = par.strip().partition("=")
+            if clave == nombre:
+                return contenido
+    return None
+
+
+def _token_de_peticion(data: bytes, client_ip: str) -> Optional[session_tokens.TokenSesion]:
+    """Token de sesión válido que trae la petición para esa IP (sin tocar el almacén)."""
+    if not session_tokens.ENABLED:
+        return None
+    token = _leer_cookie(data, session_tokens.COOKIE_NAME)
+    if not token:
+        return None
+    return session_tokens.verificar(token, client_ip)
+
+
+def _con_cookie(header_template: str, valor: str, max_age: Optional[int]) -> str:
+    """Añade Set-Cookie de sesión a una plantilla de cabecera (conserva {length})."""
+    cookie = f"{session_tokens.COOKIE_NAME}={valor}; {SESSION_COOKIE_ATTRS}"
+    if max_age is not None:
+        cookie += f"; Max-Age={max_age}"
+    if TLS_ENABLED:
+        cookie += "; Secure"
+    return header_template[:-2] + f"Set-Cookie: {cookie}\r\n\r\n"
+
+
+def _cabecera_login(header_template: str, session) -> str:
+    """Cabecera de la página de éxito con la cookie firmada de la sesión recién creada."""
+    if session is None or not session_tokens.ENABLED:
+        return header_template
+    try:
+        token = session_tokens.emitir(session)
+    except ValueError as exc:
+        logging.info("Sin cookie de sesión para %s: %s", session.ip, exc)
+        return header_template
+    max_age = None
+    if session.expires_at is not None:
+        max_age = max(0, int(session.expires_at - time.time()))
+    return _con_cookie(header_template, token, max_age)
+
+
+def _responder_logout(conn: socket.socket, data: bytes, client_ip: str) -> None:
+    """Cierra la sesión (con la MAC del token si lo hay), revoca el token y borra la cookie."""
+    token = _token_de_peticion(data, client_ip)
+    _logout_client(client_ip, mac=token.mac if token else None)
+    header_template = HTTP_OK_TEMPLATE
+    if session_tokens.ENABLED:
+        session_tokens.revocar_ip(client_ip)
+        header_template = _con_cookie(HTTP_OK_TEMPLATE, "", 0)
+    body = TEMPLATE_CACHE.get("/logout") or (
+        b"<!DOCTYPE html><html><body><h1>Sesion finalizada</h1></body></html>"
+    )
+    header = header_template.format(length=len(body)).encode("ascii")
+    conn.sendall(header + body)
+
+
+def _logout_client(client_ip: str, mac: Optional[str] = None) -> bool:
     """
     Intenta eliminar la sesión asociada a la IP (y MAC si se puede resolver).
     Devuelve True si se eliminó alguna sesión.
+    Todas las revocaciones comparten un único flush de conntrack.
     """
-    mac = _lookup_mac_for_ip(client_ip)
+    with firewall_dynamic.ciclo_revocacion():
+        return _logout_client_rules(client_ip, mac)
+
+
+def _logout_client_rules(client_ip: str, mac: Optional[str] = None) -> bool:
+    """Cuerpo de _logout_client (sesión + limpieza defensiva de reglas)."""
+    if mac is None:
+        # Sin MAC del token de sesión: resolverla por ARP
+        mac = _lookup_mac_for_ip(client_ip)
+        profiling.marcar("arp")
 
     removed = False
     if mac:
@@ -296,6 +781,7 @@ def _logout_client(client_ip: str) -> bool:
     if mac:
         firewall_dynamic.denegar_ip_mac(client_ip, mac)
     firewall_dynamic.denegar_ip(client_ip)
+    profiling.marcar("firewall")
 
     if removed:
         logging.info("Sesión cerrada para %s", client_ip)
@@ -304,6 +790,45 @@ def _logout_client(client_ip: str) -> bool:
     return removed
 
 
+def _status_payload(client_ip: str, token: Optional[session_tokens.TokenSesion] = None) -> bytes:
+    """
+    Construye el JSON compacto de /status para la IP indicada.
+    Con un token de sesión válido responde solo con sus datos (sin consumo de
+    bytes); si no, consulta la sesión en memoria (sin ARP ni firewall).
+    """
+    if token is not None:
+        now = time.time()
+        payload = {
+            "logged_in": True,
+            "ip": client_ip,
+            "username": token.username,
+            "login_time": int(token.login_time),
+            "expires_at": int(token.expires_at) if token.expires_at is not None else None,
+            "remaining": max(0, int(token.expires_at - now)) if token.expires_at is not None else None,
+        }
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+    session = obtener_sesion_por_ip(client_ip)
+    if session is None:
+        payload: dict = {"logged_in": False, "ip": client_ip}
+    else:
+        now = time.time()
+        remaining = None
+        if session.expires_at is not None:
+            remaining = max(0, int(session.expires_at - now))
+        payload = {
+            "logged_in": True,
+            "ip": client_ip,
+            "username": session.username,
+            "login_time": int(session.login_time),
+            "expires_at": int(session.expires_at) if session.expires_at is not None else None,
+            "remaining": remaining,
+            "bytes_used": session.bytes_used,
+            "byte_quota": session.byte_quota,
+        }
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
 def _session_cleanup_worker(stop_event: threading.Event) -> None:
     """
     Elimina sesiones expiradas periódicamente para revocar acceso sin intervención del usuario.
@@ -321,18 +846,104 @@ def _session_cleanup_worker(stop_event: threading.Event) -> None:
         stop_event.wait(SESSION_CLEANUP_INTERVAL)
 
 
+def _periodic_worker(stop_event: threading.Event, interval: int, task, description: str) -> None:
+    """
+    Ejecuta `task()` cada `interval` segundos hasta que se active stop_event.
+    Intervalos <= 0 deshabilitan la tarea.
+    """
+    if interval <= 0:
+        logging.info("Tarea periódica '%s' deshabilitada (intervalo <= 0).", description)
+        return
+
+    while not stop_event.wait(interval):
+        try:
+            task()
+        except Exception as exc:  # noqa: BLE001
+            logging.warning("Error en tarea periódica '%s': %s", description, exc)
+
+
+class _ConexionMemoria:
+    """Conexión en memoria para atender un stream HTTP/2 con handle_client."""
+
+    __slots__ = ("_datos", "_pos", "enviado")
+
+    def __init__(self, datos: bytes) -> None:
+        self._datos = datos
+        self._pos = 0
+        self.enviado: list[bytes] = []
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        pass
+
+    def recv(self, n: int) -> bytes:
+        chunk = self._datos[self._pos:self._pos + n]
+        self._pos += len(chunk)
+        return chunk
+
+    def sendall(self, data: bytes) -> None:
+        self.enviado.append(data)
+
+    def close(self) -> None:
+        pass
+
+
+def _atender_stream_h2(addr: Tuple[str, int]):
+    """Manejador de streams HTTP/2: la petición traducida pasa por handle_client."""
+
+    def atender(peticion: bytes) -> bytes:
+        conn = _ConexionMemoria(peticion)
+        handle_client(conn, addr)  # type: ignore[arg-type]
+        return b"".join(conn.enviado)
+
+    return atender
+
+
 def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
     """
     Maneja una conexión TCP con un cliente.
     Soporta GET y POST en /login.
     """
+    profiling.iniciar_peticion()
+    descripcion = f"desde {addr[0]}"
     try:
-        conn.settimeout(2.0)
+        # Plazo absoluto para el handshake TLS (si lo hay) y las cabeceras
+        plazo = ReadDeadline("cabeceras", HEADER_TIMEOUT)
+        if isinstance(conn, ssl.SSLSocket):
+            plazo.aplicar_timeout(conn)
+            try:
+                conn.do_handshake()
+            except socket.timeout:
+                raise plazo.error("handshake") from None
+            except (ssl.SSLError, OSError) as exc:
+                logging.warning("Fallo handshake TLS con %s: %s", addr[0], exc)
+                return
+            if conn.selected_alpn_protocol() == "h2":
+                # Cada stream se atiende como una petición propia (con su perfil)
+                profiling.terminar_peticion(f"handshake h2 desde {addr[0]}")
+                con_cupo = _CUPOS_H2.acquire(blocking=False)
+                try:
+                    peticiones = http2.atender_conexion(
+                        conn,
+                        _atender_stream_h2(addr),
+                        MAX_REQUEST_BYTES,
+                        RECV_IDLE_TIMEOUT,
+                        _DRENAR_H2,
+                        plazo_frame=HEADER_TIMEOUT,
+                        al_limite=lambda motivo, recibidos, segundos: _contar_cliente_lento(
+                            SlowClientError("h2", motivo, recibidos, segundos), addr[0]
+                        ),
+                        inactividad=http2.IDLE_TIMEOUT if con_cupo else min(HTTP2_OVERFLOW_IDLE, http2.IDLE_TIMEOUT),
+                    )
+                finally:
+                    if con_cupo:
+                        _CUPOS_H2.release()
+                descripcion = f"conexión h2 desde {addr[0]} ({peticiones} peticiones{'' if con_cupo else ', sin cupo'})"
+                return
         data = b""
 
         # Leemos hasta encontrar el fin de cabeceras HTTP
         while b"\r\n\r\n" not in data:
-            chunk = conn.recv(1024)
+            chunk = plazo.recv(conn, 1024)
             if not chunk:
                 break
             data += chunk
@@ -347,8 +958,10 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
                 conn.sendall(header + body)
                 return
 
+        profiling.marcar("recv")
         if not data:
             return
+        conn.settimeout(RECV_IDLE_TIMEOUT)
 
         # Primera línea de la petición: "GET /ruta HTTP/1.1"
         try:
@@ -366,6 +979,9 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
 
         # Normalizar la ruta sin query/fragmento
         route = path.split("?", 1)[0].split("#", 1)[0]
+        descripcion = f"{method} {route} desde {addr[0]}"
+        traffic_trace.registrar(addr[0], method, route, data)
+        profiling.marcar("parse")
 
         # Rechazar intentos evidentes de path-traversal o percent-encoding peligroso
         if ".." in route or "%" in route:
@@ -405,16 +1021,12 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
 
             # Manejo específico para logout via POST: no requiere body.
             if route == "/logout":
-                _logout_client(addr[0])
-                body = TEMPLATE_CACHE.get("/logout") or (
-                    b"<!DOCTYPE html><html><body><h1>Sesion finalizada</h1></body></html>"
-                )
-                header = HTTP_OK_TEMPLATE.format(length=len(body)).encode("ascii")
-                conn.sendall(header + body)
+                _responder_logout(conn, data, addr[0])
                 return
 
             # Parsear body del POST robustamente (solo /login)
             form = read_post_body_and_parse(data, conn)
+            profiling.marcar("parse")
             if form == {}:
                 body = (
                     b"<!DOCTYPE html><html><body>"
@@ -432,33 +1044,47 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
             # Validaciones básicas (campos vacíos)
             if not username or not password:
                 logging.info("Login con campos vacíos desde %s", addr[0])
-                body = TEMPLATE_CACHE.get("/error") or (
-                    b"<!DOCTYPE html><html><body><h1>Acceso denegado</h1></body></html>"
+                chunks = render_template_chunks(
+                    "/error",
+                    {"reason": LOGIN_ERROR_EMPTY_FIELDS},
+                    b"<!DOCTYPE html><html><body><h1>Acceso denegado</h1></body></html>",
                 )
-                header = HTTP_OK_TEMPLATE.format(length=len(body))
-                conn.sendall(header.encode("ascii") + body)
+                send_html_chunks(conn, HTTP_OK_TEMPLATE, chunks)
                 return
 
             # Validación con auth (USERS cargado en run_server)
             try:
-                if authenticate(username, password, USERS):
+                if AUTH_BACKEND is not None:
+                    autenticado = AUTH_BACKEND.autenticar(username, password)
+                else:
+                    autenticado = authenticate(username, password, USERS)
+                profiling.marcar("auth")
+                if autenticado:
                     logging.info("Login exitoso para '%s' desde %s", username, addr[0])
 
                     # Intentar obtener MAC desde el gateway (arp)
                     client_ip = addr[0]
                     mac = _lookup_mac_for_ip(client_ip)
+                    profiling.marcar("arp")
 
                     # Crear sesión guardando IP y (si se obtuvo) MAC
+                    session = None
                     try:
                         # usar sessions.crear_sesion (importarlo arriba)
-                        crear_sesion(username, client_ip, mac=mac)
+                        session = crear_sesion(username, client_ip, mac=mac)
                     except Exception as exc:
                         logging.exception("Error creando sesión para %s: %s", username, exc)
-
-                    body = TEMPLATE_CACHE.get("/success") or "<h1>Autenticación exitosa</h1>".encode("utf-8")
-
-                    header = HTTP_OK_TEMPLATE.format(length=len(body))
-                    conn.sendall(header.encode("ascii") + body)
+                    profiling.marcar("session")
+
+                    values = {"username": username}
+                    if session is not None:
+                        values["login_time"] = _format_timestamp(session.login_time)
+                        values["expires_at"] = _format_timestamp(session.expires_at)
+                        values["remaining"] = _format_remaining(session.expires_at, session.login_time)
+                    chunks = render_template_chunks(
+                        "/success", values, "<h1>Autenticación exitosa</h1>".encode("utf-8")
+                    )
+                    send_html_chunks(conn, _cabecera_login(HTTP_OK_TEMPLATE, session), chunks)
                     return
 
                 else:
@@ -467,11 +1093,20 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
                         "Login FALLIDO para '%s' desde %s", username, addr[0]
                     )
                     # --------------------------------------
-                    body = TEMPLATE_CACHE.get("/error") or (
-                        b"<!DOCTYPE html><html><body><h1>Acceso denegado</h1></body></html>"
+                    chunks = render_template_chunks(
+                        "/error",
+                        {"reason": LOGIN_ERROR_BAD_CREDENTIALS},
+                        b"<!DOCTYPE html><html><body><h1>Acceso denegado</h1></body></html>",
                     )
-                    header = HTTP_OK_TEMPLATE.format(length=len(body))
-                    conn.sendall(header.encode("ascii") + body)
+                    send_html_chunks(conn, HTTP_OK_TEMPLATE, chunks)
+            except AuthBackendError as exc:
+                logging.warning("Backend de autenticación sin respuesta para '%s': %s", username, exc)
+                chunks = render_template_chunks(
+                    "/error",
+                    {"reason": LOGIN_ERROR_BACKEND},
+                    b"<!DOCTYPE html><html><body><h1>Acceso denegado</h1></body></html>",
+                )
+                send_html_chunks(conn, HTTP_OK_TEMPLATE, chunks)
             except Exception as exc:
                 logging.exception("Error validando credenciales: %s", exc)
                 body = (
@@ -498,14 +1133,32 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
 
         # Manejo de logout (GET o POST)
         if route == "/logout":
-            _logout_client(addr[0])
-            body = TEMPLATE_CACHE.get("/logout") or (
-                b"<!DOCTYPE html><html><body><h1>Sesion finalizada</h1></body></html>"
-            )
-            header = HTTP_OK_TEMPLATE.format(length=len(body)).encode("ascii")
+            _responder_logout(conn, data, addr[0])
+            return
+
+        # Estado de sesión en JSON (consultas frecuentes: sin ARP, sin plantillas)
+        if route == "/status":
+            body = _status_payload(addr[0], _token_de_peticion(data, addr[0]))
+            header = HTTP_JSON_TEMPLATE.format(length=len(body)).encode("ascii")
             conn.sendall(header + body)
             return
 
+        # Página de éxito personalizada con los datos del token de sesión
+        if route == "/success":
+            token = _token_de_peticion(data, addr[0])
+            if token is not None:
+                values = {
+                    "username": token.username,
+                    "login_time": _format_timestamp(token.login_time),
+                    "expires_at": _format_timestamp(token.expires_at),
+                    "remaining": _format_remaining(token.expires_at, time.time()),
+                }
+                chunks = render_template_chunks(
+                    "/success", values, "<h1>Autenticación exitosa</h1>".encode("utf-8")
+                )
+                send_html_chunks(conn, HTTP_OK_TEMPLATE, chunks)
+                return
+
         body = TEMPLATE_CACHE.get(route)
         if body is None:
             # Ruta no encontrada → 404 real
@@ -522,20 +1175,35 @@ def handle_client(conn: socket.socket, addr: Tuple[str, int]) -> None:
         header = HTTP_OK_TEMPLATE.format(length=len(body)).encode("ascii")
         conn.sendall(header + body)
 
+    except SlowClientError as exc:
+        _contar_cliente_lento(exc, addr[0])
+        descripcion = f"{descripcion} (cerrada: {exc.fase} {exc.motivo})"
+        try:
+            conn.settimeout(0.5)
+            conn.sendall(HTTP_408_RESPONSE)
+        except OSError:
+            pass
+
     finally:
         conn.close()
+        profiling.marcar("send")
+        profiling.terminar_peticion(descripcion)
 
 
 def run_server(host: str = HOST, port: int = PORT) -> None:
     """
     Arranca el servidor HTTP y acepta conexiones en bucle.
 
-    Cada conexión se maneja en un hilo del pool (ThreadPoolExecutor).
+    Cada conexión se maneja en un hilo del pool (adaptable entre
+    PORTAL_HTTP_WORKERS_MIN y PORTAL_HTTP_WORKERS, ver adaptive_pool).
+    SIGHUP dispara una recarga en caliente: una nueva instancia hereda el socket
+    de escucha y arranca mientras esta sigue aceptando; cuando está lista, esta
+    deja de aceptar, drena las peticiones en curso y le da paso.
     """
     # Precargar todas las plantillas en cache
     fill_template_cache()
 
-    global USERS
+    global USERS, AUTH_BACKEND
 
     # Cargar usuarios desde config/usuarios.txt
     try:
@@ -545,10 +1213,66 @@ def run_server(host: str = HOST, port: int = PORT) -> None:
         logging.error("No se pudieron cargar usuarios: %s. El login fallará hasta corregir.", err)
         USERS = {}
 
+    # Backend de autenticación (PORTAL_AUTH_BACKEND): usuarios.txt o servicio central
+    try:
+        AUTH_BACKEND = crear_backend(USERS)
+    except ValueError as err:
+        logging.error("Backend de autenticación inválido: %s", err)
+        raise SystemExit(1) from err
+
+    # Restaurar sesiones persistidas. En una recarga en caliente las reglas de
+    # firewall ya están aplicadas por la instancia anterior.
+    cargar_sesiones(aplicar_firewall=os.environ.get(RELOAD_HANDOFF_ENV) != "1")
+    # Cookies de sesión firmadas: clave compartida y revocación en las bajas
+    session_tokens.iniciar()
+
     stop_event = threading.Event()
 
+    # Replicación activo/standby de sesiones (PORTAL_REPLICATION_ROLE)
+    replication.iniciar(stop_event)
+    # DNS cautivo para clientes sin sesión (PORTAL_DNS_LISTEN)
+    captive_dns.iniciar(stop_event)
+    # Mapa IP -> MAC por rtnetlink (PORTAL_NEIGH_MONITOR); revoca si una IP cambia de MAC
+    neighbor_monitor.iniciar(stop_event)
+    # Límites de velocidad por sesión con tc/HTB (PORTAL_SHAPING)
+    traffic_shaping.iniciar(stop_event)
+    # Traza anonimizada de peticiones para reproducirla en pruebas (PORTAL_TRACE)
+    traffic_trace.iniciar(stop_event, RUTAS_TRAZA)
+    # Socket Unix de administración: listado y operaciones en lote (PORTAL_ADMIN_SOCKET)
+    admin_socket.iniciar(stop_event)
+
     tls_context = _build_tls_context()
 
+    reload_event = threading.Event()
+
+    def _request_reload(signum, _frame) -> None:
+        logging.info("Señal %s recibida: recarga en caliente solicitada", signum)
+        reload_event.set()
+
+    _install_signal_handler(RELOAD_SIGNAL, _request_reload)
+    # Perfilado bajo demanda: `kill -USR1 <pid>` activa / desactiva
+    _install_signal_handler(profiling.PROFILE_SIGNAL, profiling.manejar_senal)
+
+    server_sock = _open_listen_socket(host, port)
+    server_sock.settimeout(1.0)  # para permitir cerrar con Ctrl+C
+
+    if tls_context:
+        logging.info(
+            "Servidor HTTPS escuchando en %s:%d (cert=%s)",
+            host,
+            port,
+            TLS_CERT_FILE,
+        )
+    else:
+        logging.info("Servidor HTTP escuchando en %s:%d", host, port)
+
+    # Si venimos de una recarga: avisar a la instancia anterior de que estamos
+    # listos y esperar a que deje de aceptar y drene. Sigue aceptando mientras
+    # arrancamos, así que las sesiones se releen con lo que creó entretanto.
+    _notify_predecessor_ready()
+    if _esperar_turno():
+        cargar_sesiones(aplicar_firewall=False)
+
     # Hilo de mantenimiento: elimina sesiones expiradas y revoca reglas.
     threading.Thread(
         target=_session_cleanup_worker,
@@ -557,25 +1281,44 @@ def run_server(host: str = HOST, port: int = PORT) -> None:
         name="session-cleanup",
     ).start()
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_sock:
-        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_sock.bind((host, port))
-        server_sock.listen(64)  # backlog decente para picos breves
-        server_sock.settimeout(1.0)  # para permitir cerrar con Ctrl+C
-
-        if tls_context:
-            logging.info(
-                "Servidor HTTPS escuchando en %s:%d (cert=%s)",
-                host,
-                port,
-                TLS_CERT_FILE,
-            )
-        else:
-            logging.info("Servidor HTTP escuchando en %s:%d", host, port)
+    # Hilo de mantenimiento: corrige deriva entre reglas de firewall y sesiones.
+    threading.Thread(
+        target=_periodic_worker,
+        args=(stop_event, FIREWALL_RECONCILE_INTERVAL, reconciliar_firewall, "reconciliación de firewall"),
+        daemon=True,
+        name="firewall-reconcile",
+    ).start()
+
+    # Hilo de mantenimiento: contabilidad de tráfico y cuotas de bytes.
+    threading.Thread(
+        target=_periodic_worker,
+        args=(stop_event, ACCOUNTING_INTERVAL, actualizar_contadores, "contabilidad de tráfico"),
+        daemon=True,
+        name="traffic-accounting",
+    ).start()
 
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    try:
+        _DRENAR_H2.clear()
+        relevo: dict = {}
+        hilo_relevo: Optional[threading.Thread] = None
+        with _crear_pool() as executor:
             try:
                 while not stop_event.is_set():
+                    if reload_event.is_set() and hilo_relevo is None:
+                        # La nueva instancia arranca mientras esta sigue aceptando
+                        logging.info("Lanzando nueva instancia del portal...")
+                        hilo_relevo = threading.Thread(
+                            target=lambda: relevo.update(go_fd=_spawn_successor(server_sock)),
+                            daemon=True,
+                            name="reload-successor",
+                        )
+                        hilo_relevo.start()
+                    if hilo_relevo is not None and not hilo_relevo.is_alive():
+                        if relevo.get("go_fd") is not None:
+                            break
+                        logging.error("La nueva instancia no confirmó arranque; esta instancia sigue atendiendo.")
+                        reload_event.clear()
+                        hilo_relevo = None
                     try:
                         conn, addr = server_sock.accept()
                     except socket.timeout:
@@ -583,12 +1326,14 @@ def run_server(host: str = HOST, port: int = PORT) -> None:
                     except OSError:
                         break  # socket cerrado
                     if tls_context:
+                        # El handshake se hace en el worker, dentro del plazo de cabeceras:
+                        # un cliente TLS mudo no bloquea el bucle de accept.
                         try:
-                            conn = tls_context.wrap_socket(conn, server_side=True)
-                        except ssl.SSLError as exc:
-                            logging.warning(
-                                "Fallo handshake TLS con %s: %s", addr[0], exc
+                            conn = tls_context.wrap_socket(
+                                conn, server_side=True, do_handshake_on_connect=False
                             )
+                        except (ssl.SSLError, OSError) as exc:
+                            logging.warning("Fallo preparando TLS con %s: %s", addr[0], exc)
                             conn.close()
                             continue
 
@@ -596,9 +1341,23 @@ def run_server(host: str = HOST, port: int = PORT) -> None:
             except KeyboardInterrupt:
                 logging.info("Se recibio Ctrl+C, deteniendo servidor...")
                 stop_event.set()
-            finally:
-                server_sock.close()
-                executor.shutdown(wait=True)
+            _DRENAR_H2.set()
+            # Al salir del with se esperan (drenan) las peticiones en curso.
+
+        go_fd = relevo.get("go_fd")
+        if go_fd is not None:
+            # Recarga: ya no aceptamos, las peticiones en curso terminaron y las
+            # sesiones están en disco. Las conexiones nuevas las acepta la nueva
+            # instancia en cuanto recibe paso (hasta entonces, al backlog).
+            if stop_event.is_set():
+                os.close(go_fd)  # parada durante la recarga: la nueva sigue sola
+            else:
+                logging.info("Peticiones en curso drenadas; la nueva instancia toma el relevo.")
+                _dar_paso_sucesor(go_fd)
+            stop_event.set()
+    finally:
+        server_sock.close()
+        traffic_trace.volcar()
 
 
 if __name__ == "__main__":
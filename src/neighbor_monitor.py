@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+neighbor_monitor.py
+
+Monitor de la tabla de vecinos (ARP/NDP) del kernel por rtnetlink, sin
+procesos externos.
+
+- Un socket AF_NETLINK/NETLINK_ROUTE suscrito a RTMGRP_NEIGH recibe cada alta,
+  cambio o baja de vecino; al arrancar (y si el kernel descarta eventos por
+  buffer lleno, ENOBUFS) se vuelca la tabla completa con RTM_GETNEIGH.
+- Mantiene un mapa IP -> MAC en memoria: arp_lookup.get_mac lo consulta sin
+  llamadas al sistema por login.
+- Si una IP con sesión pasa a otra MAC (suplantación o IP reasignada), la
+  sesión se revoca (PORTAL_NEIGH_ON_CHANGE=revoke, por defecto) o solo se
+  marca y se registra un aviso (=flag).
+
+Se habilita con PORTAL_NEIGH_MONITOR=1 (por defecto); PORTAL_NEIGH_INTERFACE
+limita el mapa a la interfaz de la LAN. Solo Linux: en otros sistemas, o si
+el socket no se puede abrir, arp_lookup sigue usando ip neigh y /proc/net/arp.
+"""
+
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+import sessions
+from netlink_util import (
+    NLM_F_DUMP,
+    NLM_F_REQUEST,
+    NLMSG_DONE,
+    NLMSG_ERROR,
+    check_error,
+    iter_messages,
+    open_socket,
+    pack_nlmsg,
+    parse_attrs,
+    raise_for_errno,
+)
+
+ENABLED = os.getenv("PORTAL_NEIGH_MONITOR", "1").strip().lower() in {"1", "true", "yes", "on"}
+INTERFACE = os.getenv("PORTAL_NEIGH_INTERFACE", "").strip()
+# revoke = eliminar la sesión cuyo MAC cambió; flag = solo marcarla y avisar
+ON_CHANGE = os.getenv("PORTAL_NEIGH_ON_CHANGE", "revoke").strip().lower()
+RCVBUF = int(os.getenv("PORTAL_NEIGH_RCVBUF", str(1 << 20)))
+
+# Constantes de linux/rtnetlink.h y linux/neighbour.h
+NETLINK_ROUTE = 0
+RTMGRP_NEIGH = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+
+# ndmsg: familia, (relleno), ifindex, estado NUD, flags, tipo
+_NDMSG = struct.Struct("=BxxxiHBB")
+
+# Evento de vecino: (tipo de mensaje, ifindex, estado NUD, IP, MAC o None)
+Evento = Tuple[int, int, int, str, Optional[str]]
+
+_metricas: Dict[str, int] = {
+    "eventos": 0,
+    "volcados": 0,
+    "desbordes": 0,
+    "cambios_mac": 0,
+    "sesiones_revocadas": 0,
+    "sesiones_marcadas": 0,
+}
+
+_monitor: Optional["MonitorVecinos"] = None
+# Sesiones marcadas (ON_CHANGE=flag): IP -> (MAC de la sesión, MAC nueva, instante)
+_marcadas: Dict[str, Tuple[str, str, float]] = {}
+
+
+def parsear_mensajes(datos: bytes) -> Iterator[Evento]:
+    """
+    Recorre un datagrama netlink y devuelve los eventos de vecino que contiene.
+    NLMSG_DONE termina el recorrido; NLMSG_ERROR con código lanza NetlinkError.
+    """
+    for tipo, _flags, _seq, payload in iter_messages(datos):
+        if tipo == NLMSG_DONE:
+            return
+        if tipo == NLMSG_ERROR:
+            raise_for_errno(check_error(payload), "volcado de vecinos")
+            continue
+        if tipo not in (RTM_NEWNEIGH, RTM_DELNEIGH) or len(payload) < _NDMSG.size:
+            continue
+        familia, ifindex, estado, _nflags, _ntype = _NDMSG.unpack_from(payload)
+        if familia not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        attrs = parse_attrs(payload, _NDMSG.size)
+        dst = attrs.get(NDA_DST)
+        if dst is None:
+            continue
+        lladdr = attrs.get(NDA_LLADDR)
+        mac = lladdr.hex(":") if lladdr is not None and len(lladdr) == 6 else None
+        yield tipo, ifindex, estado, socket.inet_ntop(familia, dst), mac
+
+
+class MonitorVecinos:
+    """
+    Mantiene `mapa` (IP -> MAC) a partir de los eventos rtnetlink y llama a
+    al_cambiar(ip, mac_anterior, mac_nueva) cuando una IP cambia de MAC o
+    vuelve a aparecer tras salir del mapa (mac_anterior None: p. ej. la entrada
+    caducó o quedó FAILED y la IP regresa con otro equipo; no durante el
+    primer volcado).
+    """
+
+    def __init__(
+        self,
+        al_cambiar: Callable[[str, Optional[str], str], None],
+        ifindex: int = 0,
+    ) -> None:
+        self.al_cambiar = al_cambiar
+        self.ifindex = ifindex
+        self.mapa: Dict[str, str] = {}
+        self.sincronizado = threading.Event()
+        self._sock: Optional[socket.socket] = None
+        self._seq = 0
+        self._vistos: Optional[Set[str]] = None
+
+    def abrir(self) -> None:
+        self._sock = open_socket(NETLINK_ROUTE, groups=RTMGRP_NEIGH, rcvbuf=RCVBUF)
+
+    def cerrar(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def pedir_volcado(self) -> None:
+        """Solicita la tabla completa; lo que no aparezca en ella se quita del mapa."""
+        self._seq += 1
+        ndmsg = _NDMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        self._vistos = set()
+        self._sock.send(pack_nlmsg(RTM_GETNEIGH, NLM_F_REQUEST | NLM_F_DUMP, self._seq, ndmsg))
+
+    def aplicar(self, evento: Evento) -> None:
+        """Actualiza el mapa con un evento y avisa si la IP cambió de MAC o es nueva en el mapa."""
+        tipo, ifindex, estado, ip, mac = evento
+        if self.ifindex and ifindex != self.ifindex:
+            return
+        # Sin dirección de enlace útil (pendiente, fallida, multicast/NOARP): fuera del mapa
+        if tipo == RTM_DELNEIGH or mac is None or estado & (NUD_INCOMPLETE | NUD_FAILED | NUD_NOARP):
+            self.mapa.pop(ip, None)
+            return
+        if self._vistos is not None:
+            self._vistos.add(ip)
+        anterior = self.mapa.get(ip)
+        self.mapa[ip] = mac
+        # Las altas del primer volcado no avisan: tras él se revisan todas las sesiones
+        if anterior != mac and (anterior is not None or self.sincronizado.is_set()):
+            self.al_cambiar(ip, anterior, mac)
+
+    def _fin_volcado(self) -> None:
+        if self._vistos is not None:
+            for ip in [ip for ip in self.mapa if ip not in self._vistos]:
+                del self.mapa[ip]
+            self._vistos = None
+        _metricas["volcados"] += 1
+        self.sincronizado.set()
+
+    def procesar(self, datos: bytes) -> None:
+        """Aplica un datagrama recibido (eventos o parte de un volcado)."""
+        for evento in parsear_mensajes(datos):
+            _metricas["eventos"] += 1
+            self.aplicar(evento)
+        if self._vistos is not None and _es_fin_volcado(datos):
+            self._fin_volcado()
+
+    def ejecutar(self, stop_event: threading.Event) -> None:
+        """Bucle de recepción hasta stop_event (revisa cada segundo)."""
+        self._sock.settimeout(1.0)
+        self.pedir_volcado()
+        while not stop_event.is_set():
+            try:
+                datos = self._sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError as exc:
+                if exc.errno != errno.ENOBUFS:
+                    raise
+                # El kernel descartó eventos: volver a volcar la tabla entera
+                _metricas["desbordes"] += 1
+                logging.warning("[NEIGH] Eventos de vecinos perdidos (ENOBUFS); resincronizando")
+                self.pedir_volcado()
+                continue
+            self.procesar(datos)
+
+
+def _es_fin_volcado(datos: bytes) -> bool:
+    return any(tipo == NLMSG_DONE for tipo, _flags, _seq, _payload in iter_messages(datos))
+
+
+def _cambio_mac(ip: str, anterior: Optional[str], nueva: str) -> None:
+    """
+    Una IP pasó a otra MAC (o reapareció sin entrada previa en el mapa): revoca
+    o marca la sesión que la usaba con una MAC distinta de `nueva`.
+    """
+    sess = sessions.obtener_sesion_por_ip(ip)
+    coincide = sess is None or sess.mac is None or sess.mac == nueva
+    if anterior is None and coincide:
+        return  # alta normal: nada que contradiga la MAC nueva
+    _metricas["cambios_mac"] += 1
+    if coincide:
+        logging.info("[NEIGH] %s cambió de MAC %s -> %s", ip, anterior, nueva)
+        return
+    _actuar_sobre_sesion(sess, nueva)
+
+
+def _actuar_sobre_sesion(sess: "sessions.Session", nueva: str) -> None:
+    if ON_CHANGE == "flag":
+        _metricas["sesiones_marcadas"] += 1
+        _marcadas[sess.ip] = (sess.mac, nueva, time.time())
+        logging.warning(
+            "[NEIGH] La IP %s (usuario=%s) aparece ahora con MAC %s en vez de %s; sesión marcada",
+            sess.ip,
+            sess.username,
+            nueva,
+            sess.mac,
+        )
+        return
+    if sessions.eliminar_sesion(sess.ip, sess.mac, motivo="cambio_mac"):
+        _metricas["sesiones_revocadas"] += 1
+        logging.warning(
+            "[NEIGH] La IP %s (usuario=%s) aparece ahora con MAC %s en vez de %s; sesión revocada",
+            sess.ip,
+            sess.username,
+            nueva,
+            sess.mac,
+        )
+
+
+def _revisar_sesiones(mapa: Dict[str, str]) -> None:
+    """Tras un volcado: sesiones restauradas o con eventos perdidos cuya MAC ya no coincide."""
+    for sess in sessions.obtener_todas_las_sesiones().values():
+        actual = mapa.get(sess.ip)
+        if sess.mac and actual and actual != sess.mac:
+            _actuar_sobre_sesion(sess, actual)
+
+
+def obtener_mac(ip: str) -> Optional[str]:
+    """MAC de `ip` según el mapa vivo, o None (monitor inactivo o vecino desconocido)."""
+    monitor = _monitor
+    if monitor is None:
+        return None
+    return monitor.mapa.get(ip)
+
+
+def obtener_tabla() -> Dict[str, str]:
+    """Copia del mapa IP -> MAC (vacía si el monitor no está activo)."""
+    monitor = _monitor
+    return dict(monitor.mapa) if monitor is not None else {}
+
+
+def activo() -> bool:
+    """True si el mapa está sincronizado con el kernel y se puede usar en vez de ARP."""
+    monitor = _monitor
+    return monitor is not None and monitor.sincronizado.is_set()
+
+
+def obtener_marcadas() -> Dict[str, Tuple[str, str, float]]:
+    """Copia de las sesiones marcadas por cambio de MAC (modo flag)."""
+    return dict(_marcadas)
+
+
+def obtener_metricas() -> Dict[str, int]:
+    """Copia de los contadores del monitor de vecinos."""
+    return dict(_metricas, vecinos=len(_monitor.mapa) if _monitor else 0)
+
+
+def iniciar(stop_event: threading.Event) -> bool:
+    """Arranca el monitor en un hilo propio si está habilitado y el sistema lo permite."""
+    global _monitor
+    if not ENABLED:
+        return False
+    try:
+        ifindex = socket.if_nametoindex(INTERFACE) if INTERFACE else 0
+        monitor = MonitorVecinos(_cambio_mac, ifindex)
+        monitor.abrir()
+    except (OSError, AttributeError) as exc:
+        logging.warning("[NEIGH] Monitor de vecinos no disponible (%s); se usará ip neigh / /proc/net/arp", exc)
+        return False
+
+    def _ejecutar() -> None:
+        global _monitor
+        try:
+            monitor.ejecutar(stop_event)
+        except Exception as exc:  # noqa: BLE001
+            logging.error("[NEIGH] El monitor de vecinos se detuvo: %s", exc)
+        finally:
+            _monitor = None
+            monitor.cerrar()
+
+    def _revisar_al_sincronizar() -> None:
+        if monitor.sincronizado.wait(10):
+            logging.info("[NEIGH] Tabla de vecinos sincronizada: %d entradas", len(monitor.mapa))
+            _revisar_sesiones(monitor.mapa)
+
+    _monitor = monitor
+    threading.Thread(target=_ejecutar, daemon=True, name="neigh-monitor").start()
+    threading.Thread(target=_revisar_al_sincronizar, daemon=True, name="neigh-check").start()
+    return True
+
+
+if __name__ == "__main__":
+    # Prueba manual: python3 src/neighbor_monitor.py [interfaz]
+    # Muestra la tabla inicial y cada cambio de vecino (Ctrl+C para salir).
+    # Con tests/neighbor_monitor_netns.sh se prueba un cambio de MAC real.
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    ifindex = socket.if_nametoindex(sys.argv[1]) if len(sys.argv) > 1 else 0
+
+    def _mostrar_cambio(ip: str, anterior: Optional[str], nueva: str) -> None:
+        if anterior is not None:
+            print(f"CAMBIO {ip}: {anterior} -> {nueva}", flush=True)
+        else:
+            print(f"NUEVO {ip}: {nueva}", flush=True)
+
+    demo = MonitorVecinos(_mostrar_cambio, ifindex)
+    demo.abrir()
+    parar = threading.Event()
+    hilo = threading.Thread(target=demo.ejecutar, args=(parar,), daemon=True)
+    hilo.start()
+    demo.sincronizado.wait(5)
+    for ip_vecino, mac_vecino in sorted(demo.mapa.items()):
+        print(f"{ip_vecino:<40} {mac_vecino}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        parar.set()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+netlink_util.py
+
+Utilidades mínimas para hablar netlink con sockets crudos de la stdlib
+(socket.AF_NETLINK), sin dependencias externas.
+
+- Empaquetado de mensajes (nlmsghdr) y atributos (nlattr).
+- Iteración sobre los mensajes de un buffer recibido.
+- Parseo de atributos (incluidos los anidados).
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+import struct
+from typing import Dict, Iterator, Tuple
+
+# Cabecera nlmsghdr: len, type, flags, seq, pid
+NLMSG_HDR = struct.Struct("=IHHII")
+# Cabecera nlattr: len, type
+NLA_HDR = struct.Struct("=HH")
+
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3FFF
+
+
+class NetlinkError(OSError):
+    """Error devuelto por el kernel en un mensaje NLMSG_ERROR."""
+
+
+def align4(length: int) -> int:
+    """Alinea una longitud a 4 bytes (NLMSG_ALIGN / NLA_ALIGN)."""
+    return (length + 3) & ~3
+
+
+def pack_nlmsg(msg_type: int, flags: int, seq: int, payload: bytes) -> bytes:
+    """Construye un mensaje netlink completo (cabecera + payload alineado)."""
+    length = NLMSG_HDR.size + len(payload)
+    padding = b"\0" * (align4(length) - length)
+    return NLMSG_HDR.pack(length, msg_type, flags, seq, 0) + payload + padding
+
+
+def pack_attr(attr_type: int, payload: bytes) -> bytes:
+    """Construye un atributo nlattr (con padding a 4 bytes)."""
+    length = NLA_HDR.size + len(payload)
+    return NLA_HDR.pack(length, attr_type) + payload + b"\0" * (align4(length) - length)
+
+
+def iter_messages(data: bytes) -> Iterator[Tuple[int, int, int, bytes]]:
+    """
+    Recorre los mensajes netlink de un buffer.
+    Devuelve tuplas (tipo, flags, seq, payload).
+    """
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        length, msg_type, flags, seq, _pid = NLMSG_HDR.unpack_from(data, offset)
+        if length < NLMSG_HDR.size:
+            break
+        yield msg_type, flags, seq, data[offset + NLMSG_HDR.size:offset + length]
+        offset += align4(length)
+
+
+def iter_attrs_raw(data: bytes, offset: int = 0) -> Iterator[Tuple[int, bytes, bytes]]:
+    """
+    Recorre atributos de un bloque. Devuelve (tipo sin flags, payload, bytes crudos del atributo).
+    Los bytes crudos (con padding) permiten reenviar un atributo tal cual al kernel.
+    """
+    while offset + NLA_HDR.size <= len(data):
+        length, attr_type = NLA_HDR.unpack_from(data, offset)
+        if length < NLA_HDR.size:
+            break
+        payload = data[offset + NLA_HDR.size:offset + length]
+        raw = data[offset:offset + length] + b"\0" * (align4(length) - length)
+        yield attr_type & NLA_TYPE_MASK, payload, raw
+        offset += align4(length)
+
+
+def parse_attrs(data: bytes, offset: int = 0) -> Dict[int, bytes]:
+    """Devuelve {tipo: payload} para los atributos de un bloque (el último gana)."""
+    return {attr_type: payload for attr_type, payload, _raw in iter_attrs_raw(data, offset)}
+
+
+def check_error(payload: bytes) -> int:
+    """
+    Interpreta el payload de un NLMSG_ERROR y devuelve el errno positivo
+    (0 significa ACK correcto).
+    """
+    (error,) = struct.unpack_from("=i", payload, 0)
+    return -error
+
+
+def open_socket(protocol: int, groups: int = 0, rcvbuf: int = 1 << 20) -> socket.socket:
+    """Abre y enlaza un socket netlink del protocolo indicado."""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.bind((0, groups))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def raise_for_errno(errno_value: int, context: str) -> None:
+    """Lanza NetlinkError con el mensaje del sistema para errno_value (si no es 0)."""
+    if errno_value:
+        raise NetlinkError(errno_value, f"{context}: {os.strerror(errno_value)}")
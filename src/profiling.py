@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+profiling.py
+
+Perfilado bajo demanda y tiempos por fase de cada petición.
+
+- Temporizador por fases (recv, parse, auth, arp, session, firewall, send):
+  con PORTAL_SLOW_REQUEST_MS > 0, las peticiones que superan ese umbral se
+  registran con el desglose por fase. marcar() puede llamarse desde cualquier
+  módulo; usa el temporizador del hilo actual.
+- SIGUSR1 activa/desactiva el perfilado: mientras está activo, una fracción
+  PORTAL_PROFILE_SAMPLE de las peticiones se perfila con cProfile (una a la
+  vez) y tracemalloc sigue las asignaciones. Al desactivarlo se escriben en
+  logs/ las estadísticas acumuladas (.pstats y resumen .txt) y la diferencia
+  de memoria entre el inicio y el final.
+
+Deshabilitado, el coste por petición es una consulta a un threading.local.
+"""
+
+from __future__ import annotations
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, Optional
+
+# Umbral de petición lenta en milisegundos (0 = temporizador deshabilitado)
+SLOW_REQUEST_MS = float(os.getenv("PORTAL_SLOW_REQUEST_MS", "0"))
+# Fracción de peticiones perfiladas con cProfile mientras el perfilado está activo
+PROFILE_SAMPLE = float(os.getenv("PORTAL_PROFILE_SAMPLE", "0.1"))
+PROFILE_SIGNAL = getattr(signal, "SIGUSR1", None)
+TRACEMALLOC_FRAMES = int(os.getenv("PORTAL_TRACEMALLOC_FRAMES", "10"))
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+LOGS_DIR = REPO_ROOT / "logs"
+
+_local = threading.local()
+
+# Estado del perfilado (alternado por señal)
+_activo = False
+_estado_lock = threading.Lock()
+# cProfile admite un único perfilador activo a la vez de forma fiable
+_perfil_lock = threading.Lock()
+_stats: Optional[pstats.Stats] = None
+_peticiones_perfiladas = 0
+_snapshot_inicial: Optional[tracemalloc.Snapshot] = None
+_inicio_perfilado = 0.0
+
+
+class PhaseTimer:
+    """Acumula el tiempo transcurrido entre marcas, por nombre de fase."""
+
+    __slots__ = ("inicio", "ultimo", "fases")
+
+    def __init__(self) -> None:
+        self.inicio = self.ultimo = time.perf_counter()
+        self.fases: Dict[str, float] = {}
+
+    def marcar(self, fase: str) -> None:
+        """Atribuye a `fase` el tiempo desde la marca anterior."""
+        now = time.perf_counter()
+        self.fases[fase] = self.fases.get(fase, 0.0) + (now - self.ultimo)
+        self.ultimo = now
+
+    def total_ms(self) -> float:
+        return (self.ultimo - self.inicio) * 1000.0
+
+    def desglose(self) -> str:
+        return " ".join(f"{fase}={seg * 1000.0:.1f}" for fase, seg in self.fases.items())
+
+
+def iniciar_peticion() -> None:
+    """Prepara el temporizador (y, si toca, cProfile) para la petición del hilo actual."""
+    if SLOW_REQUEST_MS <= 0 and not _activo:
+        return
+    _local.timer = PhaseTimer()
+    if _activo and random.random() < PROFILE_SAMPLE and _perfil_lock.acquire(blocking=False):
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Otro perfilador ya activo en el proceso
+            _perfil_lock.release()
+            return
+        _local.perfil = perfil
+
+
+def marcar(fase: str) -> None:
+    """Marca el fin de una fase de la petición en curso (no hace nada si no hay temporizador)."""
+    timer = getattr(_local, "timer", None)
+    if timer is not None:
+        timer.marcar(fase)
+
+
+def terminar_peticion(descripcion: str) -> None:
+    """Cierra el temporizador de la petición y registra si fue lenta."""
+    global _stats, _peticiones_perfiladas
+    timer = getattr(_local, "timer", None)
+    if timer is None:
+        return
+    _local.timer = None
+
+    perfil = getattr(_local, "perfil", None)
+    if perfil is not None:
+        perfil.disable()
+        _local.perfil = None
+        _perfil_lock.release()
+        with _estado_lock:
+            if _activo:
+                if _stats is None:
+                    _stats = pstats.Stats(perfil)
+                else:
+                    _stats.add(perfil)
+                _peticiones_perfiladas += 1
+
+    total = timer.total_ms()
+    if SLOW_REQUEST_MS > 0 and total >= SLOW_REQUEST_MS:
+        logging.warning(
+            "Petición lenta (%.1f ms): %s [ms: %s]", total, descripcion, timer.desglose()
+        )
+
+
+def _volcar(stats: Optional[pstats.Stats], peticiones: int, inicial, final, duracion: float) -> None:
+    """Escribe en logs/ las estadísticas de cProfile y la diferencia de tracemalloc."""
+    LOGS_DIR.mkdir(parents=True, exist_ok=True)
+    marca = time.strftime("%Y%m%d-%H%M%S")
+    if stats is not None:
+        ruta = LOGS_DIR / f"profile-{marca}.pstats"
+        stats.dump_stats(str(ruta))
+        resumen = io.StringIO()
+        stats.stream = resumen
+        stats.sort_stats("cumulative").print_stats(40)
+        (LOGS_DIR / f"profile-{marca}.txt").write_text(
+            f"# {peticiones} peticiones perfiladas en {duracion:.1f}s\n" + resumen.getvalue(),
+            encoding="utf-8",
+        )
+        logging.info("Perfil cProfile guardado en %s (%d peticiones)", ruta, peticiones)
+    else:
+        logging.info("Perfilado desactivado sin peticiones muestreadas")
+
+    if inicial is not None and final is not None:
+        lineas = [f"# tracemalloc: diferencia en {duracion:.1f}s (top 30 por línea)"]
+        lineas += [str(stat) for stat in final.compare_to(inicial, "lineno")[:30]]
+        lineas.append("")
+        lineas.append("# top 30 asignaciones vivas")
+        lineas += [str(stat) for stat in final.statistics("lineno")[:30]]
+        ruta = LOGS_DIR / f"tracemalloc-{marca}.txt"
+        ruta.write_text("\n".join(lineas) + "\n", encoding="utf-8")
+        logging.info("Instantánea tracemalloc guardada en %s", ruta)
+
+
+def alternar() -> bool:
+    """Activa o desactiva el perfilado. Devuelve el nuevo estado."""
+    global _activo, _stats, _peticiones_perfiladas, _snapshot_inicial, _inicio_perfilado
+    with _estado_lock:
+        if not _activo:
+            _stats = None
+            _peticiones_perfiladas = 0
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            _snapshot_inicial = tracemalloc.take_snapshot()
+            _inicio_perfilado = time.time()
+            _activo = True
+            logging.info(
+                "Perfilado ACTIVADO (muestreo %.0f%% de peticiones, tracemalloc)", PROFILE_SAMPLE * 100
+            )
+            return True
+
+        _activo = False
+        stats, peticiones = _stats, _peticiones_perfiladas
+        inicial, _snapshot_inicial = _snapshot_inicial, None
+        final = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        tracemalloc.stop()
+        _stats = None
+        duracion = time.time() - _inicio_perfilado
+    _volcar(stats, peticiones, inicial, final, duracion)
+    return False
+
+
+def manejar_senal(signum, frame) -> None:  # noqa: ARG001
+    """Manejador de PROFILE_SIGNAL: alterna el perfilado en un hilo aparte (el volcado puede tardar)."""
+    threading.Thread(target=alternar, daemon=True, name="profiling-toggle").start()
+
+
+if __name__ == "__main__":
+    # Prueba manual: python3 src/profiling.py
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    SLOW_REQUEST_MS = 1.0
+    PROFILE_SAMPLE = 1.0
+    alternar()
+    for _ in range(3):
+        iniciar_peticion()
+        time.sleep(0.002)
+        marcar("recv")
+        sum(i * i for i in range(20000))
+        marcar("parse")
+        terminar_peticion("GET /demo")
+    alternar()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+replication.py
+
+Replicación activo/standby de sesiones entre dos instancias del portal.
+
+- El primario (PORTAL_REPLICATION_ROLE=primary) escucha en
+  PORTAL_REPLICATION_LISTEN (``host:puerto`` o ``unix:/ruta``) y envía a cada
+  standby los cambios del módulo sessions (crear, eliminar/expirar, consumo).
+- El standby (PORTAL_REPLICATION_ROLE=standby) se conecta a
+  PORTAL_REPLICATION_PRIMARY y aplica los cambios a su propio almacén y
+  firewall, de modo que tras una conmutación nadie tiene que volver a entrar.
+
+Protocolo: líneas JSON sobre TCP o socket Unix.
+- standby -> primario: ``{"epoch", "seq", "token"}`` al conectar y luego
+  ``{"ack": seq}`` tras cada latido.
+- primario -> standby: una instantánea ``{"tipo": "instantanea", "seq", ...}``
+  si no puede ponerse al día solo con el registro de cambios reciente
+  (o el standby viene de otra "época" del primario), luego los cambios
+  ``{"seq", "ts", "tipo", "datos"}`` en orden y un ``latido`` tras cada envío
+  (o cada PORTAL_REPLICATION_HEARTBEAT segundos si no hay cambios).
+
+Ambos lados llevan métricas de retraso (eventos y segundos) en obtener_metricas().
+"""
+
+from __future__ import annotations
+
+import hmac
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import sessions
+
+ROLE = os.getenv("PORTAL_REPLICATION_ROLE", "").strip().lower()
+LISTEN_ADDRESS = os.getenv("PORTAL_REPLICATION_LISTEN", "0.0.0.0:7070")
+PRIMARY_ADDRESS = os.getenv("PORTAL_REPLICATION_PRIMARY", "")
+# Secreto compartido opcional (el standby lo envía al conectar)
+TOKEN = os.getenv("PORTAL_REPLICATION_TOKEN", "")
+# Cambios que el primario guarda para ponerse al día sin instantánea
+LOG_SIZE = int(os.getenv("PORTAL_REPLICATION_LOG_SIZE", "10000"))
+HEARTBEAT = float(os.getenv("PORTAL_REPLICATION_HEARTBEAT", "1"))
+# Sin noticias del primario en este tiempo, el standby reconecta
+TIMEOUT = float(os.getenv("PORTAL_REPLICATION_TIMEOUT", "10"))
+# El standby aplica también las reglas de firewall (0 = solo sesiones, p. ej. pruebas en una máquina)
+APPLY_FIREWALL = os.getenv("PORTAL_REPLICATION_FIREWALL", "1") != "0"
+METRICS_INTERVAL = int(os.getenv("PORTAL_REPLICATION_METRICS_INTERVAL", "60"))
+
+# --- Estado del primario ---
+_cond = threading.Condition()
+_registro: Deque[dict] = deque(maxlen=LOG_SIZE)
+_seq = 0
+# Identifica esta ejecución del primario: otro epoch obliga a una instantánea
+_epoch = uuid.uuid4().hex
+_replicas: Dict[str, dict] = {}
+
+# --- Estado del standby ---
+_standby: Dict[str, object] = {
+    "conectado": False,
+    "epoch": None,
+    "seq_aplicada": 0,
+    "seq_primario": 0,
+    "ultimo_latido": 0.0,
+    "retraso_ultimo_evento": 0.0,
+    "instantaneas": 0,
+    "reconexiones": 0,
+}
+
+
+def _parse_direccion(texto: str) -> Tuple[int, object]:
+    """Traduce ``unix:/ruta`` o ``host:puerto`` a (familia, dirección)."""
+    if texto.startswith("unix:"):
+        return socket.AF_UNIX, texto[len("unix:"):]
+    host, _, port = texto.rpartition(":")
+    return socket.AF_INET, (host or "0.0.0.0", int(port))
+
+
+def _enviar(conn: socket.socket, mensajes: list[dict]) -> None:
+    conn.sendall(b"".join(json.dumps(m, separators=(",", ":")).encode("utf-8") + b"\n" for m in mensajes))
+
+
+# ---------------------------------------------------------------------------
+# Primario
+# ---------------------------------------------------------------------------
+
+def _on_cambio(tipo: str, datos: dict) -> None:
+    """Observador de sessions (llamado con su lock tomado): añade el cambio al registro."""
+    global _seq
+    if sessions.cambio_replicado():
+        return  # ya viene del primario: no reenviarlo
+    with _cond:
+        _seq += 1
+        _registro.append({"seq": _seq, "ts": time.time(), "tipo": tipo, "datos": datos})
+        _cond.notify_all()
+
+
+def _pendientes_desde(siguiente: int) -> Optional[list[dict]]:
+    """Cambios con seq >= siguiente (llamar con _cond). None si ya no están en el registro."""
+    if siguiente > _seq:
+        return []
+    if not _registro or _registro[0]["seq"] > siguiente:
+        return None
+    return list(itertools.islice(_registro, siguiente - _registro[0]["seq"], None))
+
+
+def _leer_acks(conn: socket.socket, lector, nombre: str) -> None:
+    """Lee las confirmaciones del standby y actualiza sus métricas."""
+    try:
+        for linea in lector:
+            ack = json.loads(linea).get("ack")
+            if ack is not None:
+                with _cond:
+                    _replicas[nombre]["seq_confirmada"] = int(ack)
+                    _replicas[nombre]["ultimo_ack"] = time.time()
+    except (OSError, ValueError) as exc:
+        logging.debug("[REPL] Lectura de acks de %s terminada: %s", nombre, exc)
+    finally:
+        with _cond:
+            _replicas[nombre]["conectada"] = False
+            _cond.notify_all()
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _servir_replica(conn: socket.socket, nombre: str, stop_event: threading.Event) -> None:
+    """Atiende a un standby: instantánea si hace falta y después el flujo de cambios."""
+    try:
+        conn.settimeout(TIMEOUT)
+        lector = conn.makefile("rb")
+        hola = json.loads(lector.readline() or b"{}")
+        if TOKEN and not hmac.compare_digest(str(hola.get("token", "")), TOKEN):
+            logging.warning("[REPL] Standby %s rechazado: token inválido", nombre)
+            return
+        conn.settimeout(None)
+
+        siguiente: Optional[int] = None
+        with _cond:
+            if hola.get("epoch") == _epoch:
+                desde = int(hola.get("seq", 0))
+                if _pendientes_desde(desde + 1) is not None:
+                    siguiente = desde + 1
+            _replicas[nombre] = {
+                "conectada": True,
+                "desde": time.time(),
+                "seq_confirmada": int(hola.get("seq", 0)) if siguiente is not None else 0,
+                "ultimo_ack": time.time(),
+            }
+        logging.info(
+            "[REPL] Standby conectado: %s (%s)",
+            nombre,
+            "incremental" if siguiente is not None else "instantánea",
+        )
+        threading.Thread(
+            target=_leer_acks, args=(conn, lector, nombre), daemon=True, name=f"repl-ack-{nombre}"
+        ).start()
+
+        while not stop_event.is_set():
+            if siguiente is None:
+                estado, seq = sessions.exportar_estado(lambda: _seq)
+                _enviar(conn, [{
+                    "tipo": "instantanea",
+                    "epoch": _epoch,
+                    "seq": seq,
+                    "ts": time.time(),
+                    "datos": {"sesiones": estado},
+                }])
+                siguiente = seq + 1
+
+            with _cond:
+                if _seq < siguiente and _replicas[nombre]["conectada"]:
+                    _cond.wait(HEARTBEAT)
+                if not _replicas[nombre]["conectada"]:
+                    break
+                pendientes = _pendientes_desde(siguiente)
+                actual = _seq
+            if pendientes is None:
+                logging.warning("[REPL] Standby %s se quedó atrás del registro; reenviando instantánea", nombre)
+                siguiente = None
+                continue
+            latido = {"tipo": "latido", "epoch": _epoch, "seq": actual, "ts": time.time()}
+            _enviar(conn, pendientes + [latido])
+            if pendientes:
+                siguiente = pendientes[-1]["seq"] + 1
+    except (OSError, ValueError) as exc:
+        logging.info("[REPL] Conexión con standby %s cerrada: %s", nombre, exc)
+    finally:
+        with _cond:
+            if nombre in _replicas:
+                _replicas[nombre]["conectada"] = False
+        conn.close()
+
+
+def _escuchar(stop_event: threading.Event) -> None:
+    """Acepta standbys. Reintenta el bind (tras una recarga la instancia anterior aún lo ocupa)."""
+    familia, direccion = _parse_direccion(LISTEN_ADDRESS)
+    while not stop_event.is_set():
+        servidor = socket.socket(familia, socket.SOCK_STREAM)
+        try:
+            if familia == socket.AF_UNIX:
+                if os.path.exists(direccion):
+                    os.unlink(direccion)
+            else:
+                servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            servidor.bind(direccion)
+            servidor.listen(8)
+            break
+        except OSError as exc:
+            servidor.close()
+            logging.warning("[REPL] No se pudo escuchar en %s (%s); reintentando", LISTEN_ADDRESS, exc)
+            stop_event.wait(1.0)
+    else:
+        return
+
+    logging.info("[REPL] Primario escuchando réplicas en %s (epoch %s)", LISTEN_ADDRESS, _epoch)
+    servidor.settimeout(1.0)
+    with servidor:
+        while not stop_event.is_set():
+            try:
+                conn, addr = servidor.accept()
+            except socket.timeout:
+                continue
+            except OSError as exc:
+                logging.error("[REPL] Error aceptando réplica: %s", exc)
+                continue
+            nombre = f"{addr[0]}:{addr[1]}" if isinstance(addr, tuple) else f"unix-{conn.fileno()}"
+            threading.Thread(
+                target=_servir_replica, args=(conn, nombre, stop_event), daemon=True, name=f"repl-{nombre}"
+            ).start()
+
+
+# ---------------------------------------------------------------------------
+# Standby
+# ---------------------------------------------------------------------------
+
+def _aplicar_mensaje(msg: dict) -> bool:
+    """Aplica un mensaje del primario. Devuelve False si hay un hueco en la secuencia."""
+    tipo = msg.get("tipo")
+    if tipo == "latido":
+        _standby["seq_primario"] = msg["seq"]
+        _standby["ultimo_latido"] = time.time()
+        return True
+    if tipo == "instantanea":
+        total = sessions.aplicar_instantanea(msg["datos"]["sesiones"], aplicar_firewall=APPLY_FIREWALL)
+        _standby.update(epoch=msg["epoch"], seq_aplicada=msg["seq"], seq_primario=msg["seq"])
+        _standby["instantaneas"] = int(_standby["instantaneas"]) + 1
+        logging.info("[REPL] Instantánea recibida (seq %d, %d sesiones)", msg["seq"], total)
+        return True
+    if msg["seq"] != int(_standby["seq_aplicada"]) + 1:
+        logging.warning(
+            "[REPL] Hueco en la secuencia (esperado %d, recibido %d); se pedirá instantánea",
+            int(_standby["seq_aplicada"]) + 1,
+            msg["seq"],
+        )
+        return False
+    sessions.aplicar_replica(tipo, msg["datos"], aplicar_firewall=APPLY_FIREWALL)
+    _standby["seq_aplicada"] = msg["seq"]
+    _standby["retraso_ultimo_evento"] = max(0.0, time.time() - msg["ts"])
+    return True
+
+
+def _seguir_primario(stop_event: threading.Event) -> None:
+    """Bucle del standby: conecta, se pone al día y aplica cambios; reconecta si se corta."""
+    familia, direccion = _parse_direccion(PRIMARY_ADDRESS)
+    espera = 1.0
+    while not stop_event.is_set():
+        try:
+            conn = socket.socket(familia, socket.SOCK_STREAM)
+            conn.settimeout(TIMEOUT)
+            conn.connect(direccion)
+        except OSError as exc:
+            conn.close()
+            logging.debug("[REPL] Primario %s no disponible: %s", PRIMARY_ADDRESS, exc)
+            stop_event.wait(espera)
+            espera = min(espera * 2, 30.0)
+            continue
+
+        espera = 1.0
+        _standby["conectado"] = True
+        logging.info("[REPL] Conectado al primario %s", PRIMARY_ADDRESS)
+        try:
+            with conn:
+                _enviar(conn, [{"epoch": _standby["epoch"], "seq": _standby["seq_aplicada"], "token": TOKEN}])
+                for linea in conn.makefile("rb"):
+                    msg = json.loads(linea)
+                    if not _aplicar_mensaje(msg):
+                        _standby["epoch"] = None
+                        break
+                    if msg.get("tipo") in {"latido", "instantanea"}:
+                        _enviar(conn, [{"ack": _standby["seq_aplicada"]}])
+                    if stop_event.is_set():
+                        break
+        except (OSError, ValueError, KeyError) as exc:
+            logging.warning("[REPL] Conexión con el primario perdida: %s", exc)
+        _standby["conectado"] = False
+        _standby["reconexiones"] = int(_standby["reconexiones"]) + 1
+        stop_event.wait(espera)
+
+
+# ---------------------------------------------------------------------------
+# API
+# ---------------------------------------------------------------------------
+
+def obtener_metricas() -> dict:
+    """Métricas de replicación del rol actual (retraso en eventos y segundos)."""
+    now = time.time()
+    if ROLE == "standby":
+        metricas = dict(_standby)
+        metricas["rol"] = "standby"
+        metricas["retraso_eventos"] = max(0, int(_standby["seq_primario"]) - int(_standby["seq_aplicada"]))
+        ultimo = float(_standby["ultimo_latido"])
+        metricas["segundos_sin_latido"] = now - ultimo if ultimo else None
+        return metricas
+
+    with _cond:
+        replicas = {}
+        for nombre, info in _replicas.items():
+            confirmada = info["seq_confirmada"]
+            pendiente = _pendientes_desde(confirmada + 1)
+            retraso_s = now - pendiente[0]["ts"] if pendiente else 0.0
+            replicas[nombre] = {
+                "conectada": info["conectada"],
+                "seq_confirmada": confirmada,
+                "retraso_eventos": _seq - confirmada,
+                "retraso_segundos": round(retraso_s, 3),
+                "segundos_desde_ack": round(now - info["ultimo_ack"], 3),
+            }
+        return {"rol": "primary", "epoch": _epoch, "seq": _seq, "replicas": replicas}
+
+
+def _registrar_metricas(stop_event: threading.Event) -> None:
+    while not stop_event.wait(METRICS_INTERVAL):
+        logging.info("[REPL] Métricas: %s", json.dumps(obtener_metricas(), default=str))
+
+
+def iniciar(stop_event: threading.Event) -> None:
+    """Arranca la replicación según PORTAL_REPLICATION_ROLE (vacío = deshabilitada)."""
+    if ROLE == "primary":
+        sessions.registrar_observador(_on_cambio)
+        threading.Thread(target=_escuchar, args=(stop_event,), daemon=True, name="repl-listen").start()
+    elif ROLE == "standby":
+        if not PRIMARY_ADDRESS:
+            logging.error("[REPL] PORTAL_REPLICATION_PRIMARY no definido; replicación deshabilitada")
+            return
+        threading.Thread(target=_seguir_primario, args=(stop_event,), daemon=True, name="repl-standby").start()
+    else:
+        if ROLE:
+            logging.error("[REPL] PORTAL_REPLICATION_ROLE desconocido: %s", ROLE)
+        return
+    if METRICS_INTERVAL > 0:
+        threading.Thread(
+            target=_registrar_metricas, args=(stop_event,), daemon=True, name="repl-metrics"
+        ).start()
+
+
+if __name__ == "__main__":
+    # Prueba manual en una sola máquina (sin firewall):
+    #   PORTAL_REPLICATION_ROLE=primary PORTAL_REPLICATION_LISTEN=127.0.0.1:7070 \
+    #     PORTAL_SESSIONS_FILE=/tmp/p.json python3 src/replication.py
+    #   PORTAL_REPLICATION_ROLE=standby PORTAL_REPLICATION_PRIMARY=127.0.0.1:7070 \
+    #     PORTAL_REPLICATION_FIREWALL=0 PORTAL_SESSIONS_FILE=/tmp/s.json python3 src/replication.py
+    # El primario crea y elimina sesiones de prueba; ambos imprimen sus métricas.
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    sessions.cargar_sesiones(aplicar_firewall=False)
+    stop = threading.Event()
+    iniciar(stop)
+    try:
+        n = 0
+        while True:
+            time.sleep(2)
+            if ROLE == "primary":
+                n += 1
+                sessions.crear_sesion(f"demo{n}", f"10.0.0.{n % 250 + 1}", ttl=600, aplicar_firewall=False)
+                if n % 3 == 0:
+                    sessions.eliminar_sesion(f"10.0.0.{(n - 1) % 250 + 1}", aplicar_firewall=False)
+            print(json.dumps(obtener_metricas(), default=str))
+    except KeyboardInterrupt:
+        stop.set()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+session_tokens.py
+
+Tokens de sesión firmados con HMAC (cookie) para validar a un cliente sin
+consultar el almacén de sesiones ni su lock.
+
+Formato: base64url(carga) "." base64url(HMAC-SHA256(clave, carga)[:16]), con
+carga binaria compacta:
+
+    versión (1) | emitido_ms (8) | expira (4, 0 = sin expiración)
+    | IPv4 (4) | MAC (6, ceros = sin MAC) | usuario (UTF-8)
+
+Cualquier proceso o gateway con la misma clave (PORTAL_TOKEN_KEY, o el
+archivo PORTAL_TOKEN_KEY_FILE, que se crea con una clave aleatoria si no
+existe) puede verificarlo.
+
+Revocación: cuando una sesión se elimina antes de tiempo (logout, cuota,
+inactividad...) se registra (IP, instante) y se rechazan los tokens de esa IP
+emitidos antes. La lista se persiste en PORTAL_TOKEN_REVOCATIONS_FILE y otros
+procesos la recargan al cambiar (como mucho una comprobación por segundo).
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+import sessions
+
+ENABLED = os.getenv("PORTAL_SESSION_TOKENS", "1").strip().lower() in {"1", "true", "yes", "on"}
+COOKIE_NAME = os.getenv("PORTAL_TOKEN_COOKIE", "portal_session")
+REPO_ROOT = Path(__file__).resolve().parent.parent
+KEY_FILE = Path(os.getenv("PORTAL_TOKEN_KEY_FILE") or REPO_ROOT / "config" / "token.key")
+REVOCATIONS_FILE = Path(os.getenv("PORTAL_TOKEN_REVOCATIONS_FILE") or REPO_ROOT / "config" / "revoked_tokens.json")
+
+_VERSION = 1
+_CABECERA = struct.Struct("!BQI4s6s")
+_FIRMA_BYTES = 16
+_SIN_MAC = b"\0" * 6
+
+_clave: Optional[bytes] = None
+_clave_lock = threading.Lock()
+
+# Revocaciones: IP -> instante (ms) antes del cual sus tokens no valen
+_revocadas: Dict[str, int] = {}
+_revocadas_lock = threading.Lock()
+_revocadas_mtime = 0.0
+_revocadas_revisado = 0.0
+_guardado_pendiente: Optional[threading.Timer] = None
+
+
+@dataclass(frozen=True)
+class TokenSesion:
+    """Contenido verificado de un token."""
+
+    username: str
+    ip: str
+    mac: Optional[str]
+    login_time: float
+    expires_at: Optional[float]
+
+
+def _b64(datos: bytes) -> str:
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode("ascii")
+
+
+def _unb64(texto: str) -> bytes:
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def _obtener_clave() -> bytes:
+    """Clave compartida: PORTAL_TOKEN_KEY o el archivo de clave (se crea si no existe)."""
+    global _clave
+    if _clave is not None:
+        return _clave
+    with _clave_lock:
+        if _clave is not None:
+            return _clave
+        env = os.getenv("PORTAL_TOKEN_KEY")
+        if env:
+            _clave = env.encode("utf-8")
+            return _clave
+        try:
+            _clave = bytes.fromhex(KEY_FILE.read_text(encoding="ascii").strip())
+        except FileNotFoundError:
+            _clave = secrets.token_bytes(32)
+            try:
+                KEY_FILE.parent.mkdir(parents=True, exist_ok=True)
+                fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "w", encoding="ascii") as f:
+                    f.write(_clave.hex() + "\n")
+                logging.info("Clave de tokens de sesión generada en %s", KEY_FILE)
+            except FileExistsError:
+                # Otro proceso la creó a la vez: usar la suya
+                _clave = bytes.fromhex(KEY_FILE.read_text(encoding="ascii").strip())
+            except OSError as exc:
+                logging.warning("No se pudo guardar la clave de tokens en %s (%s); solo vale en este proceso", KEY_FILE, exc)
+        except (OSError, ValueError) as exc:
+            logging.error("Clave de tokens ilegible en %s (%s); usando una temporal", KEY_FILE, exc)
+            _clave = secrets.token_bytes(32)
+        return _clave
+
+
+def _firmar(carga: bytes) -> bytes:
+    return hmac.new(_obtener_clave(), carga, hashlib.sha256).digest()[:_FIRMA_BYTES]
+
+
+def emitir(sess: "sessions.Session") -> str:
+    """Token firmado para la sesión (IP IPv4; con otras direcciones lanza ValueError)."""
+    try:
+        ip = socket.inet_aton(sess.ip)
+    except OSError as exc:
+        raise ValueError(f"IP no IPv4 para token: {sess.ip}") from exc
+    mac = bytes.fromhex(sess.mac.replace(":", "")) if sess.mac else _SIN_MAC
+    expira = int(sess.expires_at) if sess.expires_at is not None else 0
+    carga = _CABECERA.pack(_VERSION, int(sess.login_time * 1000), expira, ip, mac) + sess.username.encode("utf-8")
+    return f"{_b64(carga)}.{_b64(_firmar(carga))}"
+
+
+def _recargar_revocaciones(now: float) -> None:
+    """Relee la lista de revocaciones si otro proceso la cambió (como mucho una vez por segundo)."""
+    global _revocadas_mtime, _revocadas_revisado
+    if now - _revocadas_revisado < 1.0:
+        return
+    _revocadas_revisado = now
+    try:
+        mtime = REVOCATIONS_FILE.stat().st_mtime
+    except OSError:
+        return
+    if mtime == _revocadas_mtime:
+        return
+    try:
+        datos = json.loads(REVOCATIONS_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as exc:
+        logging.warning("Lista de revocaciones ilegible en %s: %s", REVOCATIONS_FILE, exc)
+        return
+    with _revocadas_lock:
+        for ip, instante in datos.items():
+            if int(instante) > _revocadas.get(ip, 0):
+                _revocadas[ip] = int(instante)
+        _revocadas_mtime = mtime
+
+
+def _guardar_revocaciones() -> None:
+    """Persiste la lista (llamar con _revocadas_lock tomado); descarta las ya inútiles."""
+    global _revocadas_mtime
+    if sessions.DEFAULT_SESSION_TTL > 0:
+        # Un token vive como mucho el TTL de sesión: las revocaciones más viejas sobran
+        limite = (time.time() - sessions.DEFAULT_SESSION_TTL) * 1000
+        for ip in [ip for ip, instante in _revocadas.items() if instante < limite]:
+            del _revocadas[ip]
+    try:
+        REVOCATIONS_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = REVOCATIONS_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(_revocadas), encoding="utf-8")
+        os.replace(tmp, REVOCATIONS_FILE)
+        _revocadas_mtime = REVOCATIONS_FILE.stat().st_mtime
+    except OSError as exc:
+        logging.error("No se pudo guardar la lista de revocaciones en %s: %s", REVOCATIONS_FILE, exc)
+
+
+def _guardar_diferido() -> None:
+    global _guardado_pendiente
+    with _revocadas_lock:
+        _guardado_pendiente = None
+        _guardar_revocaciones()
+
+
+def revocar_ip(ip: str, inmediato: bool = True) -> None:
+    """
+    Invalida todos los tokens de la IP emitidos hasta ahora. Con
+    inmediato=False la escritura a disco se agrupa (medio segundo después),
+    para no hacer E/S con el lock de sesiones tomado en las purgas masivas.
+    """
+    global _guardado_pendiente
+    if inmediato:
+        # Desde otro proceso (p. ej. scripts/reset_sessions.sh): no pisar la lista del portal
+        _recargar_revocaciones(time.time())
+    with _revocadas_lock:
+        _revocadas[ip] = int(time.time() * 1000)
+        if inmediato:
+            _guardar_revocaciones()
+        elif _guardado_pendiente is None:
+            _guardado_pendiente = threading.Timer(0.5, _guardar_diferido)
+            _guardado_pendiente.daemon = True
+            _guardado_pendiente.start()
+
+
+def verificar(token: str, ip: str, now: Optional[float] = None) -> Optional[TokenSesion]:
+    """
+    Devuelve el contenido del token si la firma es válida, no ha expirado,
+    pertenece a `ip` y no está revocado; si no, None.
+    """
+    if now is None:
+        now = time.time()
+    try:
+        carga_b64, firma_b64 = token.split(".", 1)
+        carga = _unb64(carga_b64)
+        firma = _unb64(firma_b64)
+    except (ValueError, TypeError):
+        return None
+    if len(carga) < _CABECERA.size or not hmac.compare_digest(firma, _firmar(carga)):
+        return None
+    version, emitido_ms, expira, ip_bytes, mac_bytes = _CABECERA.unpack_from(carga)
+    if version != _VERSION or (expira and now >= expira):
+        return None
+    if socket.inet_ntoa(ip_bytes) != ip:
+        return None
+    _recargar_revocaciones(now)
+    if emitido_ms <= _revocadas.get(ip, -1):
+        return None
+    try:
+        username = carga[_CABECERA.size:].decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    mac = None if mac_bytes == _SIN_MAC else ":".join(f"{b:02x}" for b in mac_bytes)
+    return TokenSesion(username, ip, mac, emitido_ms / 1000.0, float(expira) if expira else None)
+
+
+def _on_cambio(tipo: str, datos: dict) -> None:
+    """Observador de sessions: una baja anticipada revoca los tokens de la IP."""
+    # Las expiradas no hace falta: el token lleva la misma expiración que la sesión
+    if tipo == "eliminar" and datos.get("motivo") != "expirada":
+        revocar_ip(datos["ip"], inmediato=False)
+
+
+def iniciar() -> None:
+    """Prepara la clave y engancha la revocación automática (llamar al arrancar)."""
+    if not ENABLED:
+        return
+    _obtener_clave()
+    _recargar_revocaciones(time.time())
+    sessions.registrar_observador(_on_cambio)
+
+
+if __name__ == "__main__":
+    # Prueba manual: python3 src/session_tokens.py (usa una clave de prueba, sin firewall)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    os.environ.setdefault("PORTAL_TOKEN_KEY", "clave-de-prueba")
+    REVOCATIONS_FILE = Path("/tmp/portal-revoked-demo.json")
+    s = sessions.Session("admin", "10.0.2.15", "aa:bb:cc:dd:ee:ff", time.time(), time.time() + 3600)
+    token = emitir(s)
+    print(f"token ({len(token)} bytes): {token}")
+    print("verificar desde la IP correcta:", verificar(token, "10.0.2.15"))
+    print("verificar desde otra IP:", verificar(token, "10.0.2.16"))
+    print("firma alterada:", verificar(token[:-2] + ("AA" if token[-2:] != "AA" else "BB"), "10.0.2.15"))
+    time.sleep(0.01)
+    revocar_ip("10.0.2.15")
+    print("tras revocar la IP:", verificar(token, "10.0.2.15"))
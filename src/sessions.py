@@ -2,7 +2,9 @@
 """
 Módulo de gestión de sesiones en memoria para el portal cautivo.
 
-- Mantiene un mapa (IP[, MAC]) -> datos de sesión.
+- Mantiene un mapa (IP[, MAC]) -> datos de sesión, compacto en memoria:
+  registros con __slots__, IPv4 y MAC empaquetadas como enteros (también en
+  la clave interna) y nombres de usuario internados.
 - Proporciona funciones para crear, obtener y eliminar sesiones.
 - Cada sesión almacena:
     - usuario
@@ -10,6 +12,7 @@ Módulo de gestión de sesiones en memoria para el portal cautivo.
     - MAC (opcional)
     - hora de login
     - hora de expiración (opcional)
+    - bytes/paquetes consumidos y cuota de bytes (opcional)
 
 Este módulo está pensado para usarse desde el servidor HTTP
 cuando un usuario hace login correctamente.
@@ -19,29 +22,165 @@ from __future__ import annotations
 
 import logging
 import os
+import socket
+import sys
 import threading
 import time
-from dataclasses import dataclass
+from collections.abc import Mapping
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
 
 # Helper para reglas dinámicas de firewall
 import firewall_dynamic
+import profiling
 
 
-# Tipo de clave: IP sola o IP+MAC
-SessionKey = Tuple[str, Optional[str]]
+# IP y MAC empaquetadas: entero si es IPv4 / MAC de 6 octetos, cadena si no
+IpEmpaquetada = Union[int, str]
+MacEmpaquetada = Union[int, str, None]
+
+# Clave interna: un entero (IPv4 << 49 | MAC << 1 | hay MAC) o, si la IP o la
+# MAC no se pueden empaquetar (p. ej. IPv6), la tupla (ip, mac) empaquetadas.
+SessionKey = Union[int, Tuple[IpEmpaquetada, MacEmpaquetada]]
+
+
+def _empaquetar_ip(ip: str) -> IpEmpaquetada:
+    """IPv4 en notación decimal -> entero de 32 bits; cualquier otra cadena se conserva."""
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except (OSError, TypeError):
+        return ip
+
+
+def _desempaquetar_ip(ip: IpEmpaquetada) -> str:
+    if isinstance(ip, int):
+        return socket.inet_ntop(socket.AF_INET, ip.to_bytes(4, "big"))
+    return ip
+
+
+def _empaquetar_mac(mac: Optional[str]) -> MacEmpaquetada:
+    """MAC aa:bb:cc:dd:ee:ff (cualquier caja) -> entero de 48 bits; otras se guardan en minúsculas."""
+    if not mac:
+        return None
+    if len(mac) == 17 and mac.count(":") == 5:
+        try:
+            return int(mac.replace(":", ""), 16)
+        except ValueError:
+            pass
+    return mac.lower()
+
+
+def _desempaquetar_mac(mac: MacEmpaquetada) -> Optional[str]:
+    if isinstance(mac, int):
+        h = f"{mac:012x}"
+        return ":".join((h[0:2], h[2:4], h[4:6], h[6:8], h[8:10], h[10:12]))
+    return mac
+
+
+def _clave(ip: IpEmpaquetada, mac: MacEmpaquetada) -> SessionKey:
+    """Clave interna a partir de IP y MAC ya empaquetadas."""
+    if isinstance(ip, int):
+        if mac is None:
+            return ip << 49
+        if isinstance(mac, int):
+            return (ip << 49) | (mac << 1) | 1
+    return (ip, mac)
 
 
-@dataclass
 class Session:
-    """Datos almacenados para cada sesión activa."""
+    """
+    Datos almacenados para cada sesión activa.
+
+    Registro con __slots__ (sin __dict__ por instancia): la IP y la MAC se
+    guardan empaquetadas y se exponen como cadenas en `ip` y `mac`; el nombre
+    de usuario se interna (muchas sesiones comparten usuario).
+    """
+
+    __slots__ = (
+        "username",
+        "_ip",
+        "_mac",
+        "login_time",       # timestamp (time.time())
+        "expires_at",       # timestamp o None si no expira
+        "bytes_used",       # tráfico acumulado (subida + bajada)
+        "packets_used",
+        "byte_quota",       # límite de bytes o None si no hay cuota
+        # Última lectura cruda de los contadores de las reglas de la IP (None = sin lectura)
+        "counter_packets",
+        "counter_bytes",
+        "last_activity",    # último tráfico observado (None = solo login)
+    )
 
-    username: str
-    ip: str
-    mac: Optional[str]
-    login_time: float          # timestamp (time.time())
-    expires_at: Optional[float] = None  # timestamp o None si no expira
+    def __init__(
+        self,
+        username: str,
+        ip: str,
+        mac: Optional[str],
+        login_time: float,
+        expires_at: Optional[float] = None,
+        bytes_used: int = 0,
+        packets_used: int = 0,
+        byte_quota: Optional[int] = None,
+        counter_packets: Optional[int] = None,
+        counter_bytes: Optional[int] = None,
+        last_activity: Optional[float] = None,
+    ) -> None:
+        self.username = sys.intern(username)
+        self._ip = _empaquetar_ip(ip)
+        self._mac = _empaquetar_mac(mac)
+        self.login_time = login_time
+        self.expires_at = expires_at
+        self.bytes_used = bytes_used
+        self.packets_used = packets_used
+        self.byte_quota = byte_quota
+        self.counter_packets = counter_packets
+        self.counter_bytes = counter_bytes
+        self.last_activity = last_activity
+
+    @property
+    def ip(self) -> str:
+        return _desempaquetar_ip(self._ip)
+
+    @property
+    def mac(self) -> Optional[str]:
+        return _desempaquetar_mac(self._mac)
+
+    @property
+    def key(self) -> SessionKey:
+        """Clave interna de la sesión en el almacenamiento."""
+        return _clave(self._ip, self._mac)
+
+    def _campos(self) -> tuple:
+        return tuple(getattr(self, nombre) for nombre in self.__slots__)
+
+    def __eq__(self, other: object) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._campos() == other._campos()
+
+    __hash__ = None  # mutable, como el dataclass al que sustituye
+
+    def __repr__(self) -> str:
+        return (
+            f"Session(username={self.username!r}, ip={self.ip!r}, mac={self.mac!r}, "
+            f"login_time={self.login_time!r}, expires_at={self.expires_at!r}, "
+            f"bytes_used={self.bytes_used!r}, packets_used={self.packets_used!r}, "
+            f"byte_quota={self.byte_quota!r}, counter_packets={self.counter_packets!r}, "
+            f"counter_bytes={self.counter_bytes!r}, last_activity={self.last_activity!r})"
+        )
+
+    def quota_exceeded(self) -> bool:
+        """Devuelve True si la sesión tiene cuota de bytes y la ha superado."""
+        return self.byte_quota is not None and self.bytes_used >= self.byte_quota
+
+    def is_idle(self, timeout: float, now: Optional[float] = None) -> bool:
+        """Devuelve True si no hubo actividad en los últimos `timeout` segundos (timeout > 0)."""
+        if timeout <= 0:
+            return False
+        if now is None:
+            now = time.time()
+        ultima = self.last_activity if self.last_activity is not None else self.login_time
+        return now - ultima >= timeout
 
     def is_expired(self, now: Optional[float] = None) -> bool:
         """Devuelve True si la sesión está expirada (si tiene expiración)."""
@@ -54,10 +193,37 @@ class Session:
 
 # Almacenamiento en memoria
 _sessions: Dict[SessionKey, Session] = {}
+# Índice secundario IP empaquetada -> claves de sesión (consultas por IP sin
+# recorrer _sessions). Tupla en lugar de set: casi siempre hay una sola clave.
+_sessions_by_ip: Dict[IpEmpaquetada, Tuple[SessionKey, ...]] = {}
 
 # Lock para hacer el módulo seguro frente a múltiples hilos
 _lock = threading.Lock()
 
+# Generación del almacenamiento: se incrementa en cada alta/baja (bajo _lock).
+# Permite detectar si las sesiones cambiaron mientras se leía el firewall sin lock.
+_generation = 0
+
+# Contadores de deriva firewall <-> sesiones acumulados desde el arranque
+_drift_stats: Dict[str, float] = {
+    "reconciliaciones": 0,
+    "con_deriva": 0,
+    "reglas_faltantes": 0,
+    "reglas_sobrantes": 0,
+    "errores": 0,
+    "ultima_ejecucion": 0.0,
+}
+
+# Intentos de snapshot sin lock antes de leer el firewall con el lock tomado
+_RECONCILE_ATTEMPTS = 3
+
+# Observadores de cambios (replicación): fn(tipo, datos), llamados con _lock tomado
+_observadores: List[Callable[[str, dict], None]] = []
+# True mientras se notifica un cambio recibido del primario (ver cambio_replicado)
+_notificando_replica = False
+
+T = TypeVar("T")
+
 # Tiempo por defecto de duración de una sesión (en segundos).
 # Se puede ajustar con la variable de entorno PORTAL_SESSION_TTL.
 DEFAULT_SESSION_TTL = 60 * 60  # 1 hora
@@ -72,9 +238,48 @@ if _env_ttl:
             DEFAULT_SESSION_TTL,
         )
 
-# Ruta para persistir sesiones en disco
+# Cuota de bytes por sesión (PORTAL_SESSION_BYTE_QUOTA; 0 o vacío = sin cuota)
+DEFAULT_BYTE_QUOTA: Optional[int] = None
+_env_quota = os.getenv("PORTAL_SESSION_BYTE_QUOTA")
+if _env_quota:
+    try:
+        DEFAULT_BYTE_QUOTA = int(_env_quota) or None
+    except ValueError:
+        logging.warning("PORTAL_SESSION_BYTE_QUOTA inválido (%s); sesiones sin cuota", _env_quota)
+
+# Expiración por inactividad (PORTAL_SESSION_IDLE_TIMEOUT en segundos; 0 = deshabilitada).
+# La actividad se deduce de los contadores de tráfico y, con PORTAL_IDLE_CONNTRACK=1,
+# también de un volcado de conntrack (IPs con conexiones registradas).
+IDLE_TIMEOUT = 0
+_env_idle = os.getenv("PORTAL_SESSION_IDLE_TIMEOUT")
+if _env_idle:
+    try:
+        IDLE_TIMEOUT = max(0, int(_env_idle))
+    except ValueError:
+        logging.warning("PORTAL_SESSION_IDLE_TIMEOUT inválido (%s); sin expiración por inactividad", _env_idle)
+IDLE_USE_CONNTRACK = os.getenv("PORTAL_IDLE_CONNTRACK", "0").strip().lower() in {"1", "true", "yes", "on"}
+
+# Ruta para persistir sesiones en disco (PORTAL_SESSIONS_FILE permite otra, p. ej.
+# para dos instancias en la misma máquina)
 REPO_ROOT = Path(__file__).resolve().parent.parent
-DEFAULT_SESSIONS_FILE = REPO_ROOT / "config" / "sessions.json"
+DEFAULT_SESSIONS_FILE = Path(os.getenv("PORTAL_SESSIONS_FILE") or REPO_ROOT / "config" / "sessions.json")
+
+
+def _session_to_dict(sess: Session) -> dict:
+    """Representación JSON de una sesión (persistencia y replicación)."""
+    return {
+        "username": sess.username,
+        "ip": sess.ip,
+        "mac": sess.mac,
+        "login_time": sess.login_time,
+        "expires_at": sess.expires_at,
+        "bytes_used": sess.bytes_used,
+        "packets_used": sess.packets_used,
+        "byte_quota": sess.byte_quota,
+        "counter_packets": sess.counter_packets,
+        "counter_bytes": sess.counter_bytes,
+        "last_activity": sess.last_activity,
+    }
 
 
 def _serialize_sessions() -> Dict[str, dict]:
@@ -83,15 +288,8 @@ def _serialize_sessions() -> Dict[str, dict]:
     La clave se guarda como "ip" y "mac" en el payload.
     """
     payload: Dict[str, dict] = {}
-    for (ip, mac), sess in _sessions.items():
-        payload_key = f"{ip}|{mac or ''}"
-        payload[payload_key] = {
-            "username": sess.username,
-            "ip": sess.ip,
-            "mac": sess.mac,
-            "login_time": sess.login_time,
-            "expires_at": sess.expires_at,
-        }
+    for sess in _sessions.values():
+        payload[f"{sess.ip}|{sess.mac or ''}"] = _session_to_dict(sess)
     return payload
 
 
@@ -115,6 +313,18 @@ def _deserialize_sessions(data: Dict[str, dict]) -> Dict[SessionKey, "Session"]:
             login_time = float(raw_sess["login_time"])
             expires_at = raw_sess.get("expires_at")
             expires_at = float(expires_at) if expires_at is not None else None
+            byte_quota = raw_sess.get("byte_quota")
+            byte_quota = int(byte_quota) if byte_quota is not None else None
+            counter_packets = raw_sess.get("counter_packets")
+            counter_bytes = raw_sess.get("counter_bytes")
+            last_activity = raw_sess.get("last_activity")
+            contadores = {
+                "last_activity": float(last_activity) if last_activity is not None else None,
+                "bytes_used": int(raw_sess.get("bytes_used", 0)),
+                "packets_used": int(raw_sess.get("packets_used", 0)),
+                "counter_packets": int(counter_packets) if counter_packets is not None else None,
+                "counter_bytes": int(counter_bytes) if counter_bytes is not None else None,
+            }
         except Exception as exc:  # noqa: BLE001
             logging.warning("Entrada de sesión inválida en JSON (%s): %s", raw_key, exc)
             continue
@@ -122,16 +332,18 @@ def _deserialize_sessions(data: Dict[str, dict]) -> Dict[SessionKey, "Session"]:
         session = Session(
             username=username,
             ip=ip,
-            mac=mac.lower() if mac else None,
+            mac=mac,
             login_time=login_time,
             expires_at=expires_at,
+            byte_quota=byte_quota,
+            **contadores,
         )
 
         # Filtra expiradas al cargar
         if session.is_expired(now):
             continue
 
-        restored[_make_key(ip, mac)] = session
+        restored[session.key] = session
 
     return restored
 
@@ -150,13 +362,32 @@ def _save_to_disk(path: Path = DEFAULT_SESSIONS_FILE) -> None:
         logging.error("No se pudieron guardar las sesiones en %s: %s", path, exc)
 
 
-def _load_from_disk(path: Path = DEFAULT_SESSIONS_FILE) -> None:
+def _load_from_disk(path: Path = DEFAULT_SESSIONS_FILE, aplicar_firewall: bool = True) -> None:
     """
-    Carga sesiones desde disco, descartando las expiradas.
+    Carga sesiones desde disco, descartando las expiradas, y sincroniza el
+    firewall en bloque (una lectura del ruleset + un lote con lo que falte/sobre).
+
+    Con aplicar_firewall=False no se tocan las reglas (p. ej. tras una recarga
+    en caliente, cuando la instancia anterior ya las dejó aplicadas).
     """
-    if not path.exists():
+    inicio = time.perf_counter()
+    restored = _leer_sesiones_disco(path)
+    if restored is None:
         return
+    with _lock:
+        _replace_all(restored)
+        clientes = [(sess.ip, sess.mac) for sess in _sessions.values()]
+        if _observadores:
+            _notificar("reemplazo", {"sesiones": _serialize_sessions()})
+    logging.info("Sesiones restauradas desde disco: %d activas", len(clientes))
+    if aplicar_firewall:
+        _restaurar_firewall(clientes, inicio)
+
 
+def _leer_sesiones_disco(path: Path = DEFAULT_SESSIONS_FILE) -> Optional[Dict[SessionKey, Session]]:
+    """Lee y deserializa el archivo de sesiones (None si no existe o no se puede leer)."""
+    if not path.exists():
+        return None
     try:
         import json
 
@@ -164,32 +395,142 @@ def _load_from_disk(path: Path = DEFAULT_SESSIONS_FILE) -> None:
             data = json.load(f)
     except Exception as exc:  # noqa: BLE001
         logging.error("No se pudieron cargar sesiones desde %s: %s", path, exc)
-        return
+        return None
+    return _deserialize_sessions(data)
+
+
+def _restaurar_firewall(clientes: List[Tuple[str, Optional[str]]], inicio: float) -> None:
+    """Sincroniza las reglas con las sesiones vigentes (solo diferencias) y registra la duración."""
+    resultado = firewall_dynamic.restaurar_reglas(clientes)
+    duracion = time.perf_counter() - inicio
+    if resultado is None:
+        logging.info(
+            "Reglas de firewall re-aplicadas regla a regla para %d sesiones en %.2fs",
+            len(clientes),
+            duracion,
+        )
+    else:
+        agregadas, eliminadas = resultado
+        logging.info(
+            "Restauración de firewall: %d sesiones, %d reglas añadidas, %d obsoletas eliminadas en %.2fs",
+            len(clientes),
+            agregadas,
+            eliminadas,
+            duracion,
+        )
 
-    restored = _deserialize_sessions(data)
+
+def cargar_sesiones(aplicar_firewall: bool = True) -> None:
+    """
+    Restaura las sesiones persistidas en disco (llamar una vez al arrancar).
+    Importar este módulo ya no carga nada por sí solo.
+    """
+    _load_from_disk(DEFAULT_SESSIONS_FILE, aplicar_firewall=aplicar_firewall)
+
+
+def _store(key: SessionKey, session: Session) -> None:
+    """Guarda la sesión y actualiza el índice por IP. Llamar con _lock tomado."""
+    global _generation
+    _generation += 1
+    _sessions[key] = session
+    claves = _sessions_by_ip.get(session._ip, ())
+    if key not in claves:
+        _sessions_by_ip[session._ip] = claves + (key,)
+
+
+def _discard(key: SessionKey) -> Optional[Session]:
+    """Quita la sesión (si existe) y su entrada del índice. Llamar con _lock tomado."""
+    global _generation
+    _generation += 1
+    session = _sessions.pop(key, None)
+    if session is not None:
+        claves = tuple(k for k in _sessions_by_ip.get(session._ip, ()) if k != key)
+        if claves:
+            _sessions_by_ip[session._ip] = claves
+        else:
+            _sessions_by_ip.pop(session._ip, None)
+    return session
+
+
+def _replace_all(restored: Dict[SessionKey, Session]) -> None:
+    """Sustituye todo el almacenamiento y reconstruye el índice. Llamar con _lock tomado."""
+    _sessions.clear()
+    _sessions_by_ip.clear()
+    for key, session in restored.items():
+        _store(key, session)
+
+
+def _notificar(tipo: str, datos: dict) -> None:
+    """Avisa a los observadores de un cambio. Llamar con _lock tomado (mantiene el orden)."""
+    for observador in _observadores:
+        try:
+            observador(tipo, datos)
+        except Exception as exc:  # noqa: BLE001
+            logging.error("Error notificando cambio de sesiones (%s): %s", tipo, exc)
+
+
+def _notificar_baja(sess: Session, motivo: str) -> None:
+    """Notifica la eliminación de una sesión. Llamar con _lock tomado."""
+    if _observadores:
+        _notificar("eliminar", {"ip": sess.ip, "mac": sess.mac, "motivo": motivo})
+
+
+def _notificar_replica(tipo: str, datos: dict) -> None:
+    """Como _notificar, para un cambio que llega del primario. Llamar con _lock tomado."""
+    global _notificando_replica
+    _notificando_replica = True
+    try:
+        _notificar(tipo, datos)
+    finally:
+        _notificando_replica = False
+
+
+def cambio_replicado() -> bool:
+    """
+    Desde un observador: True si el cambio notificado viene del primario
+    (aplicar_replica/aplicar_instantanea) y no se originó en este nodo.
+    """
+    return _notificando_replica
+
+
+def registrar_observador(observador: Callable[[str, dict], None]) -> None:
+    """
+    Registra una función observador(tipo, datos) que recibe cada cambio:
+    "crear" (sesión completa), "eliminar" (ip, mac, motivo), "contadores"
+    (consumo actualizado) y "reemplazo" (todas las sesiones tras recargar).
+    Se llama con el lock interno tomado: debe ser rápida y no usar este módulo.
+    """
     with _lock:
-        _sessions.clear()
-        _sessions.update(restored)
-        logging.info("Sesiones restauradas desde disco: %d activas", len(_sessions))
-        # Reaplicar reglas de firewall para sesiones vigentes
-        for sess in _sessions.values():
-            if sess.mac:
-                firewall_dynamic.permitir_ip_mac(sess.ip, sess.mac)
-            else:
-                firewall_dynamic.permitir_ip(sess.ip)
+        _observadores.append(observador)
 
-        if _sessions:
-            logging.info("Reglas de firewall re-aplicadas para sesiones activas tras carga en disco.")
+
+def exportar_estado(marca: Callable[[], T]) -> Tuple[Dict[str, dict], T]:
+    """
+    Devuelve las sesiones serializadas junto con `marca()` evaluada bajo el
+    mismo lock, para asociar la instantánea a una posición exacta del flujo
+    de cambios enviado a los observadores.
+    """
+    with _lock:
+        return _serialize_sessions(), marca()
 
 
 def _make_key(ip: str, mac: Optional[str] = None) -> SessionKey:
     """
     Construye la clave interna para el diccionario de sesiones.
 
-    - Normaliza la MAC a minúsculas si se proporciona.
+    - Empaqueta la IPv4 y la MAC (sin distinguir mayúsculas) en un entero.
     """
-    mac_norm = mac.lower() if mac is not None else None
-    return (ip, mac_norm)
+    return _clave(_empaquetar_ip(ip), _empaquetar_mac(mac))
+
+
+def _claves_de_ip(ip: str) -> Tuple[SessionKey, ...]:
+    """Claves de las sesiones de una IP (índice secundario). Llamar con _lock tomado."""
+    return _sessions_by_ip.get(_empaquetar_ip(ip), ())
+
+
+def _macs_de_ip(ip: str) -> List[Optional[str]]:
+    """MACs (None = sin MAC) de las sesiones vivas de una IP. Llamar con _lock tomado."""
+    return [_sessions[key].mac for key in _claves_de_ip(ip)]
 
 
 def crear_sesion(
@@ -197,6 +538,8 @@ def crear_sesion(
     ip: str,
     mac: Optional[str] = None,
     ttl: Optional[int] = None,
+    byte_quota: Optional[int] = None,
+    aplicar_firewall: bool = True,
 ) -> Session:
     """
     Crea (o reemplaza) una sesión para (ip, mac) y la devuelve.
@@ -207,9 +550,16 @@ def crear_sesion(
     - mac: MAC del cliente (opcional).
     - ttl: tiempo de vida en segundos; si es None, usa DEFAULT_SESSION_TTL.
            Si ttl <= 0, la sesión no expira (expires_at = None).
+    - byte_quota: cuota de bytes; si es None, usa DEFAULT_BYTE_QUOTA.
+           Si byte_quota <= 0, la sesión no tiene cuota.
+    - aplicar_firewall: con False no se añaden reglas (pruebas sin root).
     """
     if ttl is None:
         ttl = DEFAULT_SESSION_TTL
+    if byte_quota is None:
+        byte_quota = DEFAULT_BYTE_QUOTA
+    if byte_quota is not None and byte_quota <= 0:
+        byte_quota = None
 
     now = time.time()
     if ttl > 0:
@@ -217,32 +567,40 @@ def crear_sesion(
     else:
         expires_at = None
 
-    key = _make_key(ip, mac)
     session = Session(
         username=username,
         ip=ip,
-        mac=mac.lower() if mac is not None else None,
+        mac=mac,
         login_time=now,
         expires_at=expires_at,
+        byte_quota=byte_quota,
     )
+    key = session.key
 
     with _lock:
-        _sessions[key] = session
+        # Si la IP ya tenía reglas (sesión reemplazada), su tráfico previo no cuenta
+        _heredar_lectura_contadores(session)
+        _store(key, session)
+        if _observadores:
+            _notificar("crear", _session_to_dict(session))
         logging.info(
             "Creada/actualizada sesión para %s (usuario=%s, ttl=%s)",
-            key,
+            (session.ip, session.mac),
             username,
             ttl,
         )
         _save_to_disk()
+        profiling.marcar("session")
 
         # Permitir a la IP/mac navegar (si hay mac, usar ip+mac)
-        if session.mac:
-            firewall_dynamic.permitir_ip_mac(session.ip, session.mac)
-            logging.info("Regla de firewall añadida para permitir navegación a %s (MAC %s)", session.ip, session.mac)
-        else:
-            firewall_dynamic.permitir_ip(session.ip)
-            logging.info("Regla de firewall añadida para permitir navegación a %s", session.ip)
+        if aplicar_firewall:
+            if session.mac:
+                firewall_dynamic.permitir_ip_mac(session.ip, session.mac)
+                logging.info("Regla de firewall añadida para permitir navegación a %s (MAC %s)", session.ip, session.mac)
+            else:
+                firewall_dynamic.permitir_ip(session.ip)
+                logging.info("Regla de firewall añadida para permitir navegación a %s", session.ip)
+            profiling.marcar("firewall")
 
 
 
@@ -264,8 +622,9 @@ def obtener_sesion(ip: str, mac: Optional[str] = None) -> Optional[Session]:
             return None
 
         if session.is_expired(now):
-            logging.info("Sesión expirada para %s; eliminando", key)
-            _sessions.pop(key, None)
+            logging.info("Sesión expirada para %s; eliminando", (session.ip, session.mac))
+            _discard(key)
+            _notificar_baja(session, "expirada")
             _save_to_disk()
             if session.mac:
                 firewall_dynamic.denegar_ip_mac(session.ip, session.mac)
@@ -280,9 +639,12 @@ def obtener_sesion(ip: str, mac: Optional[str] = None) -> Optional[Session]:
         return session
 
 
-def eliminar_sesion(ip: str, mac: Optional[str] = None) -> bool:
+def eliminar_sesion(
+    ip: str, mac: Optional[str] = None, motivo: str = "logout", aplicar_firewall: bool = True
+) -> bool:
     """
-    Elimina la sesión asociada a (ip, mac).
+    Elimina la sesión asociada a (ip, mac). `motivo` se pasa a los observadores.
+    Con aplicar_firewall=False no se tocan las reglas.
 
     Devuelve:
     - True si existía una sesión y se eliminó.
@@ -290,14 +652,18 @@ def eliminar_sesion(ip: str, mac: Optional[str] = None) -> bool:
     """
     key = _make_key(ip, mac)
     with _lock:
-        existed = key in _sessions
+        session = _discard(key)
+        existed = session is not None
         if existed:
-            _sessions.pop(key, None)
-            logging.info("Sesión eliminada para %s", key)
+            _notificar_baja(session, motivo)
+            logging.info("Sesión eliminada para %s", (session.ip, session.mac))
             _save_to_disk()
+            profiling.marcar("session")
 
             # Eliminar regla de navegación (si existía MAC, usarla)
-            if mac := key[1]:
+            if not aplicar_firewall:
+                return existed
+            if mac := session.mac:
                 firewall_dynamic.denegar_ip_mac(ip, mac)
                 logging.info("Regla de firewall eliminada para %s (MAC %s)", ip, mac)
             else:
@@ -315,25 +681,26 @@ def eliminar_sesiones_por_ip(ip: str) -> int:
     Útil como fallback si no se puede resolver la MAC en el logout.
     Devuelve cuántas sesiones fueron eliminadas.
     """
-    # Refrescar desde disco por si otra instancia del portal creó la sesión
-    _load_from_disk()
+    # Otra instancia del portal pudo crear la sesión: se incorporan solo las de
+    # esta IP que estén en disco (sin recargar todo ni re-aplicar el firewall)
+    en_disco = _leer_sesiones_disco() or {}
 
     removed_sessions = []
     with _lock:
-        for key, sess in list(_sessions.items()):
-            if sess.ip == ip:
+        for key, sess in en_disco.items():
+            if sess.ip == ip and key not in _sessions:
+                _store(key, sess)
+        for key in _claves_de_ip(ip):
+            sess = _discard(key)
+            if sess is not None:
+                _notificar_baja(sess, "logout")
                 removed_sessions.append((key, sess))
-                _sessions.pop(key, None)
         if removed_sessions:
             _save_to_disk()
-
-    for key, sess in removed_sessions:
-        if sess.mac:
-            firewall_dynamic.denegar_ip_mac(sess.ip, sess.mac)
-            logging.info("Regla de firewall eliminada para %s (MAC %s)", sess.ip, sess.mac)
-        else:
-            firewall_dynamic.denegar_ip(sess.ip)
-            logging.info("Regla de firewall eliminada para %s", sess.ip)
+            firewall_dynamic.revocar_lote(
+                [(sess.ip, sess.mac) for _key, sess in removed_sessions], en_uso=_macs_de_ip
+            )
+            logging.info("Reglas de firewall eliminadas para %s", ip)
 
     if removed_sessions:
         logging.info("Sesiones eliminadas por IP %s: %d", ip, len(removed_sessions))
@@ -350,39 +717,445 @@ def limpiar_sesiones_expiradas() -> int:
     now = time.time()
     removed = 0
 
+    # El ciclo agrupa los flushes de conntrack y los ejecuta al salir (ya sin _lock)
+    with firewall_dynamic.ciclo_revocacion():
+        with _lock:
+            keys_to_delete = [
+                key for key, sess in _sessions.items() if sess.is_expired(now)
+            ]
+            revocadas = []
+            for key in keys_to_delete:
+                sess = _discard(key)
+                if not sess:
+                    continue
+                _notificar_baja(sess, "expirada")
+                revocadas.append((sess.ip, sess.mac))
+                removed += 1
+            if removed:
+                _save_to_disk()
+                firewall_dynamic.revocar_lote(revocadas, en_uso=_macs_de_ip)
+
+    if removed:
+        logging.info("Limpieza de sesiones: %d sesiones expiradas eliminadas", removed)
+    return removed
+
+
+def crear_sesiones_lote(
+    entradas: Iterable[Tuple[str, str, Optional[str]]],
+    ttl: Optional[int] = None,
+    byte_quota: Optional[int] = None,
+) -> List[Session]:
+    """
+    Crea (o reemplaza) en bloque sesiones para entradas (usuario, ip, mac),
+    con el mismo TTL y cuota para todas (mismos valores por defecto que
+    crear_sesion). Un solo guardado en disco y un solo lote de firewall.
+    Devuelve las sesiones creadas.
+    """
+    if ttl is None:
+        ttl = DEFAULT_SESSION_TTL
+    if byte_quota is None:
+        byte_quota = DEFAULT_BYTE_QUOTA
+    if byte_quota is not None and byte_quota <= 0:
+        byte_quota = None
+    now = time.time()
+    expires_at = now + ttl if ttl > 0 else None
+    creadas = [
+        Session(username=username, ip=ip, mac=mac, login_time=now, expires_at=expires_at, byte_quota=byte_quota)
+        for username, ip, mac in entradas
+    ]
+    if not creadas:
+        return creadas
+
     with _lock:
-        keys_to_delete = [
-            key for key, sess in _sessions.items() if sess.is_expired(now)
-        ]
-        for key in keys_to_delete:
-            sess = _sessions.pop(key, None)
-            if not sess:
+        for session in creadas:
+            _heredar_lectura_contadores(session)
+            _store(session.key, session)
+            if _observadores:
+                _notificar("crear", _session_to_dict(session))
+        _save_to_disk()
+        firewall_dynamic.permitir_lote([(session.ip, session.mac) for session in creadas])
+
+    logging.info("Sesiones creadas en lote: %d (ttl=%s)", len(creadas), ttl)
+    return creadas
+
+
+def eliminar_sesiones(filtro: Callable[[Session], bool], motivo: str = "admin") -> int:
+    """
+    Elimina en bloque las sesiones para las que `filtro(sesion)` es True
+    (p. ej. todas las de un usuario o una subred). Un solo guardado en disco
+    y una sola revocación en lote (reglas y conntrack). Devuelve cuántas.
+    """
+    with firewall_dynamic.ciclo_revocacion():
+        with _lock:
+            revocadas = []
+            for key in [key for key, sess in _sessions.items() if filtro(sess)]:
+                sess = _discard(key)
+                if sess is None:
+                    continue
+                _notificar_baja(sess, motivo)
+                revocadas.append((sess.ip, sess.mac))
+            if revocadas:
+                _save_to_disk()
+                firewall_dynamic.revocar_lote(revocadas, en_uso=_macs_de_ip)
+
+    if revocadas:
+        logging.info("Sesiones eliminadas en lote (%s): %d", motivo, len(revocadas))
+    return len(revocadas)
+
+
+def extender_sesiones(filtro: Callable[[Session], bool], segundos: float, desde_ahora: bool = False) -> int:
+    """
+    Alarga la expiración de las sesiones para las que `filtro(sesion)` es True:
+    `segundos` más sobre su expiración actual o, con desde_ahora, expiración
+    en ahora + `segundos` (también para las que no expiraban). Las sesiones
+    sin expiración no cambian si no se pide desde_ahora. Devuelve cuántas.
+    """
+    now = time.time()
+    extendidas = 0
+    with _lock:
+        for sess in _sessions.values():
+            if not filtro(sess):
                 continue
-            if sess.mac:
-                firewall_dynamic.denegar_ip_mac(sess.ip, sess.mac)
+            if desde_ahora:
+                sess.expires_at = now + segundos
+            elif sess.expires_at is not None:
+                sess.expires_at += segundos
             else:
-                firewall_dynamic.denegar_ip(sess.ip)
+                continue
+            extendidas += 1
+            if _observadores:
+                # Mismo formato que un alta: la réplica sustituye la sesión
+                _notificar("crear", _session_to_dict(sess))
+        if extendidas:
+            _save_to_disk()
+
+    if extendidas:
+        logging.info("Expiración extendida en lote para %d sesiones (%+d s)", extendidas, segundos)
+    return extendidas
+
+
+def obtener_sesion_por_ip(ip: str) -> Optional[Session]:
+    """
+    Devuelve la sesión vigente más reciente para la IP (con o sin MAC), o None.
+
+    Solo consulta memoria (sin ARP ni firewall) y mantiene el lock lo mínimo:
+    no elimina sesiones expiradas (de eso se encarga limpiar_sesiones_expiradas).
+    """
+    now = time.time()
+    with _lock:
+        candidates = [_sessions[key] for key in _claves_de_ip(ip)]
+
+    best: Optional[Session] = None
+    for sess in candidates:
+        if sess.is_expired(now):
+            continue
+        if best is None or sess.login_time > best.login_time:
+            best = sess
+    return best
+
+
+def ip_autenticada(ip: str) -> bool:
+    """
+    True si la IP tiene alguna sesión en memoria. Consulta el índice por IP sin
+    tomar _lock (una búsqueda en dict es atómica), para rutas muy frecuentes
+    como el DNS cautivo. Una sesión vencida cuenta hasta que la limpieza
+    periódica la quita, igual que sus reglas de firewall.
+    """
+    return _empaquetar_ip(ip) in _sessions_by_ip
+
+
+def _heredar_lectura_contadores(session: Session) -> None:
+    """
+    Toma como punto de partida la última lectura de contadores de otras
+    sesiones de la misma IP (las reglas son por IP). Llamar con _lock tomado.
+    """
+    for key in _sessions_by_ip.get(session._ip, ()):
+        previa = _sessions[key]
+        if previa.counter_bytes is not None and (
+            session.counter_bytes is None or previa.counter_bytes > session.counter_bytes
+        ):
+            session.counter_packets = previa.counter_packets
+            session.counter_bytes = previa.counter_bytes
+
+
+def actualizar_contadores() -> Optional[int]:
+    """
+    Actualiza bytes/paquetes consumidos de todas las sesiones a partir de una
+    sola lectura de contadores del firewall (iptables-save -c, O(reglas)), y
+    revoca en lote las sesiones que superan su cuota de bytes o, si
+    IDLE_TIMEOUT > 0, las que llevan ese tiempo sin tráfico.
+
+    El tráfico de una IP se atribuye a su sesión vigente más reciente. Si un
+    contador es menor que la última lectura (reglas recreadas), se asume que
+    empezó de cero. Los contadores se persisten con la sesión.
+
+    Devuelve cuántas sesiones se revocaron, o None si no se pudo leer.
+    """
+    # Lecturas del firewall/conntrack sin _lock: no bloquean logins ni consultas
+    contadores = firewall_dynamic.leer_contadores()
+    if contadores is None:
+        return None
+    con_conexiones: Set[str] = set()
+    if IDLE_TIMEOUT > 0 and IDLE_USE_CONNTRACK:
+        con_conexiones = firewall_dynamic.origenes_conntrack() or set()
+
+    now = time.time()
+    cambios = False
+    revocadas = []
+    consumo: Dict[str, dict] = {}
+    with firewall_dynamic.ciclo_revocacion():
+        with _lock:
+            for ip, (paquetes, octetos) in contadores.items():
+                sesiones = [_sessions[key] for key in _claves_de_ip(ip)]
+                vigentes = [sess for sess in sesiones if not sess.is_expired(now)]
+                if not vigentes:
+                    continue
+                titular = max(vigentes, key=lambda sess: sess.login_time)
+                previo_p = titular.counter_packets or 0
+                previo_b = titular.counter_bytes or 0
+                if octetos < previo_b or paquetes < previo_p:
+                    previo_p = previo_b = 0
+                delta_p = paquetes - previo_p
+                delta_b = octetos - previo_b
+                if delta_p or delta_b:
+                    titular.packets_used += delta_p
+                    titular.bytes_used += delta_b
+                    titular.last_activity = now
+                    consumo[f"{titular.ip}|{titular.mac or ''}"] = {
+                        "bytes_used": titular.bytes_used,
+                        "packets_used": titular.packets_used,
+                        "last_activity": now,
+                    }
+                    cambios = True
+                for sess in sesiones:
+                    if sess.counter_bytes != octetos or sess.counter_packets != paquetes:
+                        sess.counter_packets = paquetes
+                        sess.counter_bytes = octetos
+                        cambios = True
+
+            for ip in con_conexiones:
+                for key in _claves_de_ip(ip):
+                    _sessions[key].last_activity = now
+            if consumo and _observadores:
+                _notificar("contadores", consumo)
+
+            for key, sess in list(_sessions.items()):
+                if sess.quota_exceeded():
+                    _discard(key)
+                    _notificar_baja(sess, "cuota")
+                    revocadas.append(sess)
+                    logging.info(
+                        "Cuota de bytes agotada para %s (usuario=%s, %d/%d bytes); revocando",
+                        (sess.ip, sess.mac),
+                        sess.username,
+                        sess.bytes_used,
+                        sess.byte_quota,
+                    )
+                elif sess.is_idle(IDLE_TIMEOUT, now):
+                    _discard(key)
+                    _notificar_baja(sess, "inactividad")
+                    revocadas.append(sess)
+                    logging.info(
+                        "Sesión inactiva durante %ds para %s (usuario=%s); revocando",
+                        IDLE_TIMEOUT,
+                        (sess.ip, sess.mac),
+                        sess.username,
+                    )
+            if cambios or revocadas:
+                _save_to_disk()
+            if revocadas:
+                firewall_dynamic.revocar_lote([(sess.ip, sess.mac) for sess in revocadas], en_uso=_macs_de_ip)
+
+    if revocadas:
+        logging.info("Contabilidad: %d sesiones revocadas por cuota o inactividad", len(revocadas))
+    return len(revocadas)
+
+
+def reconciliar_firewall() -> Optional[Tuple[int, int]]:
+    """
+    Corrige la deriva entre las reglas dinámicas de netfilter y _sessions
+    (p. ej. tras firewall_clear.sh/firewall_init.sh o un iptables fallido).
+
+    - Lee el ruleset con una sola llamada y SIN tomar _lock.
+    - Con _lock tomado calcula la diferencia contra las sesiones activas y la
+      aplica en un único lote. Si las sesiones cambiaron durante la lectura,
+      repite; en el último intento la lectura se hace con el lock tomado.
+
+    Devuelve (reglas añadidas, reglas eliminadas) o None si hubo error.
+    """
+    for intento in range(_RECONCILE_ATTEMPTS):
+        ultimo = intento == _RECONCILE_ATTEMPTS - 1
+        with _lock:
+            generacion = _generation
+        if not ultimo:
+            existentes = firewall_dynamic.leer_reglas_dinamicas()
+            if existentes is None:
+                break
+        with _lock:
+            if ultimo:
+                existentes = firewall_dynamic.leer_reglas_dinamicas()
+                if existentes is None:
+                    break
+            elif generacion != _generation:
+                continue
+
+            clientes = [(sess.ip, sess.mac) for sess in _sessions.values()]
+            agregar, eliminar = firewall_dynamic.diferencia_reglas(
+                firewall_dynamic.reglas_deseadas(clientes), existentes
+            )
+            if (agregar or eliminar) and not firewall_dynamic.aplicar_lote(agregar, eliminar):
+                break
+
+            _drift_stats["reconciliaciones"] += 1
+            _drift_stats["ultima_ejecucion"] = time.time()
+            if agregar or eliminar:
+                _drift_stats["con_deriva"] += 1
+                _drift_stats["reglas_faltantes"] += len(agregar)
+                _drift_stats["reglas_sobrantes"] += len(eliminar)
+        if agregar or eliminar:
+            logging.warning(
+                "Deriva firewall/sesiones corregida: %d reglas faltantes, %d sobrantes (%d sesiones)",
+                len(agregar),
+                len(eliminar),
+                len(clientes),
+            )
+        return len(agregar), len(eliminar)
+
+    with _lock:
+        _drift_stats["errores"] += 1
+    logging.error("No se pudo reconciliar el firewall con las sesiones activas")
+    return None
+
+
+def aplicar_instantanea(payload: Dict[str, dict], aplicar_firewall: bool = True) -> int:
+    """
+    Sustituye todas las sesiones por las de una instantánea replicada (mismo
+    formato que sessions.json) y sincroniza el firewall en un lote.
+    Devuelve cuántas sesiones vigentes quedaron.
+    """
+    inicio = time.perf_counter()
+    restored = _deserialize_sessions(payload)
+    with _lock:
+        _replace_all(restored)
+        clientes = [(sess.ip, sess.mac) for sess in _sessions.values()]
+        _save_to_disk()
+        if _observadores:
+            _notificar_replica("reemplazo", {"sesiones": _serialize_sessions()})
+    logging.info("Instantánea replicada aplicada: %d sesiones", len(clientes))
+    if aplicar_firewall:
+        _restaurar_firewall(clientes, inicio)
+    return len(clientes)
+
+
+def aplicar_replica(tipo: str, datos: dict, aplicar_firewall: bool = True) -> None:
+    """
+    Aplica en este nodo (standby) un cambio recibido del primario, con el
+    mismo formato que reciben los observadores. Los cambios se guardan en disco,
+    se notifican a los observadores locales (con cambio_replicado() True) y,
+    si aplicar_firewall, se reflejan en las reglas locales.
+    """
+    if tipo == "reemplazo":
+        aplicar_instantanea(datos["sesiones"], aplicar_firewall=aplicar_firewall)
+        return
+
+    if tipo == "crear":
+        restored = _deserialize_sessions({f"{datos['ip']}|{datos.get('mac') or ''}": datos})
+        with _lock:
+            for key, session in restored.items():
+                _store(key, session)
+                if _observadores:
+                    _notificar_replica("crear", _session_to_dict(session))
+            if restored:
+                _save_to_disk()
+        if aplicar_firewall:
+            for session in restored.values():
+                firewall_dynamic.permitir_ip_mac(session.ip, session.mac)
+        return
+
+    if tipo == "eliminar":
+        key = _make_key(datos["ip"], datos.get("mac"))
+        with firewall_dynamic.ciclo_revocacion():
+            with _lock:
+                session = _discard(key)
+                if session is not None:
+                    if _observadores:
+                        _notificar_replica(
+                            "eliminar", {"ip": session.ip, "mac": session.mac, "motivo": datos.get("motivo")}
+                        )
+                    _save_to_disk()
+                    if aplicar_firewall:
+                        firewall_dynamic.revocar_lote([(session.ip, session.mac)], en_uso=_macs_de_ip)
+        return
 
-            removed += 1
-        if removed:
+    if tipo == "contadores":
+        with _lock:
+            for raw_key, consumo in datos.items():
+                ip, mac = raw_key.split("|", 1)
+                session = _sessions.get(_make_key(ip, mac or None))
+                if session is None:
+                    continue
+                session.bytes_used = int(consumo["bytes_used"])
+                session.packets_used = int(consumo["packets_used"])
+                session.last_activity = consumo.get("last_activity")
             _save_to_disk()
+        return
+
+    logging.warning("Tipo de cambio replicado desconocido: %s", tipo)
 
-    if removed:
-        logging.info("Limpieza de sesiones: %d sesiones expiradas eliminadas", removed)
-    return removed
 
+def obtener_metricas_deriva() -> Dict[str, float]:
+    """Copia de los contadores de deriva (reconciliaciones, reglas corregidas, errores)."""
+    with _lock:
+        return dict(_drift_stats)
+
+
+class VistaSesiones(Mapping):
+    """
+    Vista de solo lectura de las sesiones activas: (ip, mac) -> Session.
 
-def obtener_todas_las_sesiones() -> Dict[SessionKey, Session]:
+    No copia el almacenamiento: len() y las consultas reflejan el estado
+    actual, y cada recorrido toma bajo el lock solo las referencias a las
+    sesiones (una tupla) para poder iterar sin él.
     """
-    Devuelve una copia del diccionario de sesiones actuales.
+
+    __slots__ = ()
+
+    def __getitem__(self, clave: Tuple[str, Optional[str]]) -> Session:
+        ip, mac = clave
+        with _lock:
+            return _sessions[_make_key(ip, mac)]
+
+    def __len__(self) -> int:
+        return len(_sessions)
+
+    def _instantanea(self) -> Tuple[Session, ...]:
+        with _lock:
+            return tuple(_sessions.values())
+
+    def __iter__(self) -> Iterator[Tuple[str, Optional[str]]]:
+        for sess in self._instantanea():
+            yield sess.ip, sess.mac
+
+    def values(self) -> Tuple[Session, ...]:  # type: ignore[override]
+        return self._instantanea()
+
+    def items(self) -> Iterator[Tuple[Tuple[str, Optional[str]], Session]]:  # type: ignore[override]
+        for sess in self._instantanea():
+            yield (sess.ip, sess.mac), sess
+
+
+_vista = VistaSesiones()
+
+
+def obtener_todas_las_sesiones() -> VistaSesiones:
+    """
+    Devuelve una vista de solo lectura de las sesiones actuales, indexada
+    por (ip, mac) como cadenas. No copia el almacenamiento.
 
     Útil para depuración o para mostrar el estado interno.
     """
-    with _lock:
-        return dict(_sessions)
+    return _vista
 
-# Restauramos sesiones (si existen en disco) al importar el módulo
-_load_from_disk()
 
 if __name__ == "__main__":
     # Restaura sesiones previas antes de iniciar pruebas manuales
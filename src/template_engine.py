@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+template_engine.py
+
+Compilador mínimo de plantillas HTML para el portal cautivo.
+
+- Las plantillas de src/templates/ pueden contener marcadores ``{{ nombre }}``.
+- Cada plantilla se compila UNA sola vez (al arrancar) a una lista de
+  fragmentos estáticos en bytes y huecos con nombre.
+- Renderizar es solo rellenar los huecos con valores escapados (html.escape)
+  y unir los fragmentos (o entregarlos tal cual a ``socket.sendmsg``).
+  No se vuelve a parsear la plantilla en cada petición.
+"""
+
+from __future__ import annotations
+
+import html
+import re
+from typing import List, Mapping, Optional, Tuple
+
+# Marcador: {{ nombre }} (espacios opcionales alrededor del nombre)
+PLACEHOLDER_RE = re.compile(rb"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+
+class CompiledTemplate:
+    """Plantilla precompilada: fragmentos estáticos + posiciones de los huecos."""
+
+    __slots__ = ("name", "_parts", "_slots", "_static")
+
+    def __init__(self, name: str, parts: List[bytes], slots: List[Tuple[int, str]]):
+        self.name = name
+        self._parts = parts
+        self._slots = slots
+        # Si no hay huecos, el resultado es siempre el mismo: se guarda unido.
+        self._static: Optional[bytes] = b"".join(parts) if not slots else None
+
+    @property
+    def placeholders(self) -> List[str]:
+        """Nombres de los marcadores presentes en la plantilla (en orden)."""
+        return [name for _, name in self._slots]
+
+    def render_chunks(self, values: Optional[Mapping[str, object]] = None) -> List[bytes]:
+        """
+        Devuelve la lista de fragmentos en bytes lista para enviar (scatter list).
+        Los valores ausentes se sustituyen por cadena vacía.
+        """
+        if self._static is not None:
+            return [self._static]
+        values = values or {}
+        chunks = list(self._parts)
+        for idx, name in self._slots:
+            value = values.get(name)
+            if value is None:
+                chunks[idx] = b""
+            else:
+                chunks[idx] = html.escape(str(value), quote=True).encode("utf-8")
+        return chunks
+
+    def render(self, values: Optional[Mapping[str, object]] = None) -> bytes:
+        """Renderiza la plantilla completa en un único bloque de bytes."""
+        if self._static is not None:
+            return self._static
+        return b"".join(self.render_chunks(values))
+
+
+def compile_template(source: bytes, name: str = "<memoria>") -> CompiledTemplate:
+    """
+    Compila el contenido de una plantilla a fragmentos + huecos.
+    Los huecos ocupan una posición propia en la lista de fragmentos.
+    """
+    parts: List[bytes] = []
+    slots: List[Tuple[int, str]] = []
+    pos = 0
+    for match in PLACEHOLDER_RE.finditer(source):
+        if match.start() > pos:
+            parts.append(source[pos:match.start()])
+        slots.append((len(parts), match.group(1).decode("ascii")))
+        parts.append(b"")
+        pos = match.end()
+    if pos < len(source):
+        parts.append(source[pos:])
+    return CompiledTemplate(name, parts, slots)
+
+
+if __name__ == "__main__":
+    # Prueba manual: python3 src/template_engine.py
+    tpl = compile_template(b"<p>Hola {{ username }}, expira {{expires}}</p>", "demo")
+    print("Marcadores:", tpl.placeholders)
+    print(tpl.render({"username": "<admin>", "expires": "12:00"}))
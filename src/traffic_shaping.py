@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+traffic_shaping.py
+
+Limitación de ancho de banda por sesión (opcional) con tc/HTB.
+
+- Bajada: HTB en la salida de la interfaz LAN (clasifica por IP destino).
+- Subida: la entrada de la LAN se redirige a un dispositivo IFB con su propio
+  HTB (clasifica por IP origen, antes del NAT).
+- Cada sesión IPv4 tiene una clase 1:<16 bits bajos de la IP> bajo la clase
+  del enlace (1:1), con una tasa garantizada pequeña (PORTAL_SHAPING_MIN_RATE)
+  y como techo su límite (por defecto o por usuario), y una qdisc fq_codel
+  como hoja. El tráfico sin clase (clientes sin sesión, el propio portal) va
+  a 1:ffff.
+- Los filtros u32 usan una tabla hash por el último octeto de la IP: cada
+  paquete recorre un solo cubo, no un filtro por cliente. El identificador
+  del filtro también se deriva de la IP, así que altas y bajas no necesitan
+  leer el estado de tc.
+
+Las clases se crean y se quitan con el ciclo de vida de las sesiones (los
+mismos eventos que aplican las reglas de firewall, vía
+sessions.registrar_observador). Los cambios se agrupan y se aplican con un
+único `tc -batch` por tanda: un login masivo o una purga de expiradas es una
+sola invocación.
+
+Para que la latencia del resto no se dispare con descargas grandes, las tasas
+del enlace (PORTAL_SHAPING_DOWNLINK / PORTAL_SHAPING_UPLINK) deben quedar un
+poco por debajo de la capacidad real: así la cola se forma aquí, repartida por
+clase y gestionada por fq_codel, y no en el módem.
+
+Limitaciones: solo IPv4; redes de hasta /16 (dos IPs con los mismos 16 bits
+bajos compartirían clase); las IPs x.x.0.0, x.x.0.1 y x.x.255.255 de cada /16
+quedan sin clase propia (sus minor coinciden con las clases fijas).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import firewall_dynamic
+import sessions
+
+ENABLED = os.getenv("PORTAL_SHAPING", "0").strip().lower() in {"1", "true", "yes", "on"}
+TC = shutil.which("tc") or "/sbin/tc"
+IP = shutil.which("ip") or "/sbin/ip"
+
+IFB_INTERFACE = os.getenv("PORTAL_SHAPING_IFB", "ifb-portal")
+# Capacidad a repartir en cada sentido (algo por debajo de la real del enlace WAN)
+DOWNLINK = os.getenv("PORTAL_SHAPING_DOWNLINK", "100mbit")
+UPLINK = os.getenv("PORTAL_SHAPING_UPLINK", "20mbit")
+# Techo por sesión salvo que config/velocidades.txt indique otro para el usuario
+DOWN_RATE = os.getenv("PORTAL_SHAPING_DOWN_RATE", "10mbit")
+UP_RATE = os.getenv("PORTAL_SHAPING_UP_RATE", "2mbit")
+# Tasa garantizada por clase (sesiones y tráfico sin clase)
+MIN_RATE = os.getenv("PORTAL_SHAPING_MIN_RATE", "256kbit")
+LEAF_QDISC = os.getenv("PORTAL_SHAPING_LEAF_QDISC", "fq_codel")
+# Espera para agrupar cambios cercanos en el mismo lote
+BATCH_DELAY = float(os.getenv("PORTAL_SHAPING_BATCH_DELAY", "0.05"))
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+USERS_FILE = Path(os.getenv("PORTAL_SHAPING_USERS_FILE") or REPO_ROOT / "config" / "velocidades.txt")
+
+CLASE_ENLACE = 0x1
+CLASE_DEFECTO = 0xFFFF
+TABLA_HASH = 0x2
+PRIORIDAD = 10
+QUANTUM = 1514
+
+_UNIDADES = {
+    "bit": 1,
+    "kbit": 1_000,
+    "mbit": 1_000_000,
+    "gbit": 1_000_000_000,
+    "bps": 8,
+    "kbps": 8_000,
+    "mbps": 8_000_000,
+    "gbps": 8_000_000_000,
+}
+_TASA_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([a-z]*)\s*$", re.IGNORECASE)
+
+# (dispositivo, campo u32 de la IP del cliente, desplazamiento del último octeto)
+Sentido = Tuple[str, str, int]
+
+# Límites por usuario: usuario -> (bajada, subida) en bit/s (None = por defecto)
+_limites: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+
+_cond = threading.Condition()
+_pendientes: Set[str] = set()
+_resincronizar = False
+
+_metricas: Dict[str, int] = {"lotes": 0, "comandos": 0, "lotes_con_error": 0}
+
+
+def tasa_bits(texto: str) -> int:
+    """Convierte una tasa estilo tc ("10mbit", "512kbit", "1mbps") a bit/s."""
+    m = _TASA_RE.match(texto)
+    unidad = m.group(2).lower() if m else ""
+    if not m or (unidad and unidad not in _UNIDADES):
+        raise ValueError(f"Tasa inválida: {texto!r}")
+    return int(float(m.group(1)) * _UNIDADES.get(unidad, 1))
+
+
+def cargar_limites(path: Path = USERS_FILE) -> Dict[str, Tuple[Optional[int], Optional[int]]]:
+    """
+    Lee los límites por usuario, una línea `usuario:bajada:subida` (p. ej.
+    `admin:50mbit:10mbit`; un campo vacío usa el valor por defecto). Las líneas
+    inválidas se ignoran con un aviso; si no hay archivo no hay excepciones.
+    """
+    limites: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+    if not path.exists():
+        return limites
+    with path.open("r", encoding="utf-8") as f:
+        for lineno, raw_line in enumerate(f, start=1):
+            line = raw_line.strip()
+            if not line or line.startswith("#"):
+                continue
+            partes = [p.strip() for p in line.split(":")]
+            if len(partes) != 3 or not partes[0]:
+                logging.warning("[SHAPING] Línea %d de %s inválida (usuario:bajada:subida)", lineno, path)
+                continue
+            try:
+                bajada = tasa_bits(partes[1]) if partes[1] else None
+                subida = tasa_bits(partes[2]) if partes[2] else None
+            except ValueError as exc:
+                logging.warning("[SHAPING] Línea %d de %s: %s", lineno, path, exc)
+                continue
+            limites[partes[0]] = (bajada, subida)
+    return limites
+
+
+def _sentidos() -> List[Tuple[Sentido, int, int]]:
+    """(sentido, capacidad del enlace, techo por defecto) para bajada y subida."""
+    return [
+        ((firewall_dynamic.LAN_INTERFACE, "dst", 16), tasa_bits(DOWNLINK), tasa_bits(DOWN_RATE)),
+        ((IFB_INTERFACE, "src", 12), tasa_bits(UPLINK), tasa_bits(UP_RATE)),
+    ]
+
+
+def _minor(ip: str) -> Optional[int]:
+    """Minor de la clase de la IP (16 bits bajos) o None si no se puede clasificar."""
+    try:
+        octetos = socket.inet_aton(ip)
+    except OSError:
+        return None
+    minor = (octetos[2] << 8) | octetos[3]
+    if minor in (0, CLASE_ENLACE, CLASE_DEFECTO):
+        return None
+    return minor
+
+
+def _handle_filtro(minor: int) -> str:
+    """Handle u32 del filtro de la IP: tabla 2, cubo = último octeto, nodo = tercer octeto + 1."""
+    return f"{TABLA_HASH:x}:{minor & 0xFF:x}:{(minor >> 8) + 1:x}"
+
+
+def _lineas_estructura() -> List[str]:
+    """Qdiscs, clases fijas y filtros hash de ambos sentidos, y la redirección LAN -> IFB."""
+    minimo = tasa_bits(MIN_RATE)
+    lan = firewall_dynamic.LAN_INTERFACE
+    lineas = []
+    for (dev, campo, desplazamiento), enlace, _techo in _sentidos():
+        lineas += [
+            f"qdisc replace dev {dev} root handle 1: htb default {CLASE_DEFECTO:x}",
+            f"class replace dev {dev} parent 1: classid 1:{CLASE_ENLACE:x} htb rate {enlace}bit ceil {enlace}bit quantum {QUANTUM}",
+            f"class replace dev {dev} parent 1:{CLASE_ENLACE:x} classid 1:{CLASE_DEFECTO:x} htb rate {minimo}bit ceil {enlace}bit quantum {QUANTUM}",
+            f"qdisc replace dev {dev} parent 1:{CLASE_DEFECTO:x} {LEAF_QDISC}",
+            f"filter replace dev {dev} parent 1: protocol ip prio {PRIORIDAD} handle {TABLA_HASH:x}: u32 divisor 256",
+            f"filter replace dev {dev} parent 1: protocol ip prio {PRIORIDAD} handle 800::1 u32 ht 800: "
+            f"match ip {campo} 0.0.0.0/0 hashkey mask 0x000000ff at {desplazamiento} link {TABLA_HASH:x}:",
+        ]
+    lineas += [
+        f"qdisc replace dev {lan} handle ffff: ingress",
+        f"filter replace dev {lan} parent ffff: protocol ip prio {PRIORIDAD} handle 800::1 u32 "
+        f"match u32 0 0 action mirred egress redirect dev {IFB_INTERFACE}",
+    ]
+    return lineas
+
+
+def _lineas_alta(ip: str, minor: int, username: str) -> List[str]:
+    minimo = tasa_bits(MIN_RATE)
+    propios = _limites.get(username, (None, None))
+    handle = _handle_filtro(minor)
+    lineas = []
+    for ((dev, campo, _desp), _enlace, techo), limite in zip(_sentidos(), propios):
+        techo = limite or techo
+        lineas += [
+            f"class replace dev {dev} parent 1:{CLASE_ENLACE:x} classid 1:{minor:x} "
+            f"htb rate {min(minimo, techo)}bit ceil {techo}bit quantum {QUANTUM}",
+            f"qdisc replace dev {dev} parent 1:{minor:x} {LEAF_QDISC}",
+            f"filter replace dev {dev} parent 1: protocol ip prio {PRIORIDAD} handle {handle} u32 "
+            f"ht {TABLA_HASH:x}:{minor & 0xFF:x}: match ip {campo} {ip}/32 flowid 1:{minor:x}",
+        ]
+    return lineas
+
+
+def _lineas_baja(minor: int) -> List[str]:
+    handle = _handle_filtro(minor)
+    lineas = []
+    for (dev, _campo, _desp), _enlace, _techo in _sentidos():
+        # Primero el filtro: una clase referenciada por un filtro no se puede borrar
+        lineas += [
+            f"filter del dev {dev} parent 1: protocol ip prio {PRIORIDAD} handle {handle} u32",
+            f"class del dev {dev} classid 1:{minor:x}",
+        ]
+    return lineas
+
+
+def _clases_existentes() -> Set[int]:
+    """Minors de las clases por sesión presentes en la LAN (una lectura de tc)."""
+    salida = subprocess.run(
+        [TC, "class", "show", "dev", firewall_dynamic.LAN_INTERFACE],
+        capture_output=True,
+        text=True,
+        check=False,
+    ).stdout
+    minors = {int(m, 16) for m in re.findall(r"^class htb 1:([0-9a-f]+) ", salida, re.MULTILINE)}
+    return minors - {CLASE_ENLACE, CLASE_DEFECTO}
+
+
+def _usuarios_por_ip(ips: Optional[Iterable[str]] = None) -> Dict[str, str]:
+    """Usuario de la sesión vigente más reciente de cada IP (todas si ips es None)."""
+    if ips is not None:
+        return {ip: sess.username for ip in ips if (sess := sessions.obtener_sesion_por_ip(ip)) is not None}
+    resultado: Dict[str, Tuple[float, str]] = {}
+    for sess in sessions.obtener_todas_las_sesiones().values():
+        previo = resultado.get(sess.ip)
+        if previo is None or sess.login_time > previo[0]:
+            resultado[sess.ip] = (sess.login_time, sess.username)
+    return {ip: username for ip, (_t, username) in resultado.items()}
+
+
+def lineas_lote(ips: Iterable[str], completo: bool = False) -> List[str]:
+    """
+    Comandos tc para dejar las clases de `ips` como dicten sus sesiones
+    actuales. Con completo=True se recorren todas las sesiones y se quitan
+    las clases que ya no tienen sesión.
+    """
+    lineas: List[str] = []
+    ips = set(ips)
+    deseadas: Dict[int, Tuple[str, str]] = {}
+    for ip, username in _usuarios_por_ip(None if completo else ips).items():
+        minor = _minor(ip)
+        if minor is not None:
+            deseadas[minor] = (ip, username)
+    sobrantes = _clases_existentes() - deseadas.keys() if completo else set()
+    for ip in ips:
+        minor = _minor(ip)
+        if minor is not None and minor not in deseadas:
+            sobrantes.add(minor)
+    for minor in sorted(sobrantes):
+        lineas += _lineas_baja(minor)
+    for minor, (ip, username) in sorted(deseadas.items()):
+        lineas += _lineas_alta(ip, minor, username)
+    return lineas
+
+
+def ejecutar_lote(lineas: List[str]) -> bool:
+    """Aplica los comandos con un único `tc -force -batch -` (un error no detiene el resto)."""
+    if not lineas:
+        return True
+    _metricas["lotes"] += 1
+    _metricas["comandos"] += len(lineas)
+    try:
+        proc = subprocess.run(
+            [TC, "-force", "-batch", "-"],
+            input="\n".join(lineas) + "\n",
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    except OSError as exc:
+        _metricas["lotes_con_error"] += 1
+        logging.error("[SHAPING] No se pudo ejecutar tc: %s", exc)
+        return False
+    if proc.returncode != 0:
+        _metricas["lotes_con_error"] += 1
+        logging.warning(
+            "[SHAPING] tc -batch terminó con errores (%d comandos): %s",
+            len(lineas),
+            " | ".join(proc.stderr.strip().splitlines()[:4]),
+        )
+        return False
+    logging.info("[SHAPING] Aplicado lote tc de %d comandos", len(lineas))
+    return True
+
+
+def _on_cambio(tipo: str, datos: dict) -> None:
+    """Observador de sessions: solo anota la IP (se llama con el lock de sesiones tomado)."""
+    global _resincronizar
+    with _cond:
+        if tipo in ("crear", "eliminar"):
+            _pendientes.add(datos["ip"])
+        elif tipo == "reemplazo":
+            _resincronizar = True
+        else:
+            return
+        _cond.notify()
+
+
+def _bucle(stop_event: threading.Event) -> None:
+    """Agrupa los cambios pendientes y los aplica en un lote por tanda."""
+    global _pendientes, _resincronizar
+    while not stop_event.is_set():
+        with _cond:
+            if not _cond.wait_for(lambda: _pendientes or _resincronizar, timeout=1.0):
+                continue
+        time.sleep(BATCH_DELAY)
+        with _cond:
+            ips, _pendientes = _pendientes, set()
+            completo, _resincronizar = _resincronizar, False
+        try:
+            ejecutar_lote(lineas_lote(ips, completo=completo))
+        except Exception as exc:  # noqa: BLE001
+            logging.error("[SHAPING] Error aplicando límites de velocidad: %s", exc)
+
+
+def preparar() -> bool:
+    """Crea el IFB y la estructura fija de tc (idempotente: se puede repetir tras una recarga)."""
+    subprocess.run([IP, "link", "add", IFB_INTERFACE, "type", "ifb"], capture_output=True, check=False)
+    if subprocess.run([IP, "link", "set", IFB_INTERFACE, "up"], capture_output=True, check=False).returncode != 0:
+        logging.error("[SHAPING] No se pudo levantar %s (¿módulo ifb?)", IFB_INTERFACE)
+        return False
+    return ejecutar_lote(_lineas_estructura())
+
+
+def obtener_metricas() -> Dict[str, int]:
+    """Copia de los contadores de lotes tc."""
+    return dict(_metricas)
+
+
+def iniciar(stop_event: threading.Event) -> bool:
+    """Prepara tc y aplica los límites a las sesiones actuales y futuras (si PORTAL_SHAPING=1)."""
+    global _limites, _resincronizar
+    if not ENABLED:
+        return False
+    if not os.path.exists(TC):
+        logging.error("[SHAPING] No se encontró el binario tc; limitación de velocidad deshabilitada")
+        return False
+    try:
+        for _sentido, enlace, techo in _sentidos():
+            if techo > enlace:
+                logging.warning("[SHAPING] El techo por sesión (%d bit/s) supera al enlace (%d bit/s)", techo, enlace)
+        tasa_bits(MIN_RATE)
+        _limites = cargar_limites()
+    except (OSError, ValueError) as exc:
+        logging.error("[SHAPING] Configuración inválida: %s; limitación de velocidad deshabilitada", exc)
+        return False
+    if not preparar():
+        logging.warning("[SHAPING] La estructura de tc quedó incompleta; se intentará igualmente")
+
+    sessions.registrar_observador(_on_cambio)
+    with _cond:
+        _resincronizar = True
+        _cond.notify()
+    threading.Thread(target=_bucle, args=(stop_event,), daemon=True, name="traffic-shaping").start()
+    logging.info(
+        "[SHAPING] Límites por sesión: bajada %s, subida %s (%d usuarios con límite propio)",
+        DOWN_RATE,
+        UP_RATE,
+        len(_limites),
+    )
+    return True
+
+
+if __name__ == "__main__":
+    # Muestra el lote tc que se generaría, sin aplicarlo:
+    #   python3 src/traffic_shaping.py [ip:usuario ...]
+    import sys
+
+    clientes = [arg.split(":", 1) for arg in sys.argv[1:]] or [["192.168.50.10", "admin"], ["192.168.50.11", "invitado"]]
+    _limites = cargar_limites()
+    print("\n".join(_lineas_estructura()))
+    for ip_cliente, usuario in clientes:
+        minor_cliente = _minor(ip_cliente)
+        if minor_cliente is None:
+            print(f"# {ip_cliente}: sin clase (no IPv4 o reservada)")
+            continue
+        print("\n".join(_lineas_alta(ip_cliente, minor_cliente, usuario)))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+traffic_trace.py
+
+Grabación opcional (PORTAL_TRACE=1) de trazas de tráfico anonimizadas para
+reproducirlas después contra un portal de pruebas
+(tests/reproducir_traza.py) con la forma real de la carga: ráfagas de
+sondas de los sistemas operativos, GET repetidos, logins enviados dos veces.
+
+Por petición se guarda solo:
+- instante (ms desde el inicio del segmento),
+- cubo de origen: 16 bits de un HMAC de la IP con una sal aleatoria que no
+  sale del proceso (las peticiones de un mismo cliente comparten cubo, pero
+  la IP no se puede recuperar),
+- método (GET, POST u otro),
+- ruta sin query ni fragmento, solo si es una de las que sirve el portal
+  (las que recibe iniciar()); cualquier otra se guarda como "otra", así la
+  traza no recoge URLs de terceros que los clientes piden al ser redirigidos,
+- clase de tamaño del cuerpo: 0 sin cuerpo, k = bits del Content-Length
+  (tamaño en [2^(k-1), 2^k)).
+
+Formato binario, una secuencia de registros con etiqueta:
+
+    b"T" versión (1) | inicio_ms (8)                 inicio de segmento (cada arranque)
+    b"R" código (1) | longitud (1) | ruta (UTF-8)    ruta nueva en el segmento
+    b"P" delta_ms (4) | cubo (2) | método (1) | código de ruta (1) | clase (1)
+
+Registrar una petición es añadir 10 bytes a un buffer en memoria; un hilo lo
+vuelca a PORTAL_TRACE_FILE cada segundo. Al llegar a PORTAL_TRACE_MAX_MB se
+deja de grabar.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, Iterator, Optional
+
+ENABLED = os.getenv("PORTAL_TRACE", "0").strip().lower() in {"1", "true", "yes", "on"}
+REPO_ROOT = Path(__file__).resolve().parent.parent
+TRACE_FILE = Path(os.getenv("PORTAL_TRACE_FILE") or REPO_ROOT / "logs" / "portal.trace")
+MAX_BYTES = int(float(os.getenv("PORTAL_TRACE_MAX_MB", "100")) * 1024 * 1024)
+
+_VERSION = 1
+_SEGMENTO = struct.Struct("!cBQ")
+_RUTA = struct.Struct("!cBB")
+_PETICION = struct.Struct("!cIHBBB")
+
+METODOS = {"GET": 1, "POST": 2}
+METODO_OTRO = 0
+RUTA_OTRA = 0  # rutas que el portal no sirve (no se graban)
+NOMBRES_METODO = {1: "GET", 2: "POST", METODO_OTRO: "OTRO"}
+
+_sal = secrets.token_bytes(16)
+_lock = threading.Lock()
+_buffer = bytearray()
+_rutas: Dict[str, int] = {}
+_permitidas: FrozenSet[str] = frozenset()
+_inicio_ms = 0
+_escritos = 0
+_activo = False
+_lleno = False
+_metricas: Dict[str, int] = {"peticiones": 0, "descartadas": 0, "volcados": 0}
+
+
+@dataclass(frozen=True)
+class Registro:
+    """Una petición leída de una traza."""
+
+    instante: float  # segundos (epoch)
+    cubo: int
+    metodo: str
+    ruta: str  # "" = ruta que el portal no sirve
+    clase_tamano: int
+
+
+def cubo_origen(ip: str) -> int:
+    """Cubo anónimo de 16 bits para la IP (estable durante la vida del proceso)."""
+    return int.from_bytes(hmac.new(_sal, ip.encode("ascii", "replace"), hashlib.sha256).digest()[:2], "big")
+
+
+def clase_tamano(tamano: int) -> int:
+    """0 sin cuerpo; k si el tamaño está en [2^(k-1), 2^k)."""
+    return min(255, max(0, tamano).bit_length())
+
+
+def tamano_de_clase(clase: int) -> int:
+    """Tamaño representativo de una clase (el centro del intervalo)."""
+    if clase <= 1:
+        return clase
+    return 3 << (clase - 2)
+
+
+def _content_length(data: bytes) -> int:
+    cabeceras = data.split(b"\r\n\r\n", 1)[0]
+    for linea in cabeceras.split(b"\r\n")[1:]:
+        campo, _, valor = linea.partition(b":")
+        if campo.strip().lower() == b"content-length":
+            try:
+                return int(valor.strip())
+            except ValueError:
+                return 0
+    return 0
+
+
+def registrar(ip: str, method: str, route: str, data: bytes) -> None:
+    """Añade una petición a la traza (no hace nada si la grabación no está activa)."""
+    if not _activo:
+        if _lleno:
+            _metricas["descartadas"] += 1
+        return
+    metodo = METODOS.get(method.upper(), METODO_OTRO)
+    clase = clase_tamano(_content_length(data)) if metodo != 1 else 0
+    cubo = cubo_origen(ip)
+    with _lock:
+        delta = int(time.time() * 1000) - _inicio_ms
+        codigo = _rutas.get(route)
+        if codigo is None:
+            codigo = RUTA_OTRA
+            if route in _permitidas:
+                codigo = len(_rutas) + 1
+                _rutas[route] = codigo
+                crudo = route.encode("utf-8")[:255]
+                _buffer.extend(_RUTA.pack(b"R", codigo, len(crudo)) + crudo)
+        _buffer.extend(_PETICION.pack(b"P", max(0, min(delta, 0xFFFFFFFF)), cubo, metodo, codigo, clase))
+        _metricas["peticiones"] += 1
+
+
+def volcar() -> None:
+    """Escribe a disco lo acumulado en el buffer (lo llama el hilo de la traza)."""
+    global _escritos, _activo, _lleno
+    with _lock:
+        if not _buffer:
+            return
+        datos = bytes(_buffer)
+        _buffer.clear()
+    if _escritos + len(datos) > MAX_BYTES:
+        with _lock:
+            _activo = False
+            _lleno = True
+        logging.warning("[TRACE] %s llegó a PORTAL_TRACE_MAX_MB; se deja de grabar", TRACE_FILE)
+        return
+    try:
+        with open(TRACE_FILE, "ab") as f:
+            f.write(datos)
+        _escritos += len(datos)
+        _metricas["volcados"] += 1
+    except OSError as exc:
+        logging.error("[TRACE] No se pudo escribir la traza en %s: %s", TRACE_FILE, exc)
+
+
+def _bucle(stop_event: threading.Event) -> None:
+    while not stop_event.wait(1.0):
+        volcar()
+    volcar()
+
+
+def obtener_metricas() -> Dict[str, int]:
+    """Peticiones grabadas, descartadas por el límite de tamaño y volcados a disco."""
+    with _lock:
+        return dict(_metricas, bytes=_escritos + len(_buffer), rutas=len(_rutas))
+
+
+def iniciar(stop_event: threading.Event, rutas: Iterable[str] = ()) -> bool:
+    """
+    Abre un segmento nuevo en la traza y arranca el volcado periódico (si
+    PORTAL_TRACE=1). Solo las `rutas` dadas (las que sirve el portal) se graban
+    por su nombre.
+    """
+    global _activo, _inicio_ms, _escritos, _permitidas
+    if not ENABLED:
+        return False
+    try:
+        TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        _escritos = TRACE_FILE.stat().st_size if TRACE_FILE.exists() else 0
+    except OSError as exc:
+        logging.error("[TRACE] No se puede preparar %s: %s; grabación deshabilitada", TRACE_FILE, exc)
+        return False
+    if _escritos >= MAX_BYTES:
+        logging.warning("[TRACE] %s ya ocupa PORTAL_TRACE_MAX_MB; grabación deshabilitada", TRACE_FILE)
+        return False
+    with _lock:
+        _inicio_ms = int(time.time() * 1000)
+        _rutas.clear()
+        _permitidas = frozenset(rutas)
+        _buffer.extend(_SEGMENTO.pack(b"T", _VERSION, _inicio_ms))
+        _activo = True
+    threading.Thread(target=_bucle, args=(stop_event,), daemon=True, name="traffic-trace").start()
+    logging.info("[TRACE] Grabando traza anonimizada en %s", TRACE_FILE)
+    return True
+
+
+def leer(ruta: Path) -> Iterator[Registro]:
+    """Registros de una traza en el orden del archivo (lanza ValueError si está corrupta)."""
+    datos = Path(ruta).read_bytes()
+    pos = 0
+    inicio_ms: Optional[int] = None
+    rutas: Dict[int, str] = {}
+    while pos < len(datos):
+        etiqueta = datos[pos:pos + 1]
+        try:
+            if etiqueta == b"T":
+                _e, version, inicio_ms = _SEGMENTO.unpack_from(datos, pos)
+                if version != _VERSION:
+                    raise ValueError(f"versión de traza no soportada: {version}")
+                rutas = {}
+                pos += _SEGMENTO.size
+            elif etiqueta == b"R":
+                _e, codigo, longitud = _RUTA.unpack_from(datos, pos)
+                pos += _RUTA.size
+                rutas[codigo] = datos[pos:pos + longitud].decode("utf-8", "replace")
+                pos += longitud
+            elif etiqueta == b"P" and inicio_ms is not None:
+                _e, delta, cubo, metodo, codigo, clase = _PETICION.unpack_from(datos, pos)
+                pos += _PETICION.size
+                yield Registro(
+                    (inicio_ms + delta) / 1000.0,
+                    cubo,
+                    NOMBRES_METODO.get(metodo, "OTRO"),
+                    rutas.get(codigo, ""),
+                    clase,
+                )
+            else:
+                raise ValueError(f"registro desconocido {etiqueta!r} en el byte {pos}")
+        except struct.error:
+            # Último registro a medias (p. ej. proceso terminado durante un volcado)
+            return
+
+
+if __name__ == "__main__":
+    # Resumen de una traza: python3 src/traffic_trace.py [logs/portal.trace]
+    import sys
+    from collections import Counter
+
+    archivo = Path(sys.argv[1]) if len(sys.argv) > 1 else TRACE_FILE
+    try:
+        registros = list(leer(archivo))
+    except (OSError, ValueError) as exc:
+        print(f"No se pudo leer la traza {archivo}: {exc}")
+        raise SystemExit(1)
+    if not registros:
+        print(f"{archivo}: sin peticiones")
+        raise SystemExit(0)
+    duracion = registros[-1].instante - registros[0].instante
+    print(
+        f"{archivo}: {len(registros)} peticiones en {duracion:.1f} s, "
+        f"{len({r.cubo for r in registros})} cubos de origen"
+    )
+    print(f"desde {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(registros[0].instante))}")
+    for (metodo, ruta), n in Counter((r.metodo, r.ruta or "(otra)") for r in registros).most_common(15):
+        print(f"  {n:8d}  {metodo:5s} {ruta}")
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Benchmark de escalado del firewall dinámico (src/firewall_dynamic.py) en
+namespaces de red desechables, sin tocar la red ni las reglas del equipo.
+
+Ejecución (requiere root, iproute2 y al menos una variante de iptables):
+
+    sudo python3 tests/benchmark_firewall.py
+    sudo python3 tests/benchmark_firewall.py --tamanos 100,1000,5000 --backends nft --subcadenas 4
+    sudo python3 tests/benchmark_firewall.py --muestras 50 --duracion 5 --json /tmp/firewall.json
+
+Topología (una por backend y reparto en subcadenas; se destruye al acabar):
+
+    fwb-cli [fwb-cli 10.98.0.2/16] <-veth-> [fwb-lan 10.98.0.1/16] fwb-gw [fwb-wan 10.97.0.1/24] <-veth-> [fwb-srv 10.97.0.2/24] fwb-srv
+
+En el namespace del gateway se cargan reglas base equivalentes a
+scripts/firewall_init.sh (FORWARD DROP, ESTABLISHED/RELATED, DNS, redirección
+HTTP al portal y MASQUERADE; sin la interfaz host-only ni el guardado en
+/etc/iptables) y se importa firewall_dynamic con PORTAL_LAN_IF=fwb-lan.
+Para cada tamaño (100 a 20 000 clientes por defecto):
+
+- se completa la tabla hasta ese número de clientes con permitir_lote (se
+  informa del tiempo del lote),
+- se miden --muestras llamadas a permitir_ip_mac (la parte de firewall de un
+  login) y otras tantas a denegar_ip_mac (logout/expiración) de clientes
+  nuevos, que se quitan al terminar para no alterar el tamaño,
+- se mide el reenvío: un flujo UDP desde el primer cliente autorizado (su
+  regla queda la última de su cadena, el peor caso) hacia fwb-srv durante
+  --duracion segundos; se informa de los paquetes por segundo recibidos.
+
+Backends: cada variante de iptables instalada (iptables-legacy e
+iptables-nft, o el iptables del sistema si no hay ninguna de las dos), por
+separado, con PATH apuntando a ella. --subcadenas repite todo con distintos
+PORTAL_FIREWALL_SHARD_BITS (0 = reglas directamente en FORWARD/PREROUTING).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+NS_CLIENTE = "fwb-cli"
+NS_GATEWAY = "fwb-gw"
+NS_SERVIDOR = "fwb-srv"
+IF_LAN = "fwb-lan"
+IF_CLIENTE = "fwb-cli"
+IF_WAN = "fwb-wan"
+IF_SERVIDOR = "fwb-srv"
+IP_GATEWAY_LAN = "10.98.0.1"
+IP_SONDA = "10.98.0.2"
+MAC_SONDA = "02:00:00:98:00:02"
+IP_GATEWAY_WAN = "10.97.0.1"
+IP_SERVIDOR = "10.97.0.2"
+PUERTO_UDP = 9999
+PORTAL_HTTP_PORT = 8080
+
+# Variantes de iptables: nombre -> sufijo de los binarios
+VARIANTES = {"legacy": "-legacy", "nft": "-nft"}
+
+PERCENTILES = (50, 95)
+
+# Reglas base equivalentes a scripts/firewall_init.sh para la topología del benchmark
+REGLAS_BASE = f"""*filter
+:INPUT DROP [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -i lo -j ACCEPT
+-A INPUT -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
+-A FORWARD -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
+-A INPUT -i {IF_LAN} -p icmp -j ACCEPT
+-A FORWARD -i {IF_LAN} -o {IF_WAN} -p udp --dport 53 -j ACCEPT
+-A FORWARD -i {IF_LAN} -o {IF_WAN} -p tcp --dport 53 -j ACCEPT
+-A INPUT -i {IF_LAN} -p tcp --dport 22 -j ACCEPT
+-A INPUT -i {IF_LAN} -p tcp --dport {PORTAL_HTTP_PORT} -j ACCEPT
+COMMIT
+*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+-A PREROUTING -i {IF_LAN} -p tcp --dport 80 -j REDIRECT --to-ports {PORTAL_HTTP_PORT}
+-A POSTROUTING -o {IF_WAN} -j MASQUERADE
+COMMIT
+"""
+
+# Receptor UDP (namespace del servidor): cuenta datagramas hasta 1 s sin recibir
+RECEPTOR = """
+import socket, sys
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+s.bind(("0.0.0.0", int(sys.argv[1])))
+s.settimeout(5.0)
+print("listo", flush=True)
+n = 0
+try:
+    while True:
+        s.recv(2048)
+        n += 1
+        s.settimeout(1.0)
+except socket.timeout:
+    pass
+print(n)
+"""
+
+# Emisor UDP (namespace del cliente): datagramas de 64 bytes durante N segundos
+EMISOR = """
+import socket, sys, time
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+s.bind((sys.argv[1], 0))
+destino = (sys.argv[2], int(sys.argv[3]))
+datos = b"x" * 64
+fin = time.monotonic() + float(sys.argv[4])
+n = 0
+while time.monotonic() < fin:
+    for _ in range(100):
+        try:
+            s.sendto(datos, destino)
+            n += 1
+        except OSError:
+            pass  # ENOBUFS: la cola de la veth está llena
+print(n)
+"""
+
+
+def _ip(comando: str) -> None:
+    subprocess.run(["ip"] + comando.split(), check=True, capture_output=True, text=True)
+
+
+def _ip_cliente(i: int) -> str:
+    """IP del cliente i (la 0 es la sonda; el resto desde 10.98.1.2)."""
+    if i == 0:
+        return IP_SONDA
+    return f"10.98.{1 + i // 250}.{2 + i % 250}"
+
+
+def _mac_cliente(i: int) -> str:
+    if i == 0:
+        return MAC_SONDA
+    return "02:00:%02x:%02x:%02x:%02x" % (i >> 24 & 0xFF, i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF)
+
+
+def _percentiles(valores: List[float]) -> Dict[str, float]:
+    ordenados = sorted(valores)
+    if not ordenados:
+        return {}
+    resumen = {
+        f"p{p}": round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))] * 1000, 2)
+        for p in PERCENTILES
+    }
+    resumen["max"] = round(ordenados[-1] * 1000, 2)
+    return resumen
+
+
+# -- lado del gateway (dentro de fwb-gw) ----------------------------------------
+
+
+def _medir_reenvio(duracion: float) -> Tuple[float, float]:
+    """(pps recibidos, pps enviados) de un flujo UDP sonda -> servidor a través del gateway."""
+    receptor = subprocess.Popen(
+        ["ip", "netns", "exec", NS_SERVIDOR, sys.executable, "-c", RECEPTOR, str(PUERTO_UDP)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        receptor.stdout.readline()  # "listo"
+        emisor = subprocess.run(
+            ["ip", "netns", "exec", NS_CLIENTE, sys.executable, "-c", EMISOR,
+             IP_SONDA, IP_SERVIDOR, str(PUERTO_UDP), str(duracion)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        recibidos = int(receptor.communicate(timeout=duracion + 15)[0].strip() or 0)
+    finally:
+        if receptor.poll() is None:
+            receptor.kill()
+    return recibidos / duracion, int(emisor.stdout.strip()) / duracion
+
+
+def ejecutar_en_gateway(args: argparse.Namespace) -> Dict[str, object]:
+    """Mide todos los tamaños con el backend ya fijado en PATH (se ejecuta dentro de fwb-gw)."""
+    logging.basicConfig(level=logging.WARNING)
+    Path("/proc/sys/net/ipv4/ip_forward").write_text("1\n")
+    iptables_restore = shutil.which("iptables-restore")
+    subprocess.run([iptables_restore], input=REGLAS_BASE, check=True, capture_output=True, text=True)
+
+    import firewall_dynamic  # PATH y PORTAL_* ya fijados por el proceso padre
+
+    if not firewall_dynamic.preparar_cadenas():
+        raise RuntimeError("no se pudieron crear las subcadenas del firewall")
+
+    tamanos = sorted(args.tamanos)
+    resultados = []
+    autorizados = 0
+    # Clientes de las muestras: por encima del mayor tamaño, para no chocar con la tabla
+    siguiente_muestra = tamanos[-1]
+    for tamano in tamanos:
+        inicio = time.perf_counter()
+        firewall_dynamic.permitir_lote([(_ip_cliente(i), _mac_cliente(i)) for i in range(autorizados, tamano)])
+        lote_s = time.perf_counter() - inicio
+        lote_clientes = tamano - autorizados
+        autorizados = tamano
+
+        muestras = [(_ip_cliente(i), _mac_cliente(i)) for i in range(siguiente_muestra, siguiente_muestra + args.muestras)]
+        siguiente_muestra += args.muestras
+        permitir: List[float] = []
+        for ip, mac in muestras:
+            inicio = time.perf_counter()
+            firewall_dynamic.permitir_ip_mac(ip, mac)
+            permitir.append(time.perf_counter() - inicio)
+        denegar: List[float] = []
+        for ip, mac in muestras:
+            inicio = time.perf_counter()
+            firewall_dynamic.denegar_ip_mac(ip, mac)
+            denegar.append(time.perf_counter() - inicio)
+
+        recibidos_pps, enviados_pps = _medir_reenvio(args.duracion)
+        resultados.append({
+            "clientes": tamano,
+            "lote_clientes": lote_clientes,
+            "lote_s": round(lote_s, 3),
+            "permitir_ms": _percentiles(permitir),
+            "denegar_ms": _percentiles(denegar),
+            "reenvio_pps": round(recibidos_pps),
+            "enviados_pps": round(enviados_pps),
+        })
+        print(f"  {tamano} clientes medidos", file=sys.stderr, flush=True)
+    return {"resultados": resultados}
+
+
+# -- lado del host ----------------------------------------------------------------
+
+
+def detectar_backends() -> Dict[str, Dict[str, str]]:
+    """Variantes de iptables instaladas: nombre -> {iptables, iptables-save, iptables-restore}."""
+    backends: Dict[str, Dict[str, str]] = {}
+    for nombre, sufijo in VARIANTES.items():
+        rutas = {b: shutil.which(b.replace("iptables", "iptables" + sufijo, 1)) for b in
+                 ("iptables", "iptables-save", "iptables-restore")}
+        if all(rutas.values()):
+            backends[nombre] = rutas
+    if not backends:
+        rutas = {b: shutil.which(b) for b in ("iptables", "iptables-save", "iptables-restore")}
+        if all(rutas.values()):
+            backends["iptables"] = rutas
+    return backends
+
+
+class Topologia:
+    """Namespaces cliente, gateway y servidor unidos por dos pares veth."""
+
+    def __enter__(self) -> "Topologia":
+        self.destruir()
+        try:
+            for ns in (NS_CLIENTE, NS_GATEWAY, NS_SERVIDOR):
+                _ip(f"netns add {ns}")
+                _ip(f"-n {ns} link set lo up")
+            for extremo_gw, extremo, ns, ip_gw, ip_otro in (
+                (IF_LAN, IF_CLIENTE, NS_CLIENTE, f"{IP_GATEWAY_LAN}/16", f"{IP_SONDA}/16"),
+                (IF_WAN, IF_SERVIDOR, NS_SERVIDOR, f"{IP_GATEWAY_WAN}/24", f"{IP_SERVIDOR}/24"),
+            ):
+                _ip(f"link add {extremo_gw} type veth peer name {extremo}")
+                _ip(f"link set {extremo_gw} netns {NS_GATEWAY}")
+                _ip(f"link set {extremo} netns {ns}")
+                _ip(f"-n {NS_GATEWAY} addr add {ip_gw} dev {extremo_gw}")
+                _ip(f"-n {NS_GATEWAY} link set {extremo_gw} up")
+                _ip(f"-n {ns} addr add {ip_otro} dev {extremo}")
+            _ip(f"-n {NS_CLIENTE} link set {IF_CLIENTE} address {MAC_SONDA}")
+            _ip(f"-n {NS_CLIENTE} link set {IF_CLIENTE} up")
+            _ip(f"-n {NS_SERVIDOR} link set {IF_SERVIDOR} up")
+            _ip(f"-n {NS_CLIENTE} route add default via {IP_GATEWAY_LAN}")
+            _ip(f"-n {NS_SERVIDOR} route add default via {IP_GATEWAY_WAN}")
+        except subprocess.CalledProcessError as exc:
+            self.destruir()
+            raise RuntimeError(f"ip {' '.join(exc.cmd[1:])}: {exc.stderr.strip()}") from None
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.destruir()
+
+    @staticmethod
+    def destruir() -> None:
+        for ns in (NS_CLIENTE, NS_GATEWAY, NS_SERVIDOR):
+            subprocess.run(["ip", "netns", "del", ns], capture_output=True)
+
+
+def medir_backend(args: argparse.Namespace, rutas: Dict[str, str], subcadenas: int) -> Dict[str, object]:
+    """Lanza este script con --interno dentro del gateway, con PATH apuntando al backend."""
+    with tempfile.TemporaryDirectory(prefix="fwb-bin-") as binarios, Topologia():
+        for nombre, ruta in rutas.items():
+            os.symlink(ruta, os.path.join(binarios, nombre))
+        entorno = dict(
+            os.environ,
+            PATH=binarios + os.pathsep + os.environ.get("PATH", ""),
+            PORTAL_LAN_IF=IF_LAN,
+            CAPTIVE_HTTP_PORT="80",
+            PORTAL_FIREWALL_SHARD_BITS=str(subcadenas),
+        )
+        proc = subprocess.run(
+            ["ip", "netns", "exec", NS_GATEWAY, sys.executable, str(Path(__file__).resolve()), "--interno",
+             "--tamanos", ",".join(map(str, args.tamanos)), "--muestras", str(args.muestras),
+             "--duracion", str(args.duracion)],
+            env=entorno,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f"la medición terminó con código {proc.returncode}")
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _imprimir(nombre: str, subcadenas: int, resultados: List[Dict[str, object]]) -> None:
+    print(f"\n== {nombre}, PORTAL_FIREWALL_SHARD_BITS={subcadenas} ==")
+    print(f"{'clientes':>9}  {'lote (s)':>9}  {'permitir p50/p95 ms':>20}  {'denegar p50/p95 ms':>19}  "
+          f"{'reenvío pps':>11}  {'vs. menor':>9}")
+    referencia = resultados[0]["reenvio_pps"] or 1
+    for r in resultados:
+        permitir, denegar = r["permitir_ms"], r["denegar_ms"]
+        print(
+            f"{r['clientes']:>9}  {r['lote_s']:>9.2f}  {permitir.get('p50', 0):>9.1f}/{permitir.get('p95', 0):<10.1f}"
+            f"  {denegar.get('p50', 0):>8.1f}/{denegar.get('p95', 0):<10.1f}  {r['reenvio_pps']:>11}"
+            f"  {r['reenvio_pps'] / referencia:>8.0%}"
+        )
+
+
+def _lista_enteros(texto: str) -> List[int]:
+    return [int(x) for x in texto.split(",") if x.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Escalado del firewall dinámico en namespaces de red")
+    parser.add_argument("--tamanos", type=_lista_enteros, default=[100, 500, 1000, 2000, 5000, 10000, 20000],
+                        help="número de clientes autorizados (coma)")
+    parser.add_argument("--backends", default="", help="variantes a medir (legacy,nft); por defecto todas las instaladas")
+    parser.add_argument("--subcadenas", type=_lista_enteros, default=[0, 4],
+                        help="valores de PORTAL_FIREWALL_SHARD_BITS a medir (coma)")
+    parser.add_argument("--muestras", type=int, default=20, help="llamadas a permitir/denegar medidas por tamaño")
+    parser.add_argument("--duracion", type=float, default=3.0, help="segundos del flujo UDP de reenvío por tamaño")
+    parser.add_argument("--json", type=Path, help="guardar también los resultados en JSON")
+    parser.add_argument("--interno", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if max(args.tamanos, default=0) + args.muestras * len(args.tamanos) >= 250 * 254:
+        parser.error("demasiados clientes para la red 10.98.0.0/16 del benchmark")
+    if args.interno:
+        print(json.dumps(ejecutar_en_gateway(args)))
+        return 0
+
+    if os.geteuid() != 0:
+        print("Requiere root (ip netns, iptables).", file=sys.stderr)
+        return 2
+    if not shutil.which("ip"):
+        print("No se encontró el comando ip (iproute2).", file=sys.stderr)
+        return 2
+    backends = detectar_backends()
+    if args.backends:
+        pedidos = {b.strip() for b in args.backends.split(",") if b.strip()}
+        backends = {nombre: rutas for nombre, rutas in backends.items() if nombre in pedidos}
+    if not backends:
+        print("No hay ninguna variante de iptables disponible (iptables-legacy, iptables-nft o iptables).",
+              file=sys.stderr)
+        return 2
+
+    print(f"Backends: {', '.join(backends)}; tamaños: {args.tamanos}; subcadenas: {args.subcadenas}")
+    salida: List[Dict[str, object]] = []
+    for nombre, rutas in backends.items():
+        for subcadenas in args.subcadenas:
+            print(f"Midiendo {nombre} con {subcadenas} bits de subcadenas...", flush=True)
+            try:
+                medida = medir_backend(args, rutas, subcadenas)
+            except RuntimeError as exc:
+                print(f"  {nombre}: {exc}", file=sys.stderr)
+                continue
+            _imprimir(nombre, subcadenas, medida["resultados"])
+            salida.append({"backend": nombre, "subcadenas": subcadenas, **medida})
+
+    if args.json:
+        args.json.write_text(json.dumps(salida, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    return 0 if salida else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
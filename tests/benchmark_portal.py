@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks del portal (solo biblioteca estándar, sin red ni iptables).
+
+Ejecución:
+
+    python3 tests/benchmark_portal.py                 # mide y compara con la línea base
+    python3 tests/benchmark_portal.py --guardar       # mide y guarda la línea base
+    python3 tests/benchmark_portal.py --tamanos 1000,10000 --umbral 0.3 --filtro sesiones
+
+Cubre:
+- Parseo de peticiones en http_server.handle_client (GET de plantilla, GET
+  /status, POST /login fallido) y read_post_body_and_parse, con una conexión
+  simulada en memoria.
+- crear_sesion / eliminar_sesion / limpiar_sesiones_expiradas con 1k, 10k y
+  100k sesiones ya cargadas.
+- _serialize_sessions / _deserialize_sessions con esos mismos tamaños.
+- auth.load_users sobre archivos de 10k y 100k usuarios.
+
+La capa de firewall se sustituye por funciones vacías y las sesiones se
+persisten en un directorio temporal. Cada medida es el mejor tiempo por
+operación de varias rondas. Los resultados se comparan con la línea base JSON
+(por defecto tests/benchmark_baseline.json, propia de cada máquina) y se marcan
+como regresión los que empeoran más que el umbral; en ese caso la salida es 1.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+# Antes de importar sessions: la ruta de persistencia se fija al importar
+_TMP = tempfile.TemporaryDirectory(prefix="portal-bench-")
+os.environ["PORTAL_SESSIONS_FILE"] = str(Path(_TMP.name) / "sessions.json")
+os.environ.setdefault("PORTAL_SLOW_REQUEST_MS", "0")
+
+import arp_lookup  # noqa: E402
+import auth  # noqa: E402
+import firewall_dynamic  # noqa: E402
+import http_server  # noqa: E402
+import sessions  # noqa: E402
+
+DEFAULT_BASELINE = REPO_ROOT / "tests" / "benchmark_baseline.json"
+DEFAULT_THRESHOLD = float(os.getenv("PORTAL_BENCH_THRESHOLD", "0.25"))
+RONDAS = 5
+
+
+def _stub_firewall() -> None:
+    """Sustituye las operaciones de iptables/ARP por funciones que no hacen nada."""
+    for nombre in ("permitir_ip_mac", "permitir_ip", "denegar_ip_mac", "denegar_ip"):
+        setattr(firewall_dynamic, nombre, lambda *args, **kwargs: True)
+    firewall_dynamic.revocar_lote = lambda clientes, en_uso=None: None
+    firewall_dynamic.restaurar_reglas = lambda clientes: (0, 0)
+    arp_lookup.get_mac = lambda ip: None
+
+
+class _ConexionFalsa:
+    """Socket mínimo en memoria para handle_client (recv del buffer, sendall descartado)."""
+
+    __slots__ = ("_datos", "_pos", "enviado")
+
+    def __init__(self, datos: bytes) -> None:
+        self._datos = datos
+        self._pos = 0
+        self.enviado = 0
+
+    def settimeout(self, timeout: float) -> None:
+        pass
+
+    def recv(self, n: int) -> bytes:
+        chunk = self._datos[self._pos:self._pos + n]
+        self._pos += len(chunk)
+        return chunk
+
+    def sendall(self, data: bytes) -> None:
+        self.enviado += len(data)
+
+    def close(self) -> None:
+        pass
+
+
+def _ip(i: int) -> str:
+    return f"10.{(i >> 16) & 0xFF}.{(i >> 8) & 0xFF}.{i & 0xFF}"
+
+
+def _mac(i: int) -> str:
+    return "02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+
+
+def _poblar(n: int, expiradas: float = 0.0) -> None:
+    """Carga n sesiones directamente en el almacén (una fracción `expiradas` ya vencida)."""
+    now = time.time()
+    corte = int(n * expiradas)
+    restored = {}
+    for i in range(n):
+        sess = sessions.Session(
+            username=f"usuario{i % 1000}",
+            ip=_ip(i),
+            mac=_mac(i),
+            login_time=now - 7200,
+            expires_at=now - 60 if i < corte else now + 3600,
+        )
+        restored[sess.key] = sess
+    with sessions._lock:
+        sessions._replace_all(restored)
+
+
+def _medir(
+    ejecutar: Callable[[], int],
+    preparar: Optional[Callable[[], None]] = None,
+    rondas: int = RONDAS,
+) -> float:
+    """
+    Mejor tiempo por operación (segundos) de `rondas` ejecuciones.
+    `ejecutar` devuelve cuántas operaciones hizo; `preparar` no se cronometra.
+    """
+    mejor = float("inf")
+    for _ in range(rondas):
+        if preparar is not None:
+            preparar()
+        inicio = time.perf_counter()
+        operaciones = ejecutar()
+        duracion = time.perf_counter() - inicio
+        mejor = min(mejor, duracion / max(1, operaciones))
+    return mejor
+
+
+def _repetir(fn: Callable[[], object], veces: int) -> Callable[[], int]:
+    def ejecutar() -> int:
+        for _ in range(veces):
+            fn()
+        return veces
+
+    return ejecutar
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_http() -> Dict[str, float]:
+    http_server.fill_template_cache()
+    http_server.USERS = {"admin": "admin"}
+    _poblar(1000)
+
+    peticiones = {
+        "http.get_login": b"GET /login HTTP/1.1\r\nHost: portal\r\nUser-Agent: bench\r\n\r\n",
+        "http.get_status": b"GET /status HTTP/1.1\r\nHost: portal\r\n\r\n",
+        "http.post_login_fallido": (
+            b"POST /login HTTP/1.1\r\nHost: portal\r\n"
+            b"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: 29\r\n\r\n"
+            b"username=admin&password=nope1"
+        ),
+    }
+    resultados = {}
+    for nombre, datos in peticiones.items():
+        addr = (_ip(5), 40000)
+        resultados[nombre] = _medir(
+            _repetir(lambda datos=datos: http_server.handle_client(_ConexionFalsa(datos), addr), 2000)
+        )
+
+    cuerpo = "username=" + "u" * 40 + "&password=" + "p" * 40 + "&extra=" + "x%20y" * 200
+    cabeceras = (
+        "POST /login HTTP/1.1\r\nHost: portal\r\nContent-Length: %d\r\n\r\n" % len(cuerpo)
+    ).encode("ascii")
+    # La mitad del cuerpo llega con las cabeceras y el resto se lee de la conexión
+    mitad = len(cuerpo) // 2
+    inicial = cabeceras + cuerpo[:mitad].encode("ascii")
+    resto = cuerpo[mitad:].encode("ascii")
+    resultados["http.read_post_body_and_parse"] = _medir(
+        _repetir(lambda: http_server.read_post_body_and_parse(inicial, _ConexionFalsa(resto)), 5000)
+    )
+    return resultados
+
+
+def bench_sesiones(tamanos: List[int]) -> Dict[str, float]:
+    resultados = {}
+    for n in tamanos:
+        # Cada alta/baja persiste todo el almacén: menos operaciones con tablas grandes
+        veces = max(3, min(100, 100_000 // n))
+        nuevas = [(_ip(n + i), _mac(n + i)) for i in range(veces)]
+
+        def crear() -> int:
+            for ip, mac in nuevas:
+                sessions.crear_sesion("bench", ip, mac=mac)
+            return len(nuevas)
+
+        def eliminar() -> int:
+            for ip, mac in nuevas:
+                sessions.eliminar_sesion(ip, mac)
+            return len(nuevas)
+
+        rondas = 3 if n >= 10_000 else RONDAS
+        resultados[f"sesiones.crear_sesion[{n}]"] = _medir(crear, preparar=lambda: _poblar(n), rondas=rondas)
+        resultados[f"sesiones.eliminar_sesion[{n}]"] = _medir(
+            eliminar, preparar=lambda: (_poblar(n), crear()), rondas=rondas
+        )
+        # Una pasada de limpieza con el 10 % de las sesiones vencidas
+        resultados[f"sesiones.limpiar_sesiones_expiradas[{n}]"] = _medir(
+            lambda: (sessions.limpiar_sesiones_expiradas(), 1)[1],
+            preparar=lambda: _poblar(n, expiradas=0.1),
+            rondas=rondas,
+        )
+
+        _poblar(n)
+        with sessions._lock:
+            payload = sessions._serialize_sessions()
+        resultados[f"sesiones.serialize[{n}]"] = _medir(
+            lambda: (sessions._serialize_sessions(), 1)[1], rondas=rondas
+        )
+        resultados[f"sesiones.deserialize[{n}]"] = _medir(
+            lambda: (sessions._deserialize_sessions(payload), 1)[1], rondas=rondas
+        )
+    with sessions._lock:
+        sessions._replace_all({})
+    return resultados
+
+
+def bench_usuarios(tamanos: List[int]) -> Dict[str, float]:
+    resultados = {}
+    for n in tamanos:
+        if n < 10_000:
+            continue
+        ruta = Path(_TMP.name) / f"usuarios-{n}.txt"
+        with ruta.open("w", encoding="utf-8") as f:
+            f.write("# usuarios de prueba\n\n")
+            for i in range(n):
+                f.write(f"usuario{i}:clave-{i:08d}\n")
+        resultados[f"auth.load_users[{n}]"] = _medir(lambda: (auth.load_users(ruta), 1)[1])
+    return resultados
+
+
+# ---------------------------------------------------------------------------
+# Línea base y comparación
+# ---------------------------------------------------------------------------
+
+def _cargar_baseline(ruta: Path) -> Dict[str, float]:
+    try:
+        with ruta.open("r", encoding="utf-8") as f:
+            return json.load(f).get("resultados", {})
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exc:
+        print(f"Línea base ilegible en {ruta}: {exc}", file=sys.stderr)
+        return {}
+
+
+def _guardar_baseline(ruta: Path, resultados: Dict[str, float]) -> None:
+    datos = {
+        "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "resultados": resultados,
+    }
+    ruta.parent.mkdir(parents=True, exist_ok=True)
+    with ruta.open("w", encoding="utf-8") as f:
+        json.dump(datos, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def _formatear(segundos: float) -> str:
+    if segundos < 1e-3:
+        return f"{segundos * 1e6:9.1f} µs"
+    if segundos < 1:
+        return f"{segundos * 1e3:9.2f} ms"
+    return f"{segundos:9.3f} s "
+
+
+def comparar(resultados: Dict[str, float], baseline: Dict[str, float], umbral: float) -> List[str]:
+    """Imprime la tabla de resultados y devuelve los nombres que empeoran más que `umbral`."""
+    regresiones = []
+    ancho = max(len(nombre) for nombre in resultados)
+    for nombre, valor in resultados.items():
+        previo = baseline.get(nombre)
+        if previo:
+            cambio = valor / previo - 1.0
+            marca = ""
+            if cambio > umbral:
+                marca = "  << REGRESIÓN"
+                regresiones.append(nombre)
+            print(f"{nombre:<{ancho}}  {_formatear(valor)}  (base {_formatear(previo).strip()}, {cambio:+.0%}){marca}")
+        else:
+            print(f"{nombre:<{ancho}}  {_formatear(valor)}")
+    return regresiones
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks del portal cautivo")
+    parser.add_argument("--tamanos", default="1000,10000,100000", help="número de sesiones/usuarios (coma)")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="archivo JSON de línea base")
+    parser.add_argument("--guardar", action="store_true", help="guardar los resultados como nueva línea base")
+    parser.add_argument(
+        "--umbral",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="empeoramiento relativo tolerado antes de marcar regresión (0.25 = 25%%)",
+    )
+    parser.add_argument("--filtro", default="", help="solo grupos cuyo nombre contenga el texto (http, sesiones, auth)")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    _stub_firewall()
+    tamanos = [int(t) for t in args.tamanos.split(",") if t.strip()]
+
+    grupos = {
+        "http": bench_http,
+        "sesiones": lambda: bench_sesiones(tamanos),
+        "auth": lambda: bench_usuarios(tamanos),
+    }
+    resultados: Dict[str, float] = {}
+    for nombre, bench in grupos.items():
+        if args.filtro and args.filtro not in nombre:
+            continue
+        resultados.update(bench())
+
+    if not resultados:
+        print("Ningún benchmark seleccionado")
+        return 0
+
+    baseline = _cargar_baseline(args.baseline)
+    regresiones = comparar(resultados, baseline, args.umbral)
+
+    if args.guardar:
+        # Conserva las medidas de grupos no ejecutados en esta pasada
+        _guardar_baseline(args.baseline, {**baseline, **resultados})
+        print(f"Línea base guardada en {args.baseline}")
+        return 0
+    if regresiones:
+        print(f"{len(regresiones)} regresiones por encima del {args.umbral:.0%}: {', '.join(regresiones)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Comprueba el índice de concesiones DHCP de src/dhcp_leases.py con los
+archivos de ejemplo de tests/data/ (dnsmasq e ISC dhcpd), sin red ni root:
+
+    python3 tests/comprobar_dhcp_leases.py
+
+- Parseo de ambos formatos: caducidades, concesiones liberadas, la última
+  concesión de una IP manda, bloques que no son concesiones, DHCPv6.
+- Relectura incremental (ISC): un bloque añadido a medias no se aplica hasta
+  que se completa, y solo se leen los bytes nuevos.
+- Relectura completa cuando el archivo se reescribe (dnsmasq, o dhcpd
+  sustituyendo el archivo).
+
+Termina con código 1 si alguna comprobación falla.
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DATOS = REPO_ROOT / "tests" / "data"
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+import dhcp_leases  # noqa: E402
+
+# Instante fijo para que las caducidades del ejemplo no dependan de la fecha
+AHORA = 1792400000.0  # 2026-10-19
+
+fallos = 0
+
+
+def comprobar(descripcion: str, obtenido: object, esperado: object) -> None:
+    global fallos
+    if obtenido == esperado:
+        print(f"OK    {descripcion}")
+    else:
+        fallos += 1
+        print(f"FALLO {descripcion}: se obtuvo {obtenido!r}, se esperaba {esperado!r}")
+
+
+def vigentes(indice: dhcp_leases.IndiceConcesiones) -> dict:
+    return {ip: (c.mac, c.hostname) for ip, c in indice.concesiones.items() if c.vigente(AHORA)}
+
+
+def tocar(ruta: Path) -> None:
+    # Asegura un mtime distinto aunque el sistema de archivos tenga poca resolución
+    marca = time.time_ns() + 1_000_000_000
+    os.utime(ruta, ns=(marca, marca))
+
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        # --- dnsmasq ---
+        ruta = Path(tmp) / "dnsmasq.leases"
+        shutil.copy(DATOS / "dnsmasq.leases", ruta)
+        indice = dhcp_leases.IndiceConcesiones(str(ruta), intervalo=0)
+        comprobar("dnsmasq: formato detectado", (indice.actualizar(), indice.formato), (True, "dnsmasq"))
+        comprobar(
+            "dnsmasq: concesiones vigentes (sin caducadas, IPv6 ni MACs no Ethernet)",
+            vigentes(indice),
+            {
+                "192.168.50.101": ("aa:bb:cc:00:00:01", "telefono-ana"),
+                "192.168.50.102": ("aa:bb:cc:00:00:02", "impresora-aula"),
+                "192.168.50.104": ("aa:bb:cc:00:00:04", None),
+            },
+        )
+        comprobar("dnsmasq: expiración 0 = sin caducidad", indice.concesiones["192.168.50.102"].expira, None)
+        comprobar("dnsmasq: sin cambios no se relee", indice.actualizar(), False)
+
+        ruta.write_text("4102444800 aa:bb:cc:00:00:09 192.168.50.109 nuevo *\n", encoding="utf-8")
+        tocar(ruta)
+        indice.actualizar()
+        comprobar(
+            "dnsmasq: archivo reescrito sustituye el índice",
+            sorted(indice.concesiones),
+            ["192.168.50.109"],
+        )
+
+        # --- ISC dhcpd ---
+        ruta = Path(tmp) / "dhcpd.leases"
+        shutil.copy(DATOS / "dhcpd.leases", ruta)
+        indice = dhcp_leases.IndiceConcesiones(str(ruta), intervalo=0)
+        comprobar("isc: formato detectado", (indice.actualizar(), indice.formato), (True, "isc"))
+        comprobar(
+            "isc: concesiones vigentes (liberada, caducada, host e ia-na fuera; la última manda)",
+            vigentes(indice),
+            {
+                "192.168.50.202": ("aa:bb:cc:00:01:02", "camara # 2"),
+                "192.168.50.203": ("aa:bb:cc:00:01:03", "portátil-luis"),
+                "192.168.50.205": ("aa:bb:cc:00:01:55", "movil-nuevo"),
+            },
+        )
+        comprobar("isc: 'ends never' sin caducidad", indice.concesiones["192.168.50.202"].expira, None)
+        comprobar("isc: 'ends epoch'", indice.concesiones["192.168.50.203"].expira, 4102444800.0)
+        comprobar("isc: fecha UTC", indice.concesiones["192.168.50.201"].expira, 1792008000.0)
+
+        tamano = ruta.stat().st_size
+        with open(ruta, "a", encoding="utf-8") as f:
+            f.write("lease 192.168.50.206 {\n  starts 1 2026/10/19 10:00:00;\n  ends never;\n")
+        tocar(ruta)
+        indice.actualizar()
+        comprobar("isc: bloque a medio escribir no se aplica", "192.168.50.206" in indice.concesiones, False)
+
+        with open(ruta, "a", encoding="utf-8") as f:
+            f.write("  binding state active;\n  hardware ethernet aa:bb:cc:00:01:06;\n}\n")
+            f.write("lease 192.168.50.202 {\n  binding state released;\n  hardware ethernet aa:bb:cc:00:01:02;\n}\n")
+        tocar(ruta)
+        leidos = indice.metricas["lecturas_completas"]
+        indice.actualizar()
+        comprobar("isc: bloque completado se aplica", indice.concesiones.get("192.168.50.206").mac, "aa:bb:cc:00:01:06")
+        comprobar("isc: concesión liberada se quita", "192.168.50.202" in indice.concesiones, False)
+        comprobar(
+            "isc: solo lecturas incrementales tras la carga",
+            (indice.metricas["lecturas_completas"], indice.metricas["lecturas_incrementales"]),
+            (leidos, 2),
+        )
+        comprobar("isc: bytes procesados = tamaño del archivo", indice._leido, ruta.stat().st_size)
+        comprobar("isc: el archivo creció", ruta.stat().st_size > tamano, True)
+
+        # dhcpd reescribe el archivo con rename(): otro inodo, relectura completa
+        nuevo = Path(tmp) / "dhcpd.leases.new"
+        nuevo.write_text(
+            "lease 192.168.50.210 {\n  ends never;\n  hardware ethernet aa:bb:cc:00:01:10;\n}\n", encoding="utf-8"
+        )
+        os.replace(nuevo, ruta)
+        tocar(ruta)
+        indice.actualizar()
+        comprobar("isc: archivo sustituido se relee entero", sorted(indice.concesiones), ["192.168.50.210"])
+
+    comprobar("archivo inexistente: sin concesiones", dhcp_leases.IndiceConcesiones("/nonexistent").tabla(), {})
+
+    print(f"\n{'Todas las comprobaciones pasaron' if not fallos else f'{fallos} comprobaciones fallaron'}")
+    return 1 if fallos else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Mide la memoria por sesión del almacén de src/sessions.py (sin firewall ni disco).
+
+Ejecución:
+
+    python3 tests/medir_memoria_sesiones.py [N]
+
+Crea N sesiones (por defecto 100000) con IPs y MACs distintas y 1000 usuarios
+que se repiten, directamente en el almacén interno, y muestra los bytes por
+sesión medidos con tracemalloc (objetos de sesión + claves + índice por IP)
+y el coste de recorrer todas las sesiones con obtener_todas_las_sesiones().
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import sessions  # noqa: E402
+
+
+def _cliente(i: int):
+    """IP, MAC y usuario del cliente i (cadenas nuevas, como las de cada login)."""
+    ip = f"10.{(i >> 16) & 0xFF}.{(i >> 8) & 0xFF}.{i & 0xFF}"
+    mac = "02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+    return ip, mac, f"usuario{i % 1000}"
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    now = time.time()
+
+    tracemalloc.start()
+    antes, _ = tracemalloc.get_traced_memory()
+    with sessions._lock:
+        for i in range(n):
+            ip, mac, usuario = _cliente(i)
+            sess = sessions.Session(
+                username=usuario,
+                ip=ip,
+                mac=mac,
+                login_time=now,
+                expires_at=now + 3600,
+            )
+            sessions._store(sessions._make_key(ip, mac), sess)
+    despues, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    inicio = time.perf_counter()
+    total = sum(1 for _ in sessions.obtener_todas_las_sesiones().values())
+    recorrido = time.perf_counter() - inicio
+
+    print(f"sesiones: {total}")
+    print(f"memoria: {(despues - antes) / n:.1f} bytes/sesión ({(despues - antes) / 1e6:.1f} MB)")
+    print(f"obtener_todas_las_sesiones() + recorrido: {recorrido * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
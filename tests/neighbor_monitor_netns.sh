@@ -0,0 +1,71 @@
+#!/usr/bin/env bash
+# Prueba del monitor de vecinos rtnetlink (src/neighbor_monitor.py) con un par
+# veth y un namespace de red, sin tocar la red real del equipo.
+#
+#   sudo bash tests/neighbor_monitor_netns.sh
+#
+# 1) Crea el namespace "nmtest" con un extremo veth (10.99.0.2) y deja el otro
+#    en el host (10.99.0.1).
+# 2) Arranca el monitor (filtrado a la interfaz del host) y envía tráfico al vecino:
+#    el mapa debe tener 10.99.0.2 con la MAC del extremo del namespace.
+# 3) Cambia la MAC del extremo del namespace y hace que vuelva a hablar: el
+#    monitor debe avisar del cambio de MAC al instante.
+#
+# Requiere root (ip netns / ip link) y python3. Sale con código 0 si todo se cumple.
+
+set -euo pipefail
+
+NS="nmtest"
+HOST_IF="nm-host"
+NS_IF="nm-cli"
+MAC_1="02:00:00:99:00:02"
+MAC_2="02:00:00:99:00:fe"
+REPO_DIR="$(cd "$(dirname "$0")/.." && pwd)"
+SALIDA="$(mktemp)"
+
+cleanup() {
+  [[ -n "${MON_PID:-}" ]] && kill "$MON_PID" 2>/dev/null || true
+  ip netns del "$NS" 2>/dev/null || true
+  ip link del "$HOST_IF" 2>/dev/null || true
+  rm -f "$SALIDA"
+}
+trap cleanup EXIT
+
+# Envía un datagrama UDP (fuerza la resolución ARP, no hace falta ping)
+hablar() { python3 -c "import socket; socket.socket(socket.AF_INET, socket.SOCK_DGRAM).sendto(b'x', ('$1', 9))"; sleep 0.3; }
+log() { echo "[$(date +%H:%M:%S)] $*"; }
+fallo() { log "FALLO: $*"; echo "--- salida del monitor ---"; cat "$SALIDA"; exit 1; }
+
+ip netns add "$NS"
+ip link add "$HOST_IF" type veth peer name "$NS_IF"
+ip link set "$NS_IF" netns "$NS"
+ip addr add 10.99.0.1/24 dev "$HOST_IF"
+ip link set "$HOST_IF" up
+ip -n "$NS" link set "$NS_IF" address "$MAC_1"
+ip -n "$NS" addr add 10.99.0.2/24 dev "$NS_IF"
+ip -n "$NS" link set "$NS_IF" up
+ip -n "$NS" link set lo up
+
+log "Arrancando el monitor en $HOST_IF"
+python3 -u "$REPO_DIR/src/neighbor_monitor.py" "$HOST_IF" >"$SALIDA" 2>&1 &
+MON_PID=$!
+sleep 1
+
+log "1) tráfico hacia el vecino: debe aparecer 10.99.0.2 -> $MAC_1"
+hablar 10.99.0.2
+ip neigh show dev "$HOST_IF" | grep -q "$MAC_1" || fallo "el kernel no aprendió la MAC"
+
+log "2) cambiando la MAC del vecino a $MAC_2"
+ip -n "$NS" link set "$NS_IF" address "$MAC_2"
+ip -n "$NS" neigh flush all
+sleep 1.2   # arp locktime: el kernel ignora actualizaciones muy seguidas
+ip netns exec "$NS" bash -c "$(declare -f hablar); hablar 10.99.0.1"
+
+for _ in $(seq 1 20); do
+  grep -q "CAMBIO 10.99.0.2: $MAC_1 -> $MAC_2" "$SALIDA" && break
+  sleep 0.1
+done
+grep -q "CAMBIO 10.99.0.2: $MAC_1 -> $MAC_2" "$SALIDA" || fallo "el monitor no notificó el cambio de MAC"
+
+log "OK: el monitor detectó el cambio de MAC"
+cat "$SALIDA"
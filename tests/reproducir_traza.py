@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Reproduce una traza grabada con PORTAL_TRACE=1 (src/traffic_trace.py) contra
+un portal local y mide latencias y errores (solo biblioteca estándar).
+
+Ejecución (con un portal de pruebas escuchando, por ejemplo en 127.0.0.1:8080):
+
+    python3 tests/reproducir_traza.py logs/portal.trace
+    python3 tests/reproducir_traza.py logs/portal.trace --velocidad 20 --origenes
+    python3 tests/reproducir_traza.py traza --tls --puerto 8443 --json resultado.json
+
+- Cada petición sale en su instante original dividido por --velocidad (1 a
+  50): se conservan las ráfagas y los huecos de la carga real.
+- GET y POST a la ruta grabada; los POST /login llevan --usuario/--clave
+  rellenados hasta el tamaño de la clase grabada. Las rutas que el portal
+  no sirve (grabadas como "otra") van a una ruta inexistente (404).
+- --origenes conecta desde 127.77.x.y, una dirección de loopback por cubo de
+  origen, así el portal ve clientes distintos (crea sesiones para ellas:
+  usar un portal de pruebas, con iptables sustituido o en un namespace).
+- La latencia se mide desde el instante programado, no desde que un hilo
+  queda libre: si el reproductor o el portal se atascan, el retraso cuenta.
+
+Salida: percentiles de latencia (total y por ruta), códigos HTTP y errores
+(conexión, timeout, 408, 5xx). Código de salida 1 si la fracción de errores
+supera --max-errores.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import socket
+import ssl
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "src"))
+
+import traffic_trace  # noqa: E402
+
+RUTA_DESCONOCIDA = "/__ruta_no_grabada"
+PERCENTILES = (50, 90, 95, 99)
+
+
+class Reproductor:
+    """Lanza las peticiones de la traza y acumula los resultados."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.lock = threading.Lock()
+        self.latencias: Dict[str, List[float]] = defaultdict(list)
+        self.servicio: List[float] = []
+        self.codigos: Counter = Counter()
+        self.errores: Counter = Counter()
+        self.errores_ruta: Counter = Counter()
+        self.tls: Optional[ssl.SSLContext] = None
+        if args.tls:
+            self.tls = ssl.create_default_context()
+            self.tls.check_hostname = False
+            self.tls.verify_mode = ssl.CERT_NONE
+
+    def _peticion(self, registro: traffic_trace.Registro) -> bytes:
+        ruta = registro.ruta or RUTA_DESCONOCIDA
+        metodo = registro.metodo if registro.metodo != "OTRO" else "HEAD"
+        cabecera = f"{metodo} {ruta} HTTP/1.1\r\nHost: {self.args.host}\r\nConnection: close\r\n"
+        if metodo != "POST":
+            return (cabecera + "\r\n").encode("utf-8")
+        tamano = traffic_trace.tamano_de_clase(registro.clase_tamano)
+        cuerpo = f"username={self.args.usuario}&password={self.args.clave}" if ruta == "/login" else ""
+        if len(cuerpo) < tamano:
+            relleno = "&relleno=" if cuerpo else "relleno="
+            cuerpo += relleno + "x" * max(0, tamano - len(cuerpo) - len(relleno))
+        cuerpo_b = cuerpo.encode("utf-8")
+        cabecera += f"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(cuerpo_b)}\r\n\r\n"
+        return cabecera.encode("utf-8") + cuerpo_b
+
+    def _origen(self, cubo: int) -> Optional[Tuple[str, int]]:
+        if not self.args.origenes:
+            return None
+        return (f"127.77.{cubo >> 8}.{cubo & 0xFF}", 0)
+
+    def ejecutar(self, registro: traffic_trace.Registro, programado: float) -> None:
+        ruta = registro.ruta or RUTA_DESCONOCIDA
+        inicio = time.monotonic()
+        error = None
+        codigo = None
+        try:
+            with socket.create_connection(
+                (self.args.host, self.args.puerto), timeout=self.args.timeout, source_address=self._origen(registro.cubo)
+            ) as sock:
+                conn = self.tls.wrap_socket(sock, server_hostname=self.args.host) if self.tls else sock
+                conn.sendall(self._peticion(registro))
+                respuesta = b""
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    respuesta += chunk
+            linea = respuesta.split(b"\r\n", 1)[0].split(b" ")
+            if len(linea) < 2 or not linea[1].isdigit():
+                error = "respuesta_invalida"
+            else:
+                codigo = int(linea[1])
+                if codigo == 408 or codigo >= 500:
+                    error = f"http_{codigo}"
+        except socket.timeout:
+            error = "timeout"
+        except ConnectionRefusedError:
+            error = "conexion_rechazada"
+        except (ConnectionResetError, BrokenPipeError):
+            error = "conexion_cortada"
+        except (OSError, ssl.SSLError) as exc:
+            error = type(exc).__name__
+        fin = time.monotonic()
+        with self.lock:
+            self.latencias[ruta].append(fin - programado)
+            self.servicio.append(fin - inicio)
+            if codigo is not None:
+                self.codigos[codigo] += 1
+            if error:
+                self.errores[error] += 1
+                self.errores_ruta[ruta] += 1
+
+    def reproducir(self, registros: List[traffic_trace.Registro]) -> float:
+        """Lanza todas las peticiones respetando los tiempos; devuelve la duración real."""
+        origen = registros[0].instante
+        comienzo = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrencia) as pool:
+            for registro in registros:
+                programado = comienzo + (registro.instante - origen) / self.args.velocidad
+                espera = programado - time.monotonic()
+                if espera > 0:
+                    time.sleep(espera)
+                pool.submit(self.ejecutar, registro, programado)
+        return time.monotonic() - comienzo
+
+
+def _percentil(valores: List[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def _resumen(valores: List[float]) -> Dict[str, float]:
+    ordenados = sorted(valores)
+    resumen = {f"p{p}": round(_percentil(ordenados, p) * 1000, 2) for p in PERCENTILES}
+    resumen["max"] = round(ordenados[-1] * 1000, 2) if ordenados else 0.0
+    return resumen
+
+
+def _formato(resumen: Dict[str, float]) -> str:
+    return "  ".join(f"{clave}={valor:8.1f}" for clave, valor in resumen.items())
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Reproduce una traza del portal y mide latencias")
+    parser.add_argument("traza", type=Path, help="archivo grabado con PORTAL_TRACE=1")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8080)
+    parser.add_argument("--tls", action="store_true", help="conectar por HTTPS (sin verificar el certificado)")
+    parser.add_argument("--velocidad", type=float, default=1.0, help="factor de aceleración, de 1 a 50")
+    parser.add_argument("--concurrencia", type=int, default=256, help="peticiones simultáneas como mucho")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--usuario", default="admin")
+    parser.add_argument("--clave", default="admin")
+    parser.add_argument("--origenes", action="store_true", help="una IP de loopback 127.77.x.y por cubo de origen")
+    parser.add_argument("--limite", type=int, default=0, help="reproducir solo las N primeras peticiones")
+    parser.add_argument("--max-errores", type=float, default=0.01, help="fracción de errores tolerada")
+    parser.add_argument("--json", type=Path, help="guardar también el resultado en JSON")
+    args = parser.parse_args(argv)
+
+    if not 1.0 <= args.velocidad <= 50.0:
+        parser.error("--velocidad debe estar entre 1 y 50")
+    try:
+        registros = sorted(traffic_trace.leer(args.traza), key=lambda r: r.instante)
+    except (OSError, ValueError) as exc:
+        print(f"No se pudo leer la traza {args.traza}: {exc}", file=sys.stderr)
+        return 2
+    if args.limite:
+        registros = registros[: args.limite]
+    if not registros:
+        print(f"{args.traza}: traza vacía", file=sys.stderr)
+        return 2
+
+    duracion_original = registros[-1].instante - registros[0].instante
+    print(
+        f"Traza {args.traza}: {len(registros)} peticiones en {duracion_original:.1f} s, "
+        f"{len({r.cubo for r in registros})} cubos de origen; reproduciendo a x{args.velocidad:g} "
+        f"contra {args.host}:{args.puerto}{' (TLS)' if args.tls else ''}"
+    )
+    reproductor = Reproductor(args)
+    duracion = reproductor.reproducir(registros)
+
+    todas = [valor for valores in reproductor.latencias.values() for valor in valores]
+    total_errores = sum(reproductor.errores.values())
+    fraccion = total_errores / len(registros)
+    print(f"Reproducida en {duracion:.1f} s ({len(registros) / max(duracion, 1e-9):.0f} pet/s)")
+    print(f"Latencia desde el instante programado (ms): {_formato(_resumen(todas))}")
+    print(f"Tiempo de servicio (ms):                    {_formato(_resumen(reproductor.servicio))}")
+    print("Por ruta:")
+    for ruta, valores in sorted(reproductor.latencias.items(), key=lambda item: -len(item[1])):
+        resumen = _resumen(valores)
+        print(
+            f"  {ruta[:30]:30s} {len(valores):7d}  p50={resumen['p50']:8.1f}  p95={resumen['p95']:8.1f}  "
+            f"p99={resumen['p99']:8.1f}  errores={reproductor.errores_ruta[ruta]}"
+        )
+    print("Códigos HTTP:", dict(sorted(reproductor.codigos.items())))
+    print(f"Errores: {total_errores} ({fraccion:.2%})", dict(reproductor.errores) if total_errores else "")
+
+    if args.json:
+        resultado = {
+            "traza": str(args.traza),
+            "peticiones": len(registros),
+            "velocidad": args.velocidad,
+            "duracion_s": round(duracion, 3),
+            "latencia_ms": _resumen(todas),
+            "servicio_ms": _resumen(reproductor.servicio),
+            "por_ruta": {ruta: dict(_resumen(v), peticiones=len(v)) for ruta, v in reproductor.latencias.items()},
+            "codigos": {str(c): n for c, n in reproductor.codigos.items()},
+            "errores": dict(reproductor.errores),
+        }
+        args.json.write_text(json.dumps(resultado, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+
+    if fraccion > args.max_errores:
+        print(f"Errores por encima de lo tolerado ({args.max_errores:.2%})")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())